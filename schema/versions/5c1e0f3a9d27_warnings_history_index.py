@@ -0,0 +1,31 @@
+"""Composite index for warning history
+
+Revision ID: 5c1e0f3a9d27
+Revises: a2bc71b837b9
+Create Date: 2026-10-18 09:12:41.503118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e0f3a9d27'
+down_revision = 'a2bc71b837b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'ix_warnings_server_user_id',
+        'warnings',
+        ['server_id', 'user_id', 'id']
+    )
+    # fully covered by the leading column of the composite index
+    op.drop_index('ix_warnings_server_id', table_name='warnings')
+
+
+def downgrade():
+    op.create_index('ix_warnings_server_id', 'warnings', ['server_id'])
+    op.drop_index('ix_warnings_server_user_id', table_name='warnings')
@@ -0,0 +1,37 @@
+"""Warning timestamps and hourly tallies
+
+Revision ID: 8f4b2d61c0e5
+Revises: 5c1e0f3a9d27
+Create Date: 2026-10-18 10:40:02.118734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f4b2d61c0e5'
+down_revision = '5c1e0f3a9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing warnings have no real timestamp, leave them NULL rather than
+    # stamping them with the migration time and counting them as recent
+    op.add_column(
+        'warnings',
+        sa.Column('created_at', sa.DateTime, nullable=True)
+    )
+    op.create_table(
+        'warning_tallies',
+        sa.Column('server_id', sa.BigInteger, primary_key=True, autoincrement=False),
+        sa.Column('user_id', sa.BigInteger, primary_key=True, autoincrement=False),
+        sa.Column('bucket', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('count', sa.Integer, nullable=False, default=0)
+    )
+
+
+def downgrade():
+    op.drop_table('warning_tallies')
+    op.drop_column('warnings', 'created_at')
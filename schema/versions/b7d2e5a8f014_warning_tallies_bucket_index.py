@@ -0,0 +1,25 @@
+"""Index warning tally buckets
+
+Revision ID: b7d2e5a8f014
+Revises: e4f9a1c2b7d3
+Create Date: 2026-10-18 20:05:13.662940
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d2e5a8f014'
+down_revision = 'e4f9a1c2b7d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the startup load and the pruning both select by bucket alone
+    op.create_index('ix_warning_tallies_bucket', 'warning_tallies', ['bucket'])
+
+
+def downgrade():
+    op.drop_index('ix_warning_tallies_bucket', table_name='warning_tallies')
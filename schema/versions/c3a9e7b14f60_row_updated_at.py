@@ -0,0 +1,42 @@
+"""Track when settings rows last changed
+
+Revision ID: c3a9e7b14f60
+Revises: 8f4b2d61c0e5
+Create Date: 2026-10-18 13:05:27.940211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3a9e7b14f60'
+down_revision = '8f4b2d61c0e5'
+branch_labels = None
+depends_on = None
+
+TABLES = ('channels', 'roles', 'servers', 'users')
+
+
+def _column():
+    if op.get_bind().dialect.name == 'mysql':
+        # kept current by the server, so rows the config UIs write directly
+        # are caught up on too; TIMESTAMP is stored in UTC whatever time zone
+        # the writer's session uses
+        return sa.Column(
+            'updated_at', sa.TIMESTAMP, nullable=False,
+            server_default=sa.text('CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP')
+        )
+    return sa.Column('updated_at', sa.DateTime, nullable=False, server_default=sa.func.now())
+
+
+def upgrade():
+    for table in TABLES:
+        op.add_column(table, _column())
+        op.create_index(f'ix_{table}_updated_at', table, ['updated_at'])
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_index(f'ix_{table}_updated_at', table_name=table)
+        op.drop_column(table, 'updated_at')
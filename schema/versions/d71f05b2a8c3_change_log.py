@@ -0,0 +1,32 @@
+"""Change log for versioned settings sync
+
+Revision ID: d71f05b2a8c3
+Revises: c3a9e7b14f60
+Create Date: 2026-10-18 15:42:10.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd71f05b2a8c3'
+down_revision = 'c3a9e7b14f60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'change_log',
+        sa.Column('seq', sa.BigInteger().with_variant(sa.Integer, 'sqlite'), primary_key=True, autoincrement=True),
+        sa.Column('table_name', sa.String(16), nullable=False),
+        sa.Column('row_id', sa.BigInteger, nullable=False),
+        sa.Column('deleted', sa.Boolean, nullable=False, server_default=sa.false()),
+        sa.Column('state', sa.JSON),
+        sa.Column('changed_at', sa.DateTime, nullable=False, server_default=sa.func.now()),
+    )
+
+
+def downgrade():
+    op.drop_table('change_log')
@@ -0,0 +1,75 @@
+"""Log settings changes with triggers, whoever writes them
+
+Revision ID: e4f9a1c2b7d3
+Revises: d71f05b2a8c3
+Create Date: 2026-10-18 19:20:41.507136
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4f9a1c2b7d3'
+down_revision = 'd71f05b2a8c3'
+branch_labels = None
+depends_on = None
+
+# the synced columns of each table, as of this revision
+TABLES = {
+    'channels': (('prefix', 'string'), ('muted', 'boolean'), ('voiced', 'boolean'), ('jsondata', 'json')),
+    'roles': (('voiced', 'boolean'), ('muted', 'boolean'), ('moderator', 'boolean'), ('jsondata', 'json')),
+    'servers': (('prefix', 'string'), ('muted', 'boolean'), ('jsondata', 'json')),
+    'users': (('voiced', 'boolean'), ('muted', 'boolean'), ('moderator', 'boolean'), ('jsondata', 'json')),
+}
+
+
+def _value(column, kind, mysql):
+    ref = f'NEW.{column}'
+    if kind == 'boolean':
+        if mysql:
+            return f"IF({ref}, CAST('true' AS JSON), CAST('false' AS JSON))"
+        return f"json(CASE WHEN {ref} THEN 'true' ELSE 'false' END)"
+    if kind == 'json' and not mysql:
+        return f'json({ref})'
+    return ref
+
+
+def _triggers(table, columns, mysql):
+    state = '{}({})'.format(
+        'JSON_OBJECT' if mysql else 'json_object',
+        ', '.join(f"'{column}', {_value(column, kind, mysql)}" for column, kind in columns)
+    )
+    logged = f"INSERT INTO change_log (table_name, row_id, deleted, state, changed_at) VALUES ('{table}', {{row}}.id, {{deleted}}, {{state}}, CURRENT_TIMESTAMP)"
+    insert_row = logged.format(row='NEW', deleted='FALSE' if mysql else 0, state=state)
+    delete_row = logged.format(row='OLD', deleted='TRUE' if mysql else 1, state='NULL')
+    names = [column for column, _ in columns]
+
+    if mysql:
+        unchanged = ' AND '.join(f'OLD.{column} <=> NEW.{column}' for column in names)
+        return [
+            f'CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} FOR EACH ROW {insert_row}',
+            f'CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} FOR EACH ROW BEGIN IF NOT ({unchanged}) THEN {insert_row}; END IF; END',
+            f'CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} FOR EACH ROW {delete_row}',
+        ]
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in names)
+    return [
+        f'CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} BEGIN {insert_row}; END',
+        f'CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} WHEN {changed} BEGIN {insert_row}; END',
+        f'CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} BEGIN {delete_row}; END',
+    ]
+
+
+def upgrade():
+    op.create_index('ix_change_log_row', 'change_log', ['table_name', 'row_id', 'seq'])
+    mysql = op.get_bind().dialect.name == 'mysql'
+    for table, columns in TABLES.items():
+        for statement in _triggers(table, columns, mysql):
+            op.execute(statement)
+
+
+def downgrade():
+    for table in TABLES:
+        for action in ('insert', 'update', 'delete'):
+            op.execute(f'DROP TRIGGER IF EXISTS {table}_log_{action}')
+    op.drop_index('ix_change_log_row', table_name='change_log')
@@ -0,0 +1,291 @@
+"""
+Automod content filter
+
+Rules live in each server's settings under `automod`:
+
+    {"enabled": true, "rules": [
+        {"id": "slurs", "type": "words", "patterns": ["foo", "bar"]},
+        {"id": "invites", "type": "invites", "action": "delete"},
+        {"id": "links", "type": "regex", "patterns": ["https?://\\\\S+\\\\.ru\\\\b"]}
+    ]}
+
+A guild's rules are compiled once into a single Aho-Corasick automaton for
+every literal word (case-insensitive, whole words unless `"whole_word":
+false`) plus one alternation regex for every pattern, so a message is
+scanned twice no matter how many rules there are.  Patterns using
+backreferences cannot be renumbered into the alternation and are checked on
+their own.
+
+The automaton and regex are cached by their inputs, so editing only the
+regex rules does not rebuild the word automaton and guilds with identical
+lists share one.  Alternation matches never overlap, so after a hit the
+text is scanned again with only the rules that have not matched yet; a
+message breaking one regex rule costs two passes, not one per rule.
+Compiled rules are dropped when the guild's settings change locally or over
+MQTT, and rebuilt on the next message.  Malformed rules and patterns are
+logged and skipped, the rest of the guild's rules still apply.
+
+`action` is `warn` (default), `delete` (delete and warn) or `log` (count only);
+a message breaking several rules gets the strongest of their actions.
+"""
+import logging, re, time
+from collections import Counter, deque
+from functools import lru_cache
+from metrics import observe, register_gauge
+from settings_store import SETTINGS
+
+INVITE_PATTERN = r'(?:https?://)?(?:www\.)?(?:discord(?:app)?\.com/invite|discord\.gg)/[\w-]+'
+# weakest first
+ACTIONS = ('log', 'warn', 'delete')
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+
+
+class Automaton:
+    """
+    Aho-Corasick over lowercased text.  `words` maps each word to the
+    (rule id, whole word) pairs it belongs to.
+    """
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for word, owners in words.items():
+            state = 0
+            for char in word:
+                nxt = self.goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][char] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = nxt
+            self.out[state] = tuple((len(word), rule, whole) for rule, whole in owners)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, nxt in self.goto[state].items():
+                queue.append(nxt)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def __len__(self):
+        return len(self.goto)
+
+    def search(self, text):
+        """
+        rule ids with a match in `text`, which must already be lowercased
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set()
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, rule, whole in out[state]:
+                if rule in found:
+                    continue
+                if whole and not _bounded(text, end - length, end):
+                    continue
+                found.add(rule)
+        return found
+
+def _word_char(char):
+    return char.isalnum() or char == '_'
+
+def _bounded(text, start, end):
+    return (start == 0 or not _word_char(text[start - 1])) and (end == len(text) or not _word_char(text[end]))
+
+
+@lru_cache(maxsize=256)
+def _automaton(literals):
+    words = {}
+    for word, rule, whole in literals:
+        words.setdefault(word, []).append((rule, whole))
+    return Automaton(words) if words else None
+
+@lru_cache(maxsize=256)
+def _combined(patterns):
+    if not patterns:
+        return None, ()
+    groups = {f'r{n}': rule for n, (rule, _) in enumerate(patterns)}
+    regex = re.compile('|'.join(f'(?P<r{n}>{pattern})' for n, (_, pattern) in enumerate(patterns)), re.IGNORECASE)
+    return regex, groups
+
+@lru_cache(maxsize=1024)
+def _single(pattern):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+class CompiledRules:
+    """
+    everything needed to scan a message for one guild
+    """
+    def __init__(self, literals=(), patterns=(), separate=(), actions=None):
+        self.automaton = _automaton(literals)
+        try:
+            _combined(patterns)
+            self.patterns = patterns
+        except re.error:
+            # e.g. inline flags that are only valid at the start of a pattern
+            self.patterns = ()
+            separate = tuple(patterns) + tuple(separate)
+        self.separate = tuple((rule, _single(pattern)) for rule, pattern in separate)
+        self.actions = actions or {}
+
+    def __bool__(self):
+        return bool(self.actions)
+
+    def scan(self, text):
+        found = set()
+        if self.automaton is not None:
+            found |= self.automaton.search(text.lower())
+        patterns = self.patterns
+        while patterns:
+            regex, groups = _combined(patterns)
+            hits = {groups[match.lastgroup] for match in regex.finditer(text)}
+            if not hits:
+                break
+            found |= hits
+            # a match hides anything overlapping it, look again for the other rules
+            patterns = tuple(item for item in patterns if item[0] not in found)
+        for rule, regex in self.separate:
+            if rule not in found and regex.search(text):
+                found.add(rule)
+        return found
+
+def _valid(pattern):
+    try:
+        _single(pattern)
+        return True
+    except re.error as err:
+        logging.warning(f'Skipping invalid automod pattern `{pattern}`: {err}')
+        return False
+
+def _patterns(rule, rule_id):
+    patterns = rule.get('patterns', ())
+    if not isinstance(patterns, (list, tuple)):
+        logging.warning(f'Skipping patterns of automod rule `{rule_id}`: expected a list')
+        return []
+    valid = []
+    for pattern in patterns:
+        if isinstance(pattern, str):
+            valid.append(pattern)
+        else:
+            logging.warning(f'Skipping automod pattern of rule `{rule_id}`: {pattern!r:.50} is not a string')
+    return valid
+
+def compile_rules(config):
+    """
+    `config` is a server's `automod` setting
+    """
+    if not isinstance(config, dict) or not config.get('enabled', True):
+        return CompiledRules()
+
+    rules = config.get('rules', ())
+    if not isinstance(rules, (list, tuple)):
+        logging.warning('Skipping automod rules: expected a list')
+        rules = ()
+
+    literals, patterns, separate, actions = set(), [], [], {}
+    for n, rule in enumerate(rules):
+        if not isinstance(rule, dict):
+            logging.warning(f'Skipping automod rule {n}: {rule!r:.50} is not an object')
+            continue
+        rule_id = str(rule.get('id', n))
+        kind = rule.get('type', 'words')
+        action = rule.get('action', 'warn')
+        if action not in ACTIONS:
+            logging.warning(f'Skipping automod rule `{rule_id}`: unknown action `{action}`')
+            continue
+
+        if kind == 'words':
+            whole = bool(rule.get('whole_word', True))
+            literals.update((word.lower(), rule_id, whole) for word in _patterns(rule, rule_id) if word)
+        elif kind == 'invites':
+            patterns.append((rule_id, INVITE_PATTERN))
+        elif kind == 'regex':
+            for pattern in filter(_valid, _patterns(rule, rule_id)):
+                (separate if BACKREFERENCE.search(pattern) else patterns).append((rule_id, pattern))
+        else:
+            logging.warning(f'Skipping automod rule `{rule_id}`: unknown type `{kind}`')
+            continue
+        actions[rule_id] = action
+
+    return CompiledRules(tuple(sorted(literals)), tuple(patterns), tuple(separate), actions)
+
+
+def strongest(hits):
+    """
+    the action to take for a `check()` result, None when nothing matched
+    """
+    return max(hits.values(), key=ACTIONS.index, default=None)
+
+
+class FilterEngine:
+    def __init__(self, settings):
+        self.settings = settings
+        self.compiled = {}
+        self.generation = Counter()
+        self.hits = Counter()
+        self.cost = Counter()
+        self.scans = 0
+        self.builds = 0
+        settings.watch(self._changed)
+
+    def _changed(self, table, id):
+        if table == 'servers':
+            self.compiled.pop(id, None)
+            self.generation[id] += 1
+
+    async def rules_for(self, guild_id):
+        compiled = self.compiled.get(guild_id)
+        if compiled is not None:
+            return compiled
+
+        generation = self.generation[guild_id]
+        config = await self.settings.get('servers', guild_id, 'automod')
+        compiled = compile_rules(config)
+        self.builds += 1
+        # settings changed while loading, the next message rebuilds
+        if self.generation[guild_id] == generation:
+            self.compiled[guild_id] = compiled
+        return compiled
+
+    async def check(self, guild_id, text):
+        """
+        `{rule id: action}` for every rule `text` breaks
+        """
+        compiled = await self.rules_for(guild_id)
+        if not compiled or not text:
+            return {}
+
+        start = time.perf_counter()
+        found = compiled.scan(text)
+        took = time.perf_counter() - start
+        observe('automod.scan', took)
+        self.scans += 1
+        self.cost[guild_id] += took
+        for rule in found:
+            self.hits[(guild_id, rule)] += 1
+        return {rule: compiled.actions[rule] for rule in found}
+
+    def stats(self):
+        return {
+            'guilds': len(self.compiled),
+            'builds': self.builds,
+            'scans': self.scans,
+            'hits': {f'{guild}/{rule}': count for (guild, rule), count in self.hits.most_common(20)},
+            'cost_ms': {str(guild): round(took * 1000, 3) for guild, took in self.cost.most_common(10)},
+        }
+
+
+AUTOMOD = FilterEngine(SETTINGS)
+SETTINGS.define('servers', 'automod', dict, {})
+register_gauge('automod', AUTOMOD.stats)
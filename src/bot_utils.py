@@ -1,9 +1,17 @@
-import os, sys, logging
-from configuration import ADMINS, PREFIXES, PREFIX
+import os, logging, time
+from configuration import ADMINS, PREFIX
 from discord.ext import commands
 from pathlib import Path
-from db import Session, bot_session, Servers, Channels, Users, Roles
+from db import AsyncSession, Servers, Channels, Users, Roles
 from functools import wraps
+from sqlalchemy import or_
+from sqlalchemy.exc import SQLAlchemyError
+from permissions import load_live_permissions, is_moderator
+from prefixes import PREFIX_CACHE, PrefixResolver
+from gate import allow_message
+from metrics import observe, increment
+from outbox import OUTBOX
+from member_index import role_ids_of, resolve_role_ids
 
 """
 Core utlities
@@ -16,48 +24,108 @@ def load_extension_directory(bot, ext):
             continue
         bot.load_extension('{}.{}'.format(ext, Path(f).stem))
 
-def load_prefixes():
-    global PREFIXES
-    PREFIXES.clear()
-    prefix_list = Servers.prefixed(bot_session)
-    if prefix_list:
-        for server in prefix_list:
-            print('prefix {} => {}'.format(server.id, server.prefix))
-            PREFIXES[server.id] = server.prefix
+def _overrides(session, model, ids):
+    return session.query(model.id, model.prefix).filter(
+        model.id.in_(ids), model.prefix.isnot(None)
+    ).all()
 
-    prefix_list = Channels.prefixed(bot_session)
-    if prefix_list:
-        for channel in prefix_list:
-            print('prefix {} => {}'.format(channel.id, channel.prefix))
-            PREFIXES[channel.id] = channel.prefix
-
-    print('Preloaded prefixes:\n{}'.format(PREFIXES))
-
-def prefix_operator(bot, message):
-    channel_id = message.channel.id
-    server_id = message.guild.id
-    return PREFIXES.get(channel_id, PREFIXES.get(server_id, PREFIX))
+async def fetch_prefixes(channel_ids, server_ids):
+    """
+    prefix overrides for the given ids, one query per table
+    """
+    found = {}
+    async with AsyncSession() as db:
+        if channel_ids:
+            found.update(await db.run(_overrides, Channels, channel_ids))
+        if server_ids:
+            found.update(await db.run(_overrides, Servers, server_ids))
+    return found
+
+PREFIX_RESOLVER = PrefixResolver(PREFIX_CACHE, fetch_prefixes)
+
+PERMISSION_TABLES = (
+    ('users', Users),
+    ('roles', Roles),
+    ('channels', Channels),
+    ('servers', Servers),
+)
+
+def _flagged(session, model):
+    flags = [getattr(model, c) for c in ('moderator', 'muted', 'voiced') if hasattr(model, c)]
+    return session.query(model).filter(or_(*flags)).all()
+
+async def load_permissions():
+    async with AsyncSession() as db:
+        for table, model in PERMISSION_TABLES:
+            records = await db.run(_flagged, model)
+            load_live_permissions(table, records)
+            logging.info('Preloaded permissions: {} {}'.format(len(records), table))
+
+async def prefix_operator(bot, message):
+    # direct messages have no guild, only the channel override applies
+    server_id = message.guild.id if message.guild is not None else None
+    prefix = await PREFIX_RESOLVER.resolve(message.channel.id, server_id)
+    return prefix if prefix is not None else PREFIX
+
+class GatedBotMixin:
+    """
+    drops muted traffic before any prefix or command parsing happens,
+    and times every command invocation
+    """
+    async def process_commands(self, message):
+        if not allow_message(message):
+            return
+        await super().process_commands(message)
+
+    async def invoke(self, ctx):
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        name = ctx.command.qualified_name
+        start = time.perf_counter()
+        try:
+            return await super().invoke(ctx)
+        finally:
+            observe(f'command.{name}', time.perf_counter() - start)
+            increment(f'command.{name}')
+
+class RRBot(GatedBotMixin, commands.Bot):
+    pass
+
+class ShardedRRBot(GatedBotMixin, commands.AutoShardedBot):
+    pass
+
+def shard_arguments(argv):
+    """
+    `--shards 0-3 --shard-count 16` => ([0, 1, 2, 3], 16); (None, None) when not sharded
+    """
+    if '--shards' not in argv:
+        return None, None
+    first, _, last = argv[argv.index('--shards') + 1].partition('-')
+    shard_ids = list(range(int(first), int(last or first) + 1))
+    shard_count = int(argv[argv.index('--shard-count') + 1])
+    return shard_ids, shard_count
 
 """
 Auxiliary utiltizes
 """
 
-def _is_server_moderator(d_user):
+def _is_server_moderator(d_user, guild_id=None):
     user_id = d_user.id
 
     if _is_bot_admin(user_id):
         return True
 
-    user = bot_session.query(Users).filter(Users.id == user_id).first()
-    if user is not None and user.moderator:
-        return True
-
-    for urole in d_user.roles:
-        modrole = bot_session.query(Roles).filter(Roles.id == urole.id).first()
-        if modrole is not None and modrole.moderator:
-            return True
+    return is_moderator(user_id, role_ids_of(d_user, guild_id))
 
-    return False
+async def is_server_moderator(d_user, guild):
+    """
+    `_is_server_moderator` that fetches the roles of users missing from the
+    member index (low memory mode)
+    """
+    if _is_bot_admin(d_user.id):
+        return True
+    return is_moderator(d_user.id, await resolve_role_ids(d_user, guild))
 
 def _is_bot_admin(user_id):
     return user_id in ADMINS
@@ -71,12 +139,12 @@ def is_bot_admin():
     return commands.check(predicate)
 
 def _db_session(ctx):
-    ctx.db = Session()
+    ctx.db = AsyncSession()
 
-def cmd_db_wrapper(fn):
+def cmd_db_wrapper(db_errors_silent):
     def _cmd_db_wrapper(fn):
         """
-        wrapper to inject a command context with a database session
+        wrapper to inject a command context with an awaitable database session
         """
         @wraps(fn)
         async def predicate(ctx, *args, **kwargs):
@@ -84,17 +152,18 @@ def cmd_db_wrapper(fn):
                 _db_session(ctx)
                 return await fn(ctx, *args, **kwargs)
             except SQLAlchemyError:
+                await ctx.db.rollback()
                 if db_errors_silent == False:
-                    await ctx.send('DB Error.')
+                    await OUTBOX.send(ctx.channel, 'DB Error.')
             finally:
-                ctx.db.close()
+                await ctx.db.close()
         return predicate
     return _cmd_db_wrapper
 
-def cog_db_wrapper(fn):
+def cog_db_wrapper(db_errors_silent):
     def _cog_db_wrapper(fn):
         """
-        wrapper to inject a cog command context with a database session
+        wrapper to inject a cog command context with an awaitable database session
         """
         @wraps(fn)
         async def predicate(self, ctx, *args, **kwargs):
@@ -102,10 +171,11 @@ def cog_db_wrapper(fn):
                 _db_session(ctx)
                 return await fn(self, ctx, *args, **kwargs)
             except SQLAlchemyError:
+                await ctx.db.rollback()
                 if db_errors_silent == False:
-                    await ctx.send('DB Error.')
+                    await OUTBOX.send(ctx.channel, 'DB Error.')
             finally:
-                ctx.db.close()
+                await ctx.db.close()
         return predicate
     return _cog_db_wrapper
 
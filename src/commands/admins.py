@@ -1,5 +1,9 @@
-import logging
+import json, logging
 from discord.ext import commands
+from metrics import snapshot
+from infractions import WARNING_QUEUE
+from settings_store import SETTINGS
+from outbox import OUTBOX
 from bot_utils import _is_bot_admin, db_session
 from db import ensure_server, ensure_channel
 
@@ -14,32 +18,41 @@ class AdminCog(commands.Cog, name='Bot Administrator Commands'):
         This checks to ensure only listed administrators can execute the commands in this cog.
         """
         id = ctx.message.author.id
-        logging.info('Administrator check: {}'.format(id))
-        logging.info(ctx.message.content)
+        logging.debug('Administrator check: {} for `{}`'.format(id, ctx.command))
         return _is_bot_admin(id)
 
     @commands.command()
     async def shutdown(self, ctx):
-        await ctx.send('Goodbye')
+        await WARNING_QUEUE.flush()
+        await SETTINGS.flush()
+        await OUTBOX.send(ctx.channel, 'Goodbye')
         await ctx.bot.logout()
 
+    @commands.command()
+    async def metrics(self, ctx):
+        dump = json.dumps(snapshot(), indent=1, default=str)
+        # stay under discord's 2000 character message limit
+        if len(dump) > 1900:
+            dump = dump[:1900] + '\n...'
+        await OUTBOX.send(ctx.channel, '```json\n{}\n```'.format(dump))
+
     @commands.command(aliases=['sprefix'])
     @db_session(cog=True)
     async def prefix(self, ctx, prefix):
-        server = ensure_server(ctx.db, ctx.guild.id)
+        server = await ensure_server(ctx.db, ctx.guild.id)
         server.prefix = prefix
         ctx.db.add(server)
-        ctx.db.commit()
-        await ctx.send('Server prefix is now {}'.format(prefix))
+        await ctx.db.commit()
+        await OUTBOX.send(ctx.channel, 'Server prefix is now {}'.format(prefix))
 
     @commands.command()
     @db_session(cog=True)
     async def cprefix(self, ctx, prefix):
-        channel = ensure_channel(ctx.db, ctx.channel.id)
+        channel = await ensure_channel(ctx.db, ctx.channel.id)
         channel.prefix = prefix
         ctx.db.add(channel)
-        ctx.db.commit()
-        await ctx.send('{} prefix is now {}'.format(ctx.channel.mention, prefix))
+        await ctx.db.commit()
+        await OUTBOX.send(ctx.channel, '{} prefix is now {}'.format(ctx.channel.mention, prefix))
 
 def setup(bot):
     bot.add_cog(AdminCog(bot))
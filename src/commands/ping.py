@@ -1,11 +1,12 @@
 from discord.ext import commands
 import logging
+from outbox import OUTBOX
 
 logging.info('Loading `ping`')
 
 @commands.command()
 async def ping(ctx):
-    await ctx.send('Pong!')
+    await OUTBOX.send(ctx.channel, 'Pong!')
 
 def setup(bot):
     bot.add_command(ping)
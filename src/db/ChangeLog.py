@@ -0,0 +1,166 @@
+from datetime import datetime
+from sqlalchemy import Column, Integer, BigInteger, String, Boolean, JSON, DateTime, Index, event, func, inspect, select
+from sqlalchemy.orm import object_session, Session as OrmSession
+from . import Base
+from .Channels import Channels
+from .Roles import Roles
+from .Servers import Servers
+from .Users import Users
+
+class ChangeLog(Base):
+    """
+    One row per change to a servers/channels/roles/users row, written in the
+    same transaction by database triggers (see `trigger_ddl`).  `seq` is the sync version; `state` is the row as it
+    was after the change (NULL when deleted), so replaying the log from any
+    version needs nothing else.
+    """
+    __tablename__ = 'change_log'
+    # finding the entries a transaction just wrote, see `_logged`
+    __table_args__ = (Index('ix_change_log_row', 'table_name', 'row_id', 'seq'),)
+    # sqlite only autoincrements a plain INTEGER primary key
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key = True, autoincrement=True)
+    table_name = Column(String(16), nullable=False)
+    row_id = Column(BigInteger, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    state = Column(JSON)
+    changed_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def as_change(self):
+        return {
+            'seq': self.seq,
+            'table': self.table_name,
+            'id': self.row_id,
+            'deleted': self.deleted,
+            'state': self.state,
+        }
+
+SYNCED = (Channels, Roles, Servers, Users)
+SKIPPED = ('id', 'updated_at')
+
+def state_columns(model):
+    """
+    the columns a row's synced state is made of
+    """
+    return [column for column in inspect(model).columns if column.key not in SKIPPED]
+
+def row_state(record):
+    """
+    the synced columns of a row, as JSON-friendly values
+    """
+    return {column.key: getattr(record, column.key) for column in state_columns(type(record))}
+
+def _json_value(column, dialect):
+    """
+    SQL for a column of the changed row inside the trigger's JSON object,
+    typed the way `row_state` would serialise it
+    """
+    ref = f'NEW.{column.name}'
+    if isinstance(column.type, Boolean):
+        if dialect == 'mysql':
+            return f"IF({ref}, CAST('true' AS JSON), CAST('false' AS JSON))"
+        return f"json(CASE WHEN {ref} THEN 'true' ELSE 'false' END)"
+    if isinstance(column.type, JSON) and dialect == 'sqlite':
+        return f'json({ref})'
+    return ref
+
+def trigger_ddl(model, dialect):
+    """
+    triggers that log every change to `model`'s table, whoever writes it:
+    the bot's ORM, bulk Core inserts, or the config UIs writing straight to
+    the database.  Updates that leave the state columns alone are not logged.
+    """
+    table = model.__tablename__
+    columns = [column.name for column in state_columns(model)]
+    json_object = 'JSON_OBJECT' if dialect == 'mysql' else 'json_object'
+    state = '{}({})'.format(json_object, ', '.join(f"'{column.name}', {_json_value(column, dialect)}" for column in state_columns(model)))
+    logged = f"INSERT INTO change_log (table_name, row_id, deleted, state, changed_at) VALUES ('{table}', {{row}}.id, {{deleted}}, {{state}}, CURRENT_TIMESTAMP)"
+    insert_row = logged.format(row='NEW', deleted='FALSE' if dialect == 'mysql' else 0, state=state)
+    delete_row = logged.format(row='OLD', deleted='TRUE' if dialect == 'mysql' else 1, state='NULL')
+
+    if dialect == 'mysql':
+        unchanged = ' AND '.join(f'OLD.{column} <=> NEW.{column}' for column in columns)
+        return [
+            f'CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} FOR EACH ROW {insert_row}',
+            f'CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} FOR EACH ROW BEGIN IF NOT ({unchanged}) THEN {insert_row}; END IF; END',
+            f'CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} FOR EACH ROW {delete_row}',
+        ]
+    changed = ' OR '.join(f'OLD.{column} IS NOT NEW.{column}' for column in columns)
+    return [
+        f'CREATE TRIGGER {table}_log_insert AFTER INSERT ON {table} BEGIN {insert_row}; END',
+        f'CREATE TRIGGER {table}_log_update AFTER UPDATE ON {table} WHEN {changed} BEGIN {insert_row}; END',
+        f'CREATE TRIGGER {table}_log_delete AFTER DELETE ON {table} BEGIN {delete_row}; END',
+    ]
+
+def _create_triggers(model):
+    def create(target, connection, **kw):
+        dialect = connection.dialect.name
+        if dialect not in ('mysql', 'sqlite'):
+            return
+        for statement in trigger_ddl(model, dialect):
+            connection.exec_driver_sql(statement)
+    return create
+
+def _changed(record):
+    attrs = inspect(record).attrs
+    return any(attrs[key].history.has_changes() for key in row_state(record))
+
+def touched(session, table, ids):
+    """
+    note rows written in this transaction; their change_log entries are read
+    back before the commit and broadcast once it succeeds
+    """
+    session.info.setdefault('sync_touched', {}).setdefault(table, set()).update(ids)
+
+def _touch(target):
+    session = object_session(target)
+    if session is not None:
+        touched(session, target.__tablename__, [target.id])
+
+def _after_insert(mapper, connection, target):
+    _touch(target)
+
+def _after_update(mapper, connection, target):
+    # also called for rows that were only marked dirty
+    if _changed(target):
+        _touch(target)
+
+def _after_delete(mapper, connection, target):
+    _touch(target)
+
+def _logged(session, table, ids):
+    # the newest entry per row; rows written in this transaction are locked,
+    # so that is the one our trigger just wrote
+    newest = (
+        select(func.max(ChangeLog.seq))
+        .where(ChangeLog.table_name == table, ChangeLog.row_id.in_(ids))
+        .group_by(ChangeLog.row_id)
+    )
+    return session.connection().execute(select(ChangeLog).where(ChangeLog.seq.in_(newest))).all()
+
+@event.listens_for(OrmSession, 'before_commit')
+def _collect(session):
+    # pending objects flush after this hook, flush them first so they count
+    session.flush()
+    touched = session.info.pop('sync_touched', None)
+    if not touched:
+        return
+    changes = session.info.setdefault('sync_changes', [])
+    for table, ids in touched.items():
+        for row in _logged(session, table, list(ids)):
+            changes.append({
+                'seq': row.seq,
+                'table': row.table_name,
+                'id': row.row_id,
+                'deleted': row.deleted,
+                'state': row.state,
+            })
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _forget(session):
+    session.info.pop('sync_touched', None)
+
+for model in SYNCED:
+    event.listen(model, 'after_insert', _after_insert)
+    event.listen(model, 'after_update', _after_update)
+    event.listen(model, 'after_delete', _after_delete)
+    event.listen(model.__table__, 'after_create', _create_triggers(model))
@@ -1,6 +1,8 @@
-from sqlalchemy import Column, Boolean, BigInteger, String, JSON, event
-from . import Base, prefixed
-from configuration import update_live_prefix
+from datetime import datetime
+from sqlalchemy import Column, Boolean, BigInteger, String, JSON, DateTime, event
+from . import Base, prefixed, on_loop
+from prefixes import update_live_prefix
+from permissions import set_live_flags, flags_of, remove_live_permissions
 
 @prefixed
 class Channels(Base):
@@ -24,11 +26,22 @@ class Channels(Base):
     # Storing Ad-hoc data made easy
     jsondata = Column(JSON)
 
+    # last change (UTC), lets a warm start catch up on what it missed; on
+    # MySQL the server keeps it current for writes from outside the bot too
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
 
 @event.listens_for(Channels, 'after_update')
 def receive_after_update(mapper, connection, channel):
-    update_live_prefix(channel.id, channel.prefix)
+    on_loop(update_live_prefix, channel.id, channel.prefix)
+    on_loop(set_live_flags, 'channels', channel.id, flags_of(channel))
 
 @event.listens_for(Channels, 'after_insert')
 def receive_after_insert(mapper, connection, channel):
-    update_live_prefix(channel.id, channel.prefix)
+    on_loop(update_live_prefix, channel.id, channel.prefix)
+    on_loop(set_live_flags, 'channels', channel.id, flags_of(channel))
+
+@event.listens_for(Channels, 'after_delete')
+def receive_after_delete(mapper, connection, channel):
+    on_loop(update_live_prefix, channel.id, None)
+    on_loop(remove_live_permissions, 'channels', channel.id)
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Boolean, BigInteger, String, JSON
-from . import Base
+from datetime import datetime
+from sqlalchemy import Column, Boolean, BigInteger, String, JSON, DateTime, event
+from . import Base, on_loop
+from permissions import set_live_flags, flags_of, remove_live_permissions
 
 class Roles(Base):
     __tablename__ = 'roles'
@@ -19,3 +21,20 @@ class Roles(Base):
 
     # Storing Ad-hoc data made easy
     jsondata = Column(JSON)
+
+    # last change (UTC), lets a warm start catch up on what it missed; on
+    # MySQL the server keeps it current for writes from outside the bot too
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+
+@event.listens_for(Roles, 'after_update')
+def receive_after_update(mapper, connection, role):
+    on_loop(set_live_flags, 'roles', role.id, flags_of(role))
+
+@event.listens_for(Roles, 'after_insert')
+def receive_after_insert(mapper, connection, role):
+    on_loop(set_live_flags, 'roles', role.id, flags_of(role))
+
+@event.listens_for(Roles, 'after_delete')
+def receive_after_delete(mapper, connection, role):
+    on_loop(remove_live_permissions, 'roles', role.id)
@@ -1,6 +1,8 @@
-from sqlalchemy import Column, Boolean, BigInteger, String, JSON, event
-from . import Base, prefixed
-from configuration import update_live_prefix
+from datetime import datetime
+from sqlalchemy import Column, Boolean, BigInteger, String, JSON, DateTime, event
+from . import Base, prefixed, on_loop
+from prefixes import update_live_prefix
+from permissions import set_live_flags, flags_of, remove_live_permissions
 
 @prefixed
 class Servers(Base):
@@ -19,11 +21,22 @@ class Servers(Base):
     # Storing Ad-hoc data made easy
     jsondata = Column(JSON)
 
+    # last change (UTC), lets a warm start catch up on what it missed; on
+    # MySQL the server keeps it current for writes from outside the bot too
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
 
 @event.listens_for(Servers, 'after_update')
 def receive_after_update(mapper, connection, server):
-    update_live_prefix(server.id, server.prefix)
+    on_loop(update_live_prefix, server.id, server.prefix)
+    on_loop(set_live_flags, 'servers', server.id, flags_of(server))
 
 @event.listens_for(Servers, 'after_insert')
 def receive_after_insert(mapper, connection, server):
-    update_live_prefix(server.id, server.prefix)
+    on_loop(update_live_prefix, server.id, server.prefix)
+    on_loop(set_live_flags, 'servers', server.id, flags_of(server))
+
+@event.listens_for(Servers, 'after_delete')
+def receive_after_delete(mapper, connection, server):
+    on_loop(update_live_prefix, server.id, None)
+    on_loop(remove_live_permissions, 'servers', server.id)
@@ -1,5 +1,7 @@
-from sqlalchemy import Column, Boolean, BigInteger, String, JSON
-from . import Base
+from datetime import datetime
+from sqlalchemy import Column, Boolean, BigInteger, String, JSON, DateTime, event
+from . import Base, on_loop
+from permissions import set_live_flags, flags_of, remove_live_permissions
 
 class Users(Base):
     __tablename__ = 'users'
@@ -19,3 +21,20 @@ class Users(Base):
 
     # Storing Ad-hoc data made easy
     jsondata = Column(JSON)
+
+    # last change (UTC), lets a warm start catch up on what it missed; on
+    # MySQL the server keeps it current for writes from outside the bot too
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+
+
+@event.listens_for(Users, 'after_update')
+def receive_after_update(mapper, connection, user):
+    on_loop(set_live_flags, 'users', user.id, flags_of(user))
+
+@event.listens_for(Users, 'after_insert')
+def receive_after_insert(mapper, connection, user):
+    on_loop(set_live_flags, 'users', user.id, flags_of(user))
+
+@event.listens_for(Users, 'after_delete')
+def receive_after_delete(mapper, connection, user):
+    on_loop(remove_live_permissions, 'users', user.id)
@@ -0,0 +1,17 @@
+from sqlalchemy import Column, Integer, BigInteger
+from . import Base
+
+class WarningTallies(Base):
+    """
+    number of warnings per user, server and hour; maintained alongside
+    every insert into `warnings` so thresholds never need a COUNT(*)
+    """
+    __tablename__ = 'warning_tallies'
+    server_id = Column(BigInteger, primary_key = True, autoincrement=False)
+    user_id = Column(BigInteger, primary_key = True, autoincrement=False)
+
+    # hours since the unix epoch; indexed on its own for the startup load
+    # and the pruning of buckets outside the window
+    bucket = Column(Integer, primary_key = True, autoincrement=False, index=True)
+
+    count = Column(Integer, nullable=False, default=0)
@@ -1,9 +1,14 @@
-from sqlalchemy import Column, BigInteger, Boolean, Text
+from datetime import datetime
+from sqlalchemy import Column, Integer, BigInteger, Boolean, Text, DateTime, Index
 from . import Base
 
 class Warnings(Base):
     __tablename__ = 'warnings'
-    id = Column(BigInteger, primary_key = True)
+    __table_args__ = (
+        # history lookups are always "this user on this server, newest first"
+        Index('ix_warnings_server_user_id', 'server_id', 'user_id', 'id'),
+    )
+    id = Column(Integer, primary_key = True)
 
     # the moderator who performed the warning
     # will be the bot's id if an automated warning
@@ -14,10 +19,10 @@ class Warnings(Base):
     user_id = Column(BigInteger, nullable=False, index=True)
 
     # which server the warning was associated with
-    server_id = Column(BigInteger, nullable=False, index=True)
+    server_id = Column(BigInteger, nullable=False)
 
-    # which chanenl, if any, the warning was associated with
-    server_id = Column(BigInteger, nullable=True, index=True)
+    # which channel, if any, the warning was associated with
+    channel_id = Column(BigInteger, nullable=True, index=True)
 
     # the text of the warning that provides context
     context = Column(Text, default='')
@@ -27,3 +32,7 @@ class Warnings(Base):
 
     # was this warning accompanied by a ban?
     banned = Column(Boolean, nullable=False, default=False)
+
+    # when the warning was issued (UTC), NULL for warnings issued before
+    # this was recorded, which never count towards the rolling tallies
+    created_at = Column(DateTime, nullable=True, default=datetime.utcnow)
@@ -1,8 +1,14 @@
-import logging
-from configuration import DB_URL, LOG_LEVEL, PREFIXES
-from sqlalchemy import create_engine, sql
+import asyncio, itertools, logging, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from configuration import CONFIG, DB_URL
+from sqlalchemy import create_engine, event, insert, sql
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session as OrmSession
+from sqlalchemy.pool import StaticPool, QueuePool
+from metrics import observe, increment, register_gauge
 
 class BotDBError(Exception):
     pass
@@ -10,18 +16,180 @@ class BotDBError(Exception):
 """
 wire up the the engine basic database stuff, and related functionality
 """
+class TimedQueuePool(QueuePool):
+    """
+    queue pool that records how long callers wait for a connection
+    """
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            observe('db.pool_wait', time.perf_counter() - start)
+
+def _engine_options(url):
+    if url.startswith('sqlite'):
+        if url.rstrip('/') == 'sqlite:' or ':memory:' in url:
+            # every executor thread would otherwise get its own, empty, database
+            return {'poolclass': StaticPool, 'connect_args': {'check_same_thread': False}}
+        return {}
+
+    # MySQL closes idle connections (wait_timeout), recycle well before that
+    # and ping on checkout so a quiet period never surfaces as an error
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': CONFIG.get('database_pool_size', 5),
+        'max_overflow': CONFIG.get('database_max_overflow', 5),
+        'pool_timeout': CONFIG.get('database_pool_timeout', 30),
+        'pool_recycle': CONFIG.get('database_pool_recycle', 3600),
+        'pool_pre_ping': CONFIG.get('database_pool_pre_ping', True),
+    }
+
 logging.debug("database url: `{}`".format(DB_URL))
-engine = create_engine(DB_URL, echo = (LOG_LEVEL == 'DEBUG'))
-engine.connect()
-Session = sessionmaker(bind = engine)
-bot_session = Session() # special session reserved for core bot functionality
-
-def update_prefix(id, prefix):
-    if prefix != PREFIXES.get(id, None):
-        if prefix is None:
-            PREFIXES.delete(id)
-        else:
-            PREFIXES[id] = prefix
+# statement logging is its own switch, DEBUG logging alone should not dump every query
+engine = create_engine(DB_URL, echo=CONFIG.get('db_echo', False), **_engine_options(DB_URL))
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    observe('sql.query', time.perf_counter() - conn.info['query_start'].pop())
+    increment('sql.queries')
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    increment('db.checkouts')
+
+def _connect(dbapi_connection, connection_record):
+    increment('db.connects')
+
+def _invalidate(dbapi_connection, connection_record, exception):
+    increment('db.invalidated')
+
+def _utc_session(dbapi_connection, connection_record):
+    # `updated_at` is a MySQL TIMESTAMP, read it (and compare to it) in UTC
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET time_zone = '+00:00'")
+    cursor.close()
+
+def instrument(target):
+    """
+    query timing and pool counters for an engine
+    """
+    event.listen(target, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(target, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(target, 'checkout', _checkout)
+    event.listen(target, 'connect', _connect)
+    event.listen(target, 'invalidate', _invalidate)
+    if target.dialect.name == 'mysql':
+        event.listen(target, 'connect', _utc_session)
+    return target
+
+instrument(engine)
+
+def _pool_stats():
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+    return {
+        'size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'idle': pool.checkedin(),
+    }
+
+register_gauge('db_pool', _pool_stats)
+
+
+"""
+Read replicas
+
+With `database_replicas` configured, sessions send plain SELECTs to a
+replica and everything else to the primary.  A session that wrote anything,
+or was created with `primary=True`, stays on the primary from then on, so a
+command always reads its own writes.  Each session sticks to one replica;
+sessions take turns over the replicas that passed their last health check.
+"""
+
+class ReplicaSet:
+    def __init__(self, engines):
+        self.engines = list(engines)
+        self.healthy = list(self.engines)
+        self.turn = itertools.count()
+
+    def pick(self):
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self.turn) % len(healthy)]
+
+    def mark_down(self, replica):
+        if replica in self.healthy:
+            logging.warning(f'Database replica {replica.url!r} failed, reads go elsewhere until it recovers')
+            increment('db.replica_down')
+            self.healthy = [e for e in self.healthy if e is not replica]
+
+    def _alive(self, replica):
+        try:
+            with replica.connect() as conn:
+                conn.execute(sql.text('SELECT 1'))
+            return True
+        except Exception:
+            return False
+
+    def check(self):
+        """
+        ping every replica, blocking; returns how many are healthy
+        """
+        healthy = [replica for replica in self.engines if self._alive(replica)]
+        if len(healthy) > len(self.healthy):
+            logging.info(f'{len(healthy) - len(self.healthy)} database replica(s) back in rotation')
+        self.healthy = healthy
+        return len(healthy)
+
+    def stats(self):
+        return {'replicas': len(self.engines), 'healthy': len(self.healthy)}
+
+def _replica_error(context):
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        REPLICAS.mark_down(context.engine)
+
+REPLICAS = ReplicaSet(instrument(create_engine(url, **_engine_options(url))) for url in CONFIG.get('database_replicas') or ())
+for replica in REPLICAS.engines:
+    event.listen(replica, 'handle_error', _replica_error)
+REPLICA_CHECK_INTERVAL = CONFIG.get('database_replica_check_interval', 10)
+if REPLICAS.engines:
+    register_gauge('db_replicas', REPLICAS.stats)
+
+class RoutingSession(OrmSession):
+    def __init__(self, primary=None, replicas=None, **kwargs):
+        super().__init__(**kwargs)
+        self.primary = primary
+        self.replicas = replicas
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replicas is None or not self.replicas.healthy:
+            return self.primary
+        if self._flushing or self.info.get('primary'):
+            self.info['primary'] = True
+            return self.primary
+        if clause is None or not getattr(clause, 'is_select', False) or getattr(clause, '_for_update_arg', None) is not None:
+            # writes, locking reads and raw statements, stay there from now on
+            self.info['primary'] = True
+            return self.primary
+
+        replica = self.info.get('replica')
+        if replica is None or replica not in self.replicas.healthy:
+            replica = self.info['replica'] = self.replicas.pick()
+        return replica
+
+async def replica_health_task():
+    while True:
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+        await run_sync(REPLICAS.check)
+
+# objects handed back to coroutines must stay readable without another
+# round-trip, so commits do not expire them
+Session = sessionmaker(class_ = RoutingSession, primary = engine, replicas = REPLICAS, expire_on_commit = False)
 
 def prefixed(cls):
     """
@@ -33,6 +201,26 @@ def prefixed(cls):
     return cls
 
 
+"""
+Live cache updates from model listeners
+
+Flushes run on the database executor, but the prefix cache and the
+permission index belong to the event loop.  Listeners hand their updates to
+`on_loop`, which schedules them on the loop that awaited the work; they run
+before that await returns, so a command still sees its own writes.
+"""
+
+_CALLER = threading.local()
+
+def on_loop(fn, *args):
+    loop = getattr(_CALLER, 'loop', None)
+    if loop is None or loop.is_closed():
+        # already on the loop, or plain synchronous use
+        fn(*args)
+    else:
+        loop.call_soon_threadsafe(fn, *args)
+
+
 """
 Load all the models
 """
@@ -42,50 +230,254 @@ from .Roles import Roles
 from .Servers import Servers
 from .Users import Users
 from .Warnings import Warnings
+from .WarningTallies import WarningTallies
+from .ChangeLog import ChangeLog, touched
 
 
 """
 The all-important session functionality
+
+Database drivers are blocking, so none of their work is allowed on the event
+loop.  Everything goes through a bounded pool of worker threads and is awaited.
 """
 
-def db_test():
-    # TODO: make sure the engine connects
-    # raise BotDBError if no connection
-    pass
+executor = ThreadPoolExecutor(
+    max_workers = CONFIG.get('database_workers', 4),
+    thread_name_prefix = 'rrbot-db'
+)
+
+def _timed_call(loop, queued, fn):
+    observe('db.executor_wait', time.perf_counter() - queued)
+    _CALLER.loop = loop
+    try:
+        return fn()
+    finally:
+        _CALLER.loop = None
+
+async def run_sync(fn, *args, **kwargs):
+    """
+    run a blocking callable on the database executor
+    """
+    loop = asyncio.get_running_loop()
+    call = partial(_timed_call, loop, time.perf_counter(), partial(fn, *args, **kwargs))
+    return await loop.run_in_executor(executor, call)
+
+class AsyncSession:
+    """
+    Awaitable wrapper around a regular session.
+
+    A session is not safe for concurrent use, so each command or callback
+    gets its own and closes it when done; there is no long-lived shared
+    session, which keeps identity maps small and returns connections to the
+    pool promptly.  Calls on one instance are awaited one after another and
+    therefore never overlap on the executor.
+    """
+    def __init__(self, primary=False):
+        self.session = Session()
+        if primary:
+            self.session.info['primary'] = True
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            await self.rollback()
+        await self.close()
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        run `fn(session, *args, **kwargs)` on the executor
+        """
+        try:
+            return await run_sync(fn, self.session, *args, **kwargs)
+        except OperationalError:
+            replica = self.session.info.get('replica')
+            if replica is None or self.session.info.get('primary'):
+                raise
+        # the replica went away mid-read, try once more on the primary
+        REPLICAS.mark_down(replica)
+        await self.rollback()
+        self.session.info['primary'] = True
+        return await run_sync(fn, self.session, *args, **kwargs)
+
+    async def get(self, model, id):
+        return await self.run(lambda session: session.get(model, id))
+
+    def add(self, instance):
+        # no I/O happens until flush/commit
+        self.session.add(instance)
+
+    async def commit(self):
+        await run_sync(self.session.commit)
+
+    async def rollback(self):
+        await run_sync(self.session.rollback)
+
+    async def close(self):
+        await run_sync(self.session.close)
+
+def _ping():
+    with engine.connect() as connection:
+        connection.execute(sql.text('SELECT 1'))
+
+def _settle(future, err):
+    # the check may have timed out (and been cancelled) in the meantime
+    if future.done():
+        return
+    if err is None:
+        future.set_result(None)
+    else:
+        future.set_exception(err)
+
+async def _checked_ping():
+    """
+    `_ping` on a throwaway daemon thread.  `wait_for` cannot stop a blocked
+    driver call, so an attempt that hangs past its timeout keeps running
+    there (with its pool connection) until the driver gives up, instead of
+    tying up one of the executor's workers or holding up exit.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def check():
+        try:
+            _ping()
+            err = None
+        except Exception as exc:
+            err = exc
+        try:
+            loop.call_soon_threadsafe(_settle, future, err)
+        except RuntimeError:
+            pass   # the loop is gone, nobody is waiting anymore
+
+    threading.Thread(target=check, name='rrbot-db-check', daemon=True).start()
+    return await future
+
+async def db_test(timeout=5, retries=5, backoff=0.5):
+    """
+    make sure the database answers, retrying with exponential backoff;
+    raises BotDBError once every attempt failed
+    """
+    for attempt in range(1, retries + 1):
+        try:
+            await asyncio.wait_for(_checked_ping(), timeout)
+            return
+        except Exception as err:
+            logging.warning(f'Database check {attempt}/{retries} failed: {err!r}')
+            if attempt == retries:
+                raise BotDBError(f'database unreachable after {retries} attempts') from err
+            await asyncio.sleep(backoff * 2 ** (attempt - 1))
 
 
 """
 utilities
+
+`get_or_create` and `bulk_ensure` run inside the executor; the `ensure_*`
+helpers are the awaitable entry points and expect an `AsyncSession`.
 """
 
+# upper bound on ids per `IN (...)` lookup / multi-row insert
+ENSURE_CHUNK_SIZE = CONFIG.get('database_chunk_size', 1000)
+
+class EnsureResult(list):
+    """
+    `(id, instance)` pairs in request order, along with how many of the rows
+    had to be created and how many already existed
+    """
+    def __init__(self, pairs=(), created=0, found=0):
+        super().__init__(pairs)
+        self.created = created
+        self.found = found
+
 def get_or_create(session, model, **kwargs):
+    # a lagging replica would miss rows the primary already has, and the
+    # insert would then fail there; read where the write is going to go
+    session.info['primary'] = True
     instance = session.query(model).filter_by(**kwargs).first()
     if not instance:
         instance = model(**kwargs)
         session.add(instance)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # created by someone else in the meantime
+            session.rollback()
+            instance = session.query(model).filter_by(**kwargs).one()
     return instance
 
-def ensure_channel(session, id):
-    return get_or_create(session, Channels, id=id)
+def _insert_missing(session, model, ids):
+    """
+    multi-row insert that tolerates rows created concurrently by someone else
+    """
+    rows = [{'id': id} for id in ids]
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(model).values(rows)
+        stmt = stmt.on_duplicate_key_update(id=stmt.inserted.id)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(model).values(rows).on_conflict_do_nothing()
+    else:
+        stmt = insert(model).values(rows)
+
+    result = session.execute(stmt)
+    # Core inserts skip the ORM listeners, the triggers still log them
+    touched(session, model.__tablename__, ids)
+    return result.rowcount if result.rowcount >= 0 else len(rows)
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def bulk_ensure(session, model, ids, chunk_size=None):
+    """
+    set-based get_or_create: one lookup and at most one insert per chunk,
+    committed as a single transaction
+    """
+    wanted = list(dict.fromkeys(ids))
+    instances = {}
+    created = 0
+    try:
+        for chunk in _chunks(wanted, chunk_size or ENSURE_CHUNK_SIZE):
+            for instance in session.query(model).filter(model.id.in_(chunk)):
+                instances[instance.id] = instance
+
+            missing = [id for id in chunk if id not in instances]
+            if missing:
+                created += _insert_missing(session, model, missing)
+                for instance in session.query(model).filter(model.id.in_(missing)):
+                    instances[instance.id] = instance
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    return EnsureResult(
+        [(id, instances.get(id)) for id in ids],
+        created = created,
+        found = len(wanted) - created
+    )
+
+async def ensure_channel(session, id):
+    return await session.run(get_or_create, Channels, id=id)
 
-def ensure_channels(session, ids):
-    return [(id, ensure_channel(session, id)) for id in ids]
+async def ensure_channels(session, ids):
+    return await session.run(bulk_ensure, Channels, ids)
 
-def ensure_server(session, id):
-    return get_or_create(session, Servers, id=id)
+async def ensure_server(session, id):
+    return await session.run(get_or_create, Servers, id=id)
 
-def ensure_servers(session, ids):
-    return [(id, ensure_server(session, id)) for id in ids]
+async def ensure_servers(session, ids):
+    return await session.run(bulk_ensure, Servers, ids)
 
-def ensure_role(session, id):
-    return get_or_create(session, Roles, id=id)
+async def ensure_role(session, id):
+    return await session.run(get_or_create, Roles, id=id)
 
-def ensure_roles(session, ids):
-    return [(id, ensure_role(session, id)) for id in ids]
+async def ensure_roles(session, ids):
+    return await session.run(bulk_ensure, Roles, ids)
 
-def ensure_user(session, id):
-    return get_or_create(session, Users, id=id)
+async def ensure_user(session, id):
+    return await session.run(get_or_create, Users, id=id)
 
-def ensure_users(session, ids):
-    return [(id, ensure_user(session, id)) for id in ids]
+async def ensure_users(session, ids):
+    return await session.run(bulk_ensure, Users, ids)
@@ -0,0 +1,45 @@
+import logging
+import discord
+from discord.ext import commands
+from automod import AUTOMOD, strongest
+from bot_utils import is_server_moderator
+from infractions import WARNING_QUEUE
+
+logging.info('Loading `automod`')
+
+class AutomodCog(commands.Cog, name='Automod'):
+    """
+    Runs every guild message through the guild's compiled filter rules (see
+    `automod.py`); hits become automated warnings, written in batches.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is None or message.author.bot or not message.content:
+            return
+        if await is_server_moderator(message.author, message.guild):
+            return
+
+        hits = await AUTOMOD.check(message.guild.id, message.content)
+
+        for rule, action in hits.items():
+            if action == 'log':
+                continue
+            WARNING_QUEUE.enqueue(
+                moderator_id=self.bot.user.id,
+                user_id=message.author.id,
+                server_id=message.guild.id,
+                channel_id=message.channel.id,
+                context=f'automod:{rule}'
+            )
+
+        if strongest(hits) == 'delete':
+            try:
+                await message.delete()
+            except discord.HTTPException as err:
+                logging.warning(f'automod could not delete message {message.id}: {err}')
+
+def setup(bot):
+    bot.add_cog(AutomodCog(bot))
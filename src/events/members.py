@@ -0,0 +1,23 @@
+import logging
+from discord.ext import commands
+from member_index import MEMBER_INDEX, LOW_MEMORY
+
+logging.info('Loading `members`')
+
+class MemberIndexCog(commands.Cog, name='Member Index'):
+    """
+    Keeps the compact member -> roles index current in low memory mode.
+    Without a member cache discord.py drops member updates for members it
+    does not know, so this reads the raw gateway payloads instead.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+
+    @commands.Cog.listener()
+    async def on_socket_response(self, payload):
+        if payload.get('op') == 0:
+            MEMBER_INDEX.apply(payload.get('t'), payload.get('d') or {})
+
+def setup(bot):
+    if LOW_MEMORY:
+        bot.add_cog(MemberIndexCog(bot))
@@ -0,0 +1,88 @@
+import asyncio, logging
+from discord.ext import commands
+from configuration import CONFIG
+from db import AsyncSession, ensure_servers, ensure_channels, ensure_roles, ensure_channel, ensure_role
+
+logging.info('Loading `reconcile`')
+
+# guilds per bulk upsert round, and how long to step aside between rounds
+BATCH_SIZE = CONFIG.get('reconcile_batch_size', 50)
+BATCH_PAUSE = CONFIG.get('reconcile_batch_pause', 0)
+
+def guild_batches(guilds, batch_size, after=None):
+    """
+    Walk guilds in id order, yielding lists of at most `batch_size` guilds.
+    Guilds with an id <= `after` were handled by an earlier, interrupted pass.
+    """
+    batch = []
+    for guild in sorted(guilds, key=lambda g: g.id):
+        if after is not None and guild.id <= after:
+            continue
+        batch.append(guild)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+async def reconcile_guilds(session, guilds):
+    """
+    register the servers, channels and roles of `guilds`: one bulk upsert per table
+    """
+    servers = await ensure_servers(session, [guild.id for guild in guilds])
+    channels = await ensure_channels(session, [c.id for guild in guilds for c in guild.channels])
+    roles = await ensure_roles(session, [r.id for guild in guilds for r in guild.roles])
+    return servers.created + channels.created + roles.created
+
+class ReconcileCog(commands.Cog, name='Guild Reconciliation'):
+    """
+    Brings the servers/channels/roles tables in line with what discord reports.
+
+    A full pass runs whenever the gateway reports ready.  Progress is kept in
+    `cursor` (the last guild id completed), so a pass cut short by a
+    disconnect picks up where it stopped on the next `on_ready`.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.cursor = None
+        self.task = None
+
+    def cog_unload(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def reconcile_all(self):
+        created = batches = 0
+        for batch in guild_batches(self.bot.guilds, BATCH_SIZE, after=self.cursor):
+            async with AsyncSession() as session:
+                created += await reconcile_guilds(session, batch)
+            self.cursor = batch[-1].id
+            batches += 1
+            # let gateway and command handling run between rounds
+            await asyncio.sleep(BATCH_PAUSE)
+
+        logging.info(f'Reconciled guilds in {batches} batches, {created} rows created')
+        self.cursor = None
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.reconcile_all())
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        async with AsyncSession() as session:
+            await reconcile_guilds(session, [guild])
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        async with AsyncSession() as session:
+            await ensure_channel(session, channel.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        async with AsyncSession() as session:
+            await ensure_role(session, role.id)
+
+def setup(bot):
+    bot.add_cog(ReconcileCog(bot))
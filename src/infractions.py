@@ -0,0 +1,234 @@
+"""
+Warnings service
+
+* `record_warning` writes a single warning immediately, for moderators.
+* `WARNING_QUEUE` buffers automated warnings and writes them in batches, so
+  a raid turns into a handful of multi-row inserts instead of one commit per
+  offending message.
+* `warning_history` pages through a user's warnings newest first using the
+  (server_id, user_id, id) index; pass the last id of a page as `before` to
+  get the next one.
+
+Both write paths update `warning_tallies` in the same transaction, and the
+in-memory counters in `tallies.py` once it committed.  The counters are
+rebuilt from `warning_tallies` at startup, and `tally_prune_task` keeps
+both bounded to the tally window.
+"""
+import asyncio, logging
+from collections import Counter
+from datetime import datetime
+from sqlalchemy import delete, insert
+from sqlalchemy.dialects import mysql, sqlite
+from configuration import CONFIG
+from metrics import increment
+from db import Warnings, WarningTallies, run_sync, Session
+import tallies
+
+def _warning_row(moderator_id, user_id, server_id, channel_id=None, context='', kicked=False, banned=False):
+    return {
+        'moderator_id': moderator_id,
+        'user_id': user_id,
+        'server_id': server_id,
+        'channel_id': channel_id,
+        'context': context,
+        'kicked': kicked,
+        'banned': banned,
+        'created_at': datetime.utcnow(),
+    }
+
+def _tally(rows):
+    return Counter(
+        (row['server_id'], row['user_id'], tallies.bucket_of(row['created_at'])) for row in rows
+    )
+
+def _upsert_tallies(session, counts):
+    rows = [
+        {'server_id': server_id, 'user_id': user_id, 'bucket': bucket, 'count': count}
+        for (server_id, user_id, bucket), count in counts.items()
+    ]
+    dialect = session.get_bind().dialect.name
+    if dialect == 'mysql':
+        stmt = mysql.insert(WarningTallies).values(rows)
+        stmt = stmt.on_duplicate_key_update(count=WarningTallies.count + stmt.inserted['count'])
+        session.execute(stmt)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(WarningTallies).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['server_id', 'user_id', 'bucket'],
+            set_={'count': WarningTallies.count + stmt.excluded['count']}
+        )
+        session.execute(stmt)
+    else:
+        for row in rows:
+            tally = session.get(WarningTallies, (row['server_id'], row['user_id'], row['bucket']))
+            if tally is None:
+                session.add(WarningTallies(**row))
+            else:
+                tally.count += row['count']
+
+def _insert_warnings(rows):
+    session = Session()
+    try:
+        session.execute(insert(Warnings), rows)
+        counts = _tally(rows)
+        _upsert_tallies(session, counts)
+        session.commit()
+        return counts
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _record(session, row):
+    warning = Warnings(**row)
+    session.add(warning)
+    counts = _tally([row])
+    _upsert_tallies(session, counts)
+    session.commit()
+    return warning, counts
+
+async def record_warning(session, **fields):
+    warning, counts = await session.run(_record, _warning_row(**fields))
+    tallies.apply(counts)
+    return warning
+
+# seconds between prunes of tally buckets that fell out of the window
+TALLY_PRUNE_INTERVAL = CONFIG.get('warning_tally_prune_interval', 3600)
+
+def _oldest_bucket():
+    # the newest bucket that no window reaches anymore
+    return tallies.current_bucket() - tallies.WINDOW_HOURS
+
+def _stream_tallies(session, oldest):
+    """
+    the hourly buckets still inside the window, read back from `warning_tallies`
+    """
+    rebuilt = {}
+    rows = session.query(WarningTallies.server_id, WarningTallies.user_id, WarningTallies.bucket, WarningTallies.count).filter(
+        WarningTallies.bucket > oldest
+    ).yield_per(10000)
+    for server_id, user_id, bucket, count in rows:
+        tallies.add(server_id, user_id, bucket, count, tallies=rebuilt)
+    return rebuilt
+
+async def load_tallies():
+    session = Session()
+    try:
+        rebuilt = await run_sync(_stream_tallies, session, _oldest_bucket())
+    finally:
+        session.close()
+    tallies.replace(rebuilt)
+    logging.info('Rebuilt warning tallies for {} users'.format(len(rebuilt)))
+
+def _purge_tallies(oldest):
+    session = Session()
+    try:
+        purged = session.execute(delete(WarningTallies).where(WarningTallies.bucket <= oldest)).rowcount
+        session.commit()
+        return purged
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def prune_tallies():
+    """
+    forget buckets outside the window, in memory and in `warning_tallies`
+    """
+    tallies.prune()
+    return await run_sync(_purge_tallies, _oldest_bucket())
+
+async def tally_prune_task():
+    while True:
+        await asyncio.sleep(TALLY_PRUNE_INTERVAL)
+        try:
+            await prune_tallies()
+        except Exception:
+            logging.exception('Failed to prune warning tallies')
+
+def _history(session, server_id, user_id, before, limit):
+    query = session.query(Warnings).filter(
+        Warnings.server_id == server_id,
+        Warnings.user_id == user_id
+    )
+    if before is not None:
+        query = query.filter(Warnings.id < before)
+    return query.order_by(Warnings.id.desc()).limit(limit).all()
+
+async def warning_history(session, server_id, user_id, before=None, limit=25):
+    return await session.run(_history, server_id, user_id, before, limit)
+
+class WarningQueue:
+    """
+    Write-behind buffer for automated warnings.
+
+    Rows are flushed when `batch_size` are waiting or `interval` seconds after
+    the first one was queued, whichever comes first, and written at most
+    `batch_size` per insert.  A failed write is retried after `interval`;
+    meanwhile at most `max_queued` rows are held and the oldest are dropped.
+    `flush()` must be awaited on shutdown so nothing queued is lost.
+    """
+    def __init__(self, batch_size=100, interval=2.0, max_queued=10000):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_queued = max_queued
+        self.rows = []
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def enqueue(self, **fields):
+        self.rows.append(_warning_row(**fields))
+        self._trim()
+        if len(self.rows) >= self.batch_size:
+            self._schedule(0)
+        elif self.timer is None:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        loop = asyncio.get_running_loop()
+        self.timer = loop.call_later(delay, lambda: asyncio.ensure_future(self.flush()))
+
+    def _trim(self):
+        excess = len(self.rows) - self.max_queued
+        if excess > 0:
+            del self.rows[:excess]
+            self.dropped += excess
+            increment('warnings.dropped', excess)
+            logging.error(f'Warning queue full, dropped the {excess} oldest warnings')
+
+    async def flush(self):
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            written = 0
+            while self.rows:
+                rows = self.rows[:self.batch_size]
+                del self.rows[:len(rows)]
+                try:
+                    counts = await run_sync(_insert_warnings, rows)
+                except Exception:
+                    logging.exception(f'Failed to write {len(rows)} queued warnings, requeueing')
+                    self.rows[:0] = rows
+                    self._trim()
+                    self._schedule(self.interval)
+                    return written
+                tallies.apply(counts)
+                self.written += len(rows)
+                written += len(rows)
+            return written
+
+WARNING_QUEUE = WarningQueue(
+    batch_size = CONFIG.get('warnings_batch_size', 100),
+    interval = CONFIG.get('warnings_flush_interval', 2.0),
+    max_queued = CONFIG.get('warnings_max_queued', 10000)
+)
@@ -0,0 +1,52 @@
+"""
+rrbot fleet launcher
+
+Starts `--processes` copies of main.py, each owning a contiguous range of
+the `--shard-count` gateway shards:
+
+    py3 launcher.py --processes 4 --shard-count 16
+
+The processes keep their caches coherent through the `rrbot/sync/+` MQTT
+topics, so they all need to reach the same broker and database.
+"""
+import argparse, logging, os, subprocess, sys
+
+def shard_ranges(shard_count, processes):
+    """
+    split shard ids 0..shard_count-1 into `processes` contiguous (first, last) ranges
+    """
+    processes = min(processes, shard_count)
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    first = 0
+    for i in range(processes):
+        last = first + size + (1 if i < extra else 0) - 1
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+def main():
+    parser = argparse.ArgumentParser(description='Run rrbot as several sharded processes')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--shard-count', type=int, required=True)
+    args = parser.parse_args()
+
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    workers = []
+    for first, last in shard_ranges(args.shard_count, args.processes):
+        cmd = [sys.executable, main_py, '--shards', f'{first}-{last}', '--shard-count', str(args.shard_count)]
+        logging.info('Starting shards {}-{}'.format(first, last))
+        workers.append(subprocess.Popen(cmd))
+
+    try:
+        for worker in workers:
+            worker.wait()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,123 @@
+"""
+Logging setup.  Records are handed to a queue on the calling thread and
+written to disk by a listener thread, so the event loop never waits on file
+I/O.  Chatty subsystems can be sampled or rate limited before they are queued.
+"""
+
+import json, logging, queue, random, time, atexit
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+from configuration import CONFIG, LOG_LEVEL
+from metrics import increment
+
+TEXT_FORMAT = '[%(asctime)s|%(levelname)s]%(filename)s@L%(lineno)d - %(message)s'
+LISTENER = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one JSON object per line
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'source': f'{record.filename}:{record.lineno}',
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SubsystemFilter(logging.Filter):
+    """
+    Drops a share (`sample`) or everything above a per second rate (`limits`)
+    of a subsystem's records below WARNING.  The subsystem is the logger name
+    or, for the root logger, the module the record came from; the longest
+    configured prefix wins.
+    """
+    def __init__(self, sample=None, limits=None):
+        super().__init__()
+        self.sample = dict(sample or {})
+        self.limits = dict(limits or {})
+        self.buckets = {}
+
+    def subsystem(self, record):
+        return record.module if record.name == 'root' else record.name
+
+    def rule(self, rules, name):
+        matches = [key for key in rules if name == key or name.startswith(key + '.')]
+        return max(matches, key=len) if matches else None
+
+    def allowed(self, key):
+        rate = self.limits[key]
+        now = time.monotonic()
+        tokens, last = self.buckets.get(key, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        name = self.subsystem(record)
+        key = self.rule(self.sample, name)
+        if key is not None and random.random() >= self.sample[key]:
+            increment('log.sampled_out')
+            return False
+
+        key = self.rule(self.limits, name)
+        if key is not None and not self.allowed(key):
+            increment('log.rate_limited')
+            return False
+        return True
+
+
+def file_handler(path):
+    if CONFIG.get('log_rotate', 'size') == 'time':
+        return TimedRotatingFileHandler(path,
+                when=CONFIG.get('log_rotate_when', 'midnight'),
+                backupCount=CONFIG.get('log_backup_count', 7))
+    return RotatingFileHandler(path,
+            maxBytes=CONFIG.get('log_max_bytes', 10 * 1024 * 1024),
+            backupCount=CONFIG.get('log_backup_count', 7))
+
+def formatter():
+    if CONFIG.get('log_format', 'text') == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT)
+
+def configure(path, level=LOG_LEVEL):
+    """
+    route the root logger through a queue to a rotating file
+    """
+    global LISTENER
+    handler = file_handler(path)
+    handler.setFormatter(formatter())
+
+    records = queue.SimpleQueue()
+    queued = QueueHandler(records)
+    queued.addFilter(SubsystemFilter(CONFIG.get('log_sample'), CONFIG.get('log_rate_limits')))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queued]
+    root.setLevel(getattr(logging, level))
+
+    LISTENER = QueueListener(records, handler, respect_handler_level=True)
+    LISTENER.start()
+    atexit.register(stop)
+    return LISTENER
+
+def stop():
+    """
+    write out whatever is still queued
+    """
+    global LISTENER
+    if LISTENER is not None:
+        LISTENER.stop()
+        LISTENER = None
@@ -4,50 +4,132 @@ TODO: a good description
 """
 
 from configuration import TOKEN, LOG_LEVEL, PREFIX, ROOT
-import os, sys, logging
+import sys, logging, asyncio, time
+from contextlib import contextmanager
 
-logging.basicConfig(
-        filename=f'{ROOT}/logs/main.log',
-        filemode='w',
-        level=getattr(logging, LOG_LEVEL),
-        format='[%(asctime)s|%(levelname)s]%(filename)s@L%(lineno)d - %(message)s'
-)
+# sharded fleets run one process per shard range, keep their logs apart
+log_name = 'main' if '--shards' not in sys.argv else 'main-{}'.format(sys.argv[sys.argv.index('--shards') + 1])
+import log_pipeline
+log_pipeline.configure(f'{ROOT}/logs/{log_name}.log', LOG_LEVEL)
 
+from discord import Intents, MemberCacheFlags
+from db import db_test, REPLICAS, replica_health_task
+from bot_utils import RRBot, ShardedRRBot, shard_arguments, load_extension_directory, load_permissions, prefix_operator
+from infractions import load_tallies, tally_prune_task, WARNING_QUEUE
+from settings_store import SETTINGS
+from outbox import OUTBOX
+import snapshot
+from member_index import LOW_MEMORY
+from metrics import register_gauge
+import mqtt_client
+
+
+"""
+Startup timing, reported per phase once the bot is ready to connect
+"""
 
-# verify the database
-from db import db_test
-db_test()
+STARTUP = {}
+register_gauge('startup', lambda: dict(STARTUP))
 
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP[name] = time.perf_counter() - start
 
-# start building the bot up
-from discord import Intents
-from discord.ext import commands
-from bot_utils import load_extension_directory, load_prefixes, prefix_operator
+async def timed(name, coro):
+    with phase(name):
+        return await coro
 
+def build_bot():
+    logging.info('Using `{}` as default command token.'.format(PREFIX))
+    #intents = Intents(messages=True, guilds=True, members=True, bans=True, emojis=True, webhooks=True, reactions=True)
+    intents = Intents.default()
+    intents.members = True
+    options = {}
+    if LOW_MEMORY:
+        # member events still arrive, roles are kept in the compact index instead
+        logging.info('Low memory mode: member cache and chunking disabled')
+        options = {'member_cache_flags': MemberCacheFlags.none(), 'chunk_guilds_at_startup': False}
 
-# output some boot up information
+    shard_ids, shard_count = shard_arguments(sys.argv)
+    if shard_ids is None:
+        return RRBot(command_prefix=prefix_operator, intents=intents, **options)
 
-logging.info('Using `{}` as default command token.'.format(PREFIX))
-load_prefixes()
-#intents = Intents(messages=True, guilds=True, members=True, bans=True, emojis=True, webhooks=True, reactions=True)
-intents = Intents.default()
-intents.members = True
-bot = commands.Bot(command_prefix=prefix_operator, intents=intents)
+    logging.info('Running shards {} of {}'.format(shard_ids, shard_count))
+    return ShardedRRBot(command_prefix=prefix_operator, intents=intents, shard_ids=shard_ids, shard_count=shard_count, **options)
 
+async def warm_caches():
+    # anything committed after this version reaches us over MQTT sync
+    await timed('sync', mqtt_client.sync.init_version())
+    await asyncio.gather(
+        timed('permissions', snapshot.warm_start(load_permissions)),
+        timed('tallies', load_tallies())
+    )
 
-# load the extensions
+async def bootstrap(bot, live=True):
+    """
+    Everything that has to happen before the gateway connects.  The database
+    check comes first since nothing works without it; after that the discord
+    login, cache warm-up and MQTT connection run side by side.  The console
+    (`live=False`) only gets the database and the caches.
+    """
+    with phase('total'):
+        await timed('database', db_test())
 
-for ext in ['commands', 'events']:
-    load_extension_directory(bot, ext)
+        login = asyncio.ensure_future(timed('login', bot.login(TOKEN))) if live else None
+        warmup = asyncio.ensure_future(warm_caches())
+        if live:
+            with phase('mqtt'):
+                mqtt_client.start()
+        if live and snapshot.SNAPSHOT_INTERVAL:
+            asyncio.ensure_future(snapshot.snapshot_task())
+        if live:
+            asyncio.ensure_future(tally_prune_task())
+        if REPLICAS.engines:
+            asyncio.ensure_future(replica_health_task())
+
+        # let the login request and warm-up queries get going, extension
+        # loading is just imports and runs while those are in flight
+        await asyncio.sleep(0)
+        with phase('extensions'):
+            for ext in ['commands', 'events']:
+                load_extension_directory(bot, ext)
+
+        await asyncio.gather(*[task for task in (login, warmup) if task is not None])
+
+    logging.info('Startup: {}'.format(', '.join(f'{name} {took:.3f}s' for name, took in STARTUP.items())))
+
+async def shutdown(bot):
+    await WARNING_QUEUE.flush()
+    await SETTINGS.flush()
+    await snapshot.save()
+    await OUTBOX.drain()
+    if not bot.is_closed():
+        await bot.close()
+
+async def run(bot):
+    try:
+        await bootstrap(bot)
+        logging.info('All aboard!')
+        await bot.connect()
+    finally:
+        await shutdown(bot)
 
-import mqtt_client
 
 # go live
 
-logging.info('All aboard!')
+bot = build_bot()
+loop = asyncio.get_event_loop()
 if '-c' in sys.argv:
     print('Notice: This is not a live connection to any asyncio resources.  Discord is not running, mqtt will not respond. Database is accessible, however.  This is a test console for base functionality only.')
+    loop.run_until_complete(bootstrap(bot, live=False))
     import code
     code.interact(local=dict(globals(), **locals()))
 else:
-    bot.run(TOKEN)
+    try:
+        loop.run_until_complete(run(bot))
+    except KeyboardInterrupt:
+        loop.run_until_complete(shutdown(bot))
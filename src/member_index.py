@@ -0,0 +1,205 @@
+"""
+Compact member -> role ids index
+
+With `low_memory` on, discord.py keeps no Member objects (no member cache,
+no chunking) and the only thing the bot still needs, which roles a member
+has, lives here instead.  Each guild keeps its members in three flat arrays:
+
+    users    sorted user ids                 array('Q')
+    offsets  start of each user's roles      array('I'), len(users) + 1
+    roles    every user's role ids, in order array('Q')
+
+so a member costs 8 bytes plus 8 per role, looked up by bisection.  Changes
+go to a small `delta` dict first and are folded into the arrays once it
+grows past a fraction of the guild, keeping updates cheap without letting
+the dict turn back into a per-member cache.
+
+The index is fed from raw gateway payloads (member add/update/remove and
+the member part of every message), and `fetch_role_ids` asks the API on a
+miss.  Permission checks go through `role_ids_of` / `resolve_role_ids`, which
+use a member's own roles when discord.py has them and the index otherwise.
+"""
+import asyncio, logging
+from array import array
+from bisect import bisect_left
+from configuration import CONFIG
+from metrics import increment, register_gauge
+
+LOW_MEMORY = CONFIG.get('low_memory', False)
+
+REMOVED = None
+
+class GuildRoles:
+    def __init__(self):
+        self.users = array('Q')
+        self.offsets = array('I', [0])
+        self.roles = array('Q')
+        self.delta = {}
+
+    def __len__(self):
+        return len(self.users) + sum(1 for user_id, roles in self.delta.items() if roles is not REMOVED and not self._indexed(user_id))
+
+    def _position(self, user_id):
+        i = bisect_left(self.users, user_id)
+        return i if i < len(self.users) and self.users[i] == user_id else None
+
+    def _indexed(self, user_id):
+        return self._position(user_id) is not None
+
+    def get(self, user_id):
+        """
+        tuple of role ids, None when the member is unknown
+        """
+        if user_id in self.delta:
+            return self.delta[user_id]
+        i = self._position(user_id)
+        if i is None:
+            return None
+        return tuple(self.roles[self.offsets[i]:self.offsets[i + 1]])
+
+    def set(self, user_id, role_ids):
+        role_ids = tuple(sorted(role_ids))
+        # every message carries the author's roles, most of them change nothing
+        if self.get(user_id) == role_ids:
+            return
+        self.delta[user_id] = role_ids
+        self._maybe_compact()
+
+    def remove(self, user_id):
+        self.delta[user_id] = REMOVED
+        self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self.delta) > max(64, len(self.users) // 8):
+            self.compact()
+
+    def compact(self):
+        if not self.delta:
+            return
+        merged = {}
+        for i, user_id in enumerate(self.users):
+            if user_id not in self.delta:
+                merged[user_id] = self.roles[self.offsets[i]:self.offsets[i + 1]]
+        for user_id, roles in self.delta.items():
+            if roles is not REMOVED:
+                merged[user_id] = roles
+
+        users, offsets, roles = array('Q'), array('I', [0]), array('Q')
+        for user_id in sorted(merged):
+            users.append(user_id)
+            roles.extend(merged[user_id])
+            offsets.append(len(roles))
+        self.users, self.offsets, self.roles = users, offsets, roles
+        self.delta = {}
+
+    def nbytes(self):
+        arrays = (self.users, self.offsets, self.roles)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+
+class MemberIndex:
+    def __init__(self):
+        self.guilds = {}
+        self.fetching = {}
+
+    def get(self, guild_id, user_id):
+        guild = self.guilds.get(guild_id)
+        roles = guild.get(user_id) if guild is not None else None
+        increment('members.hit' if roles is not None else 'members.miss')
+        return roles
+
+    def set(self, guild_id, user_id, role_ids):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = GuildRoles()
+        guild.set(user_id, role_ids)
+
+    def remove(self, guild_id, user_id):
+        guild = self.guilds.get(guild_id)
+        if guild is not None:
+            guild.remove(user_id)
+
+    def drop_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def apply(self, event, data):
+        """
+        update from a raw gateway dispatch, ignores anything irrelevant
+        """
+        if event in ('GUILD_MEMBER_ADD', 'GUILD_MEMBER_UPDATE'):
+            self.set(int(data['guild_id']), int(data['user']['id']), map(int, data.get('roles', ())))
+        elif event == 'GUILD_MEMBER_REMOVE':
+            self.remove(int(data['guild_id']), int(data['user']['id']))
+        elif event == 'MESSAGE_CREATE' and 'member' in data and 'guild_id' in data:
+            self.set(int(data['guild_id']), int(data['author']['id']), map(int, data['member'].get('roles', ())))
+        elif event == 'GUILD_DELETE':
+            self.drop_guild(int(data['id']))
+
+    async def fetch_role_ids(self, guild, user_id):
+        """
+        role ids of a member, asking the API on a miss; None if not a member
+        """
+        roles = self.get(guild.id, user_id)
+        if roles is not None:
+            return roles
+
+        key = (guild.id, user_id)
+        pending = self.fetching.get(key)
+        if pending is None:
+            pending = self.fetching[key] = asyncio.ensure_future(self._fetch(guild, user_id))
+            pending.add_done_callback(lambda _: self.fetching.pop(key, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch(self, guild, user_id):
+        try:
+            member = await guild.fetch_member(user_id)
+        except Exception as err:
+            logging.debug(f'Could not fetch member {user_id} of {guild.id}: {err}')
+            return None
+        roles = tuple(role.id for role in member.roles if role.id != guild.id)
+        self.set(guild.id, user_id, roles)
+        return self.get(guild.id, user_id)
+
+    def stats(self):
+        return {
+            'guilds': len(self.guilds),
+            'members': sum(len(guild) for guild in self.guilds.values()),
+            'pending': sum(len(guild.delta) for guild in self.guilds.values()),
+            'bytes': sum(guild.nbytes() for guild in self.guilds.values()),
+        }
+
+
+MEMBER_INDEX = MemberIndex()
+if LOW_MEMORY:
+    register_gauge('member_index', MEMBER_INDEX.stats)
+
+def _guild_id(member, guild_id):
+    if guild_id is not None:
+        return guild_id
+    guild = getattr(member, 'guild', None)
+    return guild.id if guild is not None else None
+
+def role_ids_of(member, guild_id=None):
+    """
+    role ids of a message author or member; plain users (no member cache)
+    are looked up in the index, an empty tuple if nothing is known.
+    Pass the message's guild id, a plain user does not know its guild.
+    """
+    roles = getattr(member, 'roles', None)
+    if roles is not None:
+        return [role.id for role in roles]
+    guild_id = _guild_id(member, guild_id)
+    if guild_id is None:
+        return ()
+    return MEMBER_INDEX.get(guild_id, member.id) or ()
+
+async def resolve_role_ids(member, guild):
+    """
+    like `role_ids_of`, but in low memory mode a user missing from the index
+    is fetched from the API (once, however many callers ask)
+    """
+    if getattr(member, 'roles', None) is not None or guild is None:
+        return role_ids_of(member, guild.id if guild is not None else None)
+    if not LOW_MEMORY:
+        return MEMBER_INDEX.get(guild.id, member.id) or ()
+    return await MEMBER_INDEX.fetch_role_ids(guild, member.id) or ()
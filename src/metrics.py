@@ -0,0 +1,90 @@
+"""
+Runtime metrics
+
+Cheap, fixed-size structures that are safe to update from the event loop and
+from the database executor threads:
+
+* counters, plain running totals
+* histograms with fixed latency buckets (seconds)
+* gauges, callables sampled only when a snapshot is taken
+
+`snapshot()` collects everything into a JSON-friendly dict; it is published
+on `rrbot/metrics` and dumped by the `metrics` admin command.
+"""
+import threading, time
+from bisect import bisect_left
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'total', 'max', 'lock')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(BUCKETS, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q):
+        """
+        upper bound of the bucket holding the q-th observation
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+        }
+
+COUNTERS = {}
+HISTOGRAMS = {}
+GAUGES = {}
+STARTED = time.time()
+_lock = threading.Lock()
+
+def increment(name, amount=1):
+    with _lock:
+        COUNTERS[name] = COUNTERS.get(name, 0) + amount
+
+def histogram(name):
+    hist = HISTOGRAMS.get(name)
+    if hist is None:
+        with _lock:
+            hist = HISTOGRAMS.setdefault(name, Histogram())
+    return hist
+
+def observe(name, value):
+    histogram(name).observe(value)
+
+def register_gauge(name, fn):
+    GAUGES[name] = fn
+
+def snapshot():
+    return {
+        'uptime': time.time() - STARTED,
+        'counters': dict(COUNTERS),
+        'histograms': {name: hist.snapshot() for name, hist in list(HISTOGRAMS.items())},
+        'gauges': {name: fn() for name, fn in list(GAUGES.items())},
+    }
@@ -1,20 +1,58 @@
-import asyncio, json, re, logging, glob
+import asyncio, json, logging, glob, random, sys, time
+from collections import deque
 from os import path
-from configuration import MQTT_URL
+from configuration import CONFIG, MQTT_URL
 from asyncio_mqtt import Client, MqttError
-from db import Session, Servers, Channels
+from .dispatcher import Dispatcher
+from .local_broker import LOCAL_BROKER
+from metrics import register_gauge, increment, observe
 
 TOPIC_PREFIX = 'rrbot/settings'
-TOPIC_FILTER = f"{TOPIC_PREFIX}/+"
-TOPIC = re.compile(f'{TOPIC_PREFIX}/(?P<topic>.+)')
+SYNC_PREFIX = 'rrbot/sync'
+ACK_PREFIX = 'rrbot/ack'
+TOPIC_FILTERS = [f"{TOPIC_PREFIX}/+", f"{SYNC_PREFIX}/delta", f"{SYNC_PREFIX}/request"]
 MQTT_LIVE = True
+CLIENT = None
+LOOP = None
 DISPATCH = {}
+CONNECT_CALLBACKS = []
 
-def register_setting_callback(setting, callback):
-    if DISPATCH.get(setting, None) is None:
-        DISPATCH[setting] = [callback]
+QOS = CONFIG.get('mqtt_qos', 1)
+CLEAN_SESSION = CONFIG.get('mqtt_clean_session', True)
+# a persistent session needs a stable id, one per shard range
+CLIENT_ID = CONFIG.get('mqtt_client_id') or (None if CLEAN_SESSION else 'rrbot')
+if CLIENT_ID and '--shards' in sys.argv:
+    CLIENT_ID = '{}-{}'.format(CLIENT_ID, sys.argv[sys.argv.index('--shards') + 1])
+
+# reconnect delays: full jitter over base * 2^attempt, never more than cap
+BACKOFF_BASE = CONFIG.get('mqtt_backoff_base', 0.5)
+BACKOFF_CAP = CONFIG.get('mqtt_backoff_cap', 30)
+
+# messages published while disconnected, sent in order once connected again
+OUTBOX = deque(maxlen=CONFIG.get('mqtt_outbox_size', 1000))
+CONNECTION = {
+    'state': 'idle',
+    'connects': 0,
+    'disconnects': 0,
+    'buffered': 0,
+    'dropped': 0,
+}
+register_gauge('mqtt', lambda: dict(CONNECTION, outbox=len(OUTBOX)))
+DISPATCHER = Dispatcher(
+    workers = CONFIG.get('mqtt_workers', 4),
+    queue_size = CONFIG.get('mqtt_queue_size', 100),
+    overflow = CONFIG.get('mqtt_overflow', 'block')
+)
+register_gauge('mqtt_topics', lambda: {t: s.as_dict() for t, s in DISPATCHER.stats.items()})
+
+def register_topic_callback(topic, callback):
+    if DISPATCH.get(topic, None) is None:
+        DISPATCH[topic] = [callback]
     else:
-        DISPATCH[setting].append(callback)
+        DISPATCH[topic].append(callback)
+
+def register_setting_callback(setting, callback):
+    register_topic_callback(f'{TOPIC_PREFIX}/{setting}', callback)
 
 def setting_callback(name):
     """
@@ -25,36 +63,148 @@ def setting_callback(name):
         return func
     return predicate
 
+def sync_callback(name):
+    """
+    decoractor for registering a function as a settings sync callback
+    """
+    def predicate(func):
+        register_topic_callback(f'{SYNC_PREFIX}/{name}', func)
+        return func
+    return predicate
+
+def connect_callback(func):
+    """
+    decorator for a coroutine to run with the client after every (re)connect
+    """
+    CONNECT_CALLBACKS.append(func)
+    return func
+
+def connect():
+    # `local` keeps everything in-process, handy without a mosquitto around
+    if MQTT_URL == 'local':
+        return LOCAL_BROKER.client()
+    return Client(MQTT_URL, client_id=CLIENT_ID, clean_session=CLEAN_SESSION)
+
+def reconnect_delay(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
 async def dispatch_message(message):
-    m = TOPIC.match(message.topic)
-    if m is None:
+    fns = DISPATCH.get(message.topic, None)
+    if fns is None:
+        return
+
+    try:
+        data = json.loads(message.payload.decode())
+    except ValueError as err:
+        logging.error(f'Discarding malformed payload on `{message.topic}`: {err}')
         return
 
-    fns = DISPATCH.get(m['topic'], None)
-    if fns is not None:
-        [await fn(json.loads(message.payload.decode())) for fn in fns]
+    await DISPATCHER.submit(message.topic, data, fns)
+
+def _buffer(message):
+    if len(OUTBOX) == OUTBOX.maxlen:
+        CONNECTION['dropped'] += 1
+        increment('mqtt.outbox_dropped')
+    OUTBOX.append(message)
+    CONNECTION['buffered'] += 1
+
+async def publish(topic, data, retain=False):
+    """
+    publish `data` as JSON; buffered in the outbox while disconnected, the
+    oldest buffered message is dropped when it is full.  Returns whether it
+    was sent right away.
+    """
+    message = (topic, json.dumps(data), retain)
+    if CLIENT is not None:
+        try:
+            await CLIENT.publish(topic, message[1], qos=QOS, retain=retain)
+            return True
+        except MqttError as err:
+            logging.warning(f'MQTT publish to `{topic}` failed, buffering: {err}')
+    _buffer(message)
+    return False
+
+async def _flush_outbox(client):
+    while OUTBOX:
+        topic, payload, retain = OUTBOX[0]
+        await client.publish(topic, payload, qos=QOS, retain=retain)
+        OUTBOX.popleft()
+
+async def acknowledge(setting, results):
+    return await publish(f'{ACK_PREFIX}/{setting}', results)
+
+def target_of(item, keys):
+    """
+    `(key, id)` for the first of `keys` a batch item names, None when it
+    names none of them or the id is not a number
+    """
+    if not isinstance(item, dict):
+        return None
+    key = next((key for key in keys if key in item), None)
+    if key is None:
+        return None
+    try:
+        return key, int(item[key])
+    except (TypeError, ValueError):
+        return None
 
 async def mqtt_task():
-    attempts = 1
+    """
+    Keep a broker connection up.  After connecting: subscribe, send whatever
+    was buffered in the meantime, then run the connect callbacks (sync
+    catch-up) and dispatch messages until the connection drops.
+    """
+    global CLIENT, LOOP
+    LOOP = asyncio.get_running_loop()
+    DISPATCHER.start()
+    attempts = 0
+    lost_at = time.perf_counter()
     while MQTT_LIVE:
+        CONNECTION['state'] = 'connecting'
         try:
-            async with Client(MQTT_URL) as client:
-                logging.info(f'connected to client at {MQTT_URL}')
-                attempts = 1
-                await client.subscribe(TOPIC_FILTER)
-                async with client.filtered_messages(TOPIC_FILTER) as messages:
+            async with connect() as client:
+                async with client.unfiltered_messages() as messages:
+                    for topic_filter in TOPIC_FILTERS:
+                        await client.subscribe(topic_filter, qos=QOS)
+                    await _flush_outbox(client)
+                    CLIENT = client
+                    CONNECTION['state'] = 'connected'
+                    CONNECTION['connects'] += 1
+                    observe('mqtt.reconnect', time.perf_counter() - lost_at)
+                    logging.info(f'connected to client at {MQTT_URL}')
+                    attempts = 0
+                    for fn in CONNECT_CALLBACKS:
+                        asyncio.ensure_future(fn(client))
                     async for message in messages:
                         await dispatch_message(message)
         except MqttError as err:
-            logging.error(err)
-        timeout = max(5 * attempts, 30)
-        logging.info(f'Will attempt reconnect #{attempt} to {MQTT_URL} in {timeout}')
-        await asyncio.sleep(timeout)
+            logging.error(f'MQTT connection to {MQTT_URL}: {err}')
+
+        if CLIENT is not None:
+            CLIENT = None
+            CONNECTION['disconnects'] += 1
+            lost_at = time.perf_counter()
+        CONNECTION['state'] = 'backoff'
+        delay = reconnect_delay(attempts)
         attempts += 1
+        logging.info(f'Will attempt reconnect #{attempts} to {MQTT_URL} in {delay:.1f}s')
+        await asyncio.sleep(delay)
+
+
+def start():
+    """
+    start the connection loop and periodic publishers; returns their tasks
+    """
+    from .metrics_publisher import metrics_task, METRICS_INTERVAL
+    from .sync import snapshot_task, SNAPSHOT_INTERVAL, LEADER
+    tasks = [asyncio.ensure_future(mqtt_task())]
+    if METRICS_INTERVAL:
+        tasks.append(asyncio.ensure_future(metrics_task()))
+    if LEADER and SNAPSHOT_INTERVAL:
+        tasks.append(asyncio.ensure_future(snapshot_task()))
+    return tasks
 
 
 for f in glob.glob(path.join(path.dirname(__file__), "*.py")):
     if path.isfile(f) and not f.endswith('__init__.py'):
         __import__(f"mqtt_client.{path.basename(f)[:-3]}")
-
-asyncio.ensure_future(mqtt_task())
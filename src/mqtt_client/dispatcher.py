@@ -0,0 +1,107 @@
+import asyncio, logging, time, zlib
+from metrics import observe, increment
+
+OVERFLOW_POLICIES = ('block', 'drop_new', 'drop_oldest')
+
+class TopicStats:
+    def __init__(self):
+        self.depth = 0
+        self.handled = 0
+        self.dropped = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def as_dict(self):
+        return {
+            'depth': self.depth,
+            'handled': self.handled,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'latency_avg': self.latency_total / self.handled if self.handled else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+class Dispatcher:
+    """
+    Hands decoded setting messages to a fixed pool of workers.
+
+    Every topic always maps to the same worker, so updates to one setting are
+    applied in the order they arrived while different settings are handled
+    concurrently.  Each worker has a bounded queue; when it is full the
+    overflow policy decides whether the reader waits (`block`), the new
+    message is discarded (`drop_new`) or the oldest queued one is
+    (`drop_oldest`).
+    """
+    def __init__(self, workers=4, queue_size=100, overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown overflow policy `{overflow}`')
+        self.workers = workers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.queues = []
+        self.tasks = []
+        self.stats = {}
+
+    def start(self):
+        if self.tasks:
+            return
+        self.queues = [asyncio.Queue(self.queue_size) for _ in range(self.workers)]
+        self.tasks = [asyncio.ensure_future(self._worker(q)) for q in self.queues]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def topic_stats(self, topic):
+        stats = self.stats.get(topic)
+        if stats is None:
+            stats = self.stats[topic] = TopicStats()
+        return stats
+
+    def _queue_for(self, topic):
+        return self.queues[zlib.crc32(topic.encode()) % len(self.queues)]
+
+    async def submit(self, topic, data, callbacks):
+        """
+        queue `data` for every callback registered on `topic`;
+        returns False if the message was dropped
+        """
+        stats = self.topic_stats(topic)
+        queue = self._queue_for(topic)
+        if queue.full():
+            if self.overflow == 'drop_new':
+                stats.dropped += 1
+                return False
+            if self.overflow == 'drop_oldest':
+                old_topic = queue.get_nowait()[0]
+                queue.task_done()
+                old = self.topic_stats(old_topic)
+                old.depth -= 1
+                old.dropped += 1
+
+        stats.depth += 1
+        await queue.put((topic, data, callbacks, time.monotonic()))
+        return True
+
+    async def _worker(self, queue):
+        while True:
+            topic, data, callbacks, queued = await queue.get()
+            stats = self.topic_stats(topic)
+            stats.depth -= 1
+            start = time.monotonic()
+            observe('mqtt.lag', start - queued)
+            increment(f'mqtt.messages.{topic}')
+            for fn in callbacks:
+                try:
+                    await fn(data)
+                except Exception:
+                    stats.errors += 1
+                    logging.exception(f'MQTT callback {fn.__name__} failed on `{topic}`')
+            elapsed = time.monotonic() - start
+            stats.handled += 1
+            stats.latency_total += elapsed
+            stats.latency_max = max(stats.latency_max, elapsed)
+            observe(f'mqtt.handler.{topic}', elapsed)
+            queue.task_done()
@@ -0,0 +1,27 @@
+import logging
+from settings_store import SETTINGS
+from . import setting_callback, publish, TOPIC_PREFIX
+from .sync import ORIGIN
+
+async def publish_changes(changes):
+    await publish(f'{TOPIC_PREFIX}/jsondata', {'origin': ORIGIN, 'changes': changes})
+
+SETTINGS.publisher = publish_changes
+
+@setting_callback('jsondata')
+async def invalidate_jsondata(data):
+    """
+    `{"changes": [{"table": "servers", "id": 1}]}`: drop the cached copies of
+    those blobs so the next read goes back to the database
+    """
+    if not isinstance(data, dict):
+        logging.error(f'Discarding jsondata payload, expected an object: {data!r:.200}')
+        return
+    if data.get('origin') == ORIGIN:
+        return
+    for change in data.get('changes', ()):
+        try:
+            SETTINGS.invalidate(change['table'], int(change['id']))
+        except (KeyError, TypeError, ValueError):
+            logging.warning(f'Skipping invalid jsondata change: {change!r:.200}')
+    logging.debug(f"jsondata invalidated: {len(data.get('changes', ()))}")
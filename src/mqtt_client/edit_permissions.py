@@ -0,0 +1,48 @@
+import logging
+from permissions import update_live_permissions, remove_live_permissions
+from db import AsyncSession, Users, Roles, Channels, Servers
+from . import setting_callback, target_of
+
+TARGETS = (
+    ('user_id', 'users', Users),
+    ('role_id', 'roles', Roles),
+    ('channel_id', 'channels', Channels),
+    ('server_id', 'servers', Servers),
+)
+KEYS = [key for key, _, _ in TARGETS]
+
+def _lookup(session, model, ids):
+    return session.query(model).filter(model.id.in_(ids)).all()
+
+@setting_callback('permissions')
+async def set_permissions(data):
+    """
+    Refresh the live permission index for the listed users/roles/channels/servers, e.g.
+    `[{"user_id": 123}, {"role_id": 456}]`.  The database is the authority,
+    the payload only says which entries changed.  Items without a numeric id
+    are logged and skipped.
+    """
+    if not isinstance(data, list):
+        logging.error(f'Discarding permissions payload, expected a list: {data!r:.200}')
+        return
+
+    logging.info(f"Permission changes received: {len(data)}")
+    targets = []
+    for item in data:
+        target = target_of(item, KEYS)
+        if target is None:
+            logging.warning(f'Skipping invalid permissions item: {item!r:.200}')
+        else:
+            targets.append(target)
+
+    async with AsyncSession(primary=True) as session:
+        for key, table, model in TARGETS:
+            ids = {id for target_key, id in targets if target_key == key}
+            if not ids:
+                continue
+
+            found = await session.run(_lookup, model, ids)
+            for record in found:
+                update_live_permissions(table, record)
+            for id in ids - {record.id for record in found}:
+                remove_live_permissions(table, id)
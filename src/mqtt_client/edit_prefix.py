@@ -1,20 +1,62 @@
 import logging
-from configuration import update_live_prefix
-from db import Session, Servers, Channels
-from . import setting_callback
+from prefixes import update_live_prefix
+from db import AsyncSession, Servers, Channels
+from . import setting_callback, acknowledge, target_of
+
+TARGETS = (
+    ('channel_id', Channels),
+    ('server_id', Servers),
+)
+KEYS = [key for key, _ in TARGETS]
+
+def _lookup(session, model, ids):
+    return dict(session.query(model.id, model.prefix).filter(model.id.in_(ids)).all())
 
 @setting_callback('prefix')
 async def set_prefix(data):
-    logging.info(f"Data received: {data}")
-    for prefix in data:
-        dkeys = prefix.keys()
-        session = Session()
-        if 'channel_id' in dkeys:
-            target = session.query(Channels).get(prefix['channel_id'])
-        elif 'server_id' in dkeys:
-            target = session.query(Servers).get(prefix['server_id'])
-        else:
-            target = None
-
-        if target and target.prefix == prefix.get('prefix', None):
-            update_live_prefix(target.id, target.prefix)
+    """
+    Apply a batch of prefix changes, e.g.
+    `[{"server_id": 1, "prefix": "!"}, {"channel_id": 2, "prefix": null}]`.
+
+    The database is the authority: every listed id is re-read (one query per
+    table) and its stored prefix becomes live.  An acknowledgement listing the
+    outcome of each item is published on `rrbot/ack/prefix`; items without a
+    numeric id are `invalid` and do not affect the rest of the batch.
+    """
+    if not isinstance(data, list):
+        logging.error(f'Discarding prefix payload, expected a list: {data!r:.200}')
+        await acknowledge('prefix', [{'status': 'invalid', 'error': 'payload must be a list'}])
+        return
+
+    logging.info(f"Prefix changes received: {len(data)}")
+    targets = [target_of(item, KEYS) for item in data]
+    stored = {}
+    # the UI has just written these rows, a replica may not have them yet
+    async with AsyncSession(primary=True) as session:
+        for key, model in TARGETS:
+            ids = {target[1] for target in targets if target is not None and target[0] == key}
+            if ids:
+                stored[key] = await session.run(_lookup, model, ids)
+
+    results = []
+    changes = {}
+    for item, target in zip(data, targets):
+        if target is None:
+            results.append(dict(item, status='invalid') if isinstance(item, dict) else {'item': item, 'status': 'invalid'})
+            continue
+
+        key, id = target
+        if id not in stored[key]:
+            results.append(dict(item, status='not_found'))
+            continue
+
+        prefix = stored[key][id]
+        changes[id] = prefix
+        status = 'applied' if prefix == item.get('prefix', None) else 'mismatch'
+        results.append(dict(item, status=status, stored=prefix))
+
+    # nothing awaits in between, so readers see all of the batch or none of it
+    for id, prefix in changes.items():
+        update_live_prefix(id, prefix)
+
+    await acknowledge('prefix', results)
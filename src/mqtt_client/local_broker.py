@@ -0,0 +1,101 @@
+import asyncio
+from contextlib import asynccontextmanager
+from paho.mqtt.client import topic_matches_sub
+from asyncio_mqtt import MqttError
+
+# queued to a client's messages to make its reader fail like a dropped connection
+DISCONNECTED = object()
+
+class LocalMessage:
+    def __init__(self, topic, payload, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.retain = retain
+
+class LocalBroker:
+    """
+    In-process stand-in for an MQTT broker.
+
+    Clients from the same broker see each other's publishes (including their
+    own, like a real broker) and retained messages are replayed on subscribe.
+    `kill()` drops every connection and refuses new ones until `restart()`.
+    Used when `mqtt_url` is `local`, and by tests that need several clients.
+    """
+    def __init__(self):
+        self.clients = set()
+        self.retained = {}
+        self.up = True
+
+    def kill(self):
+        self.up = False
+        for client in list(self.clients):
+            client.disconnect()
+
+    def restart(self):
+        self.up = True
+
+    def client(self, *args, **kwargs):
+        return LocalClient(self)
+
+    def deliver(self, topic, payload, retain=False):
+        if not self.up:
+            raise MqttError('broker is down')
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for client in list(self.clients):
+            client.receive(LocalMessage(topic, payload))
+
+class LocalClient:
+    """
+    the subset of `asyncio_mqtt.Client` the bot relies on
+    """
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscriptions = set()
+        self.queue = asyncio.Queue()
+
+    async def __aenter__(self):
+        if not self.broker.up:
+            raise MqttError('connection refused, broker is down')
+        self.broker.clients.add(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.broker.clients.discard(self)
+
+    def disconnect(self):
+        self.broker.clients.discard(self)
+        self.queue.put_nowait(DISCONNECTED)
+
+    def receive(self, message):
+        if any(topic_matches_sub(sub, message.topic) for sub in self.subscriptions):
+            self.queue.put_nowait(message)
+
+    async def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+        for retained_topic, payload in self.broker.retained.items():
+            if topic_matches_sub(topic, retained_topic):
+                self.queue.put_nowait(LocalMessage(retained_topic, payload, retain=True))
+
+    async def unsubscribe(self, topic):
+        self.subscriptions.discard(topic)
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.broker.deliver(topic, payload or b'', retain)
+
+    @asynccontextmanager
+    async def unfiltered_messages(self):
+        async def messages():
+            while True:
+                message = await self.queue.get()
+                if message is DISCONNECTED:
+                    raise MqttError('disconnected')
+                yield message
+        yield messages()
+
+LOCAL_BROKER = LocalBroker()
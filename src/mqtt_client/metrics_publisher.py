@@ -0,0 +1,15 @@
+import asyncio
+from configuration import CONFIG
+from metrics import snapshot
+from . import publish
+
+METRICS_TOPIC = 'rrbot/metrics'
+METRICS_INTERVAL = CONFIG.get('metrics_interval', 60)
+
+async def metrics_task():
+    """
+    publish a metrics snapshot every `metrics_interval` seconds
+    """
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        await publish(METRICS_TOPIC, snapshot())
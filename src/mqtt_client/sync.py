@@ -0,0 +1,227 @@
+import asyncio, logging, sys, uuid
+from types import SimpleNamespace
+from sqlalchemy import Boolean, event, func, select, delete, or_, true
+from configuration import CONFIG
+from db import AsyncSession, Session, Servers, Channels, Users, Roles, ChangeLog
+from db.ChangeLog import state_columns
+from prefixes import update_live_prefix
+from permissions import update_live_permissions, remove_live_permissions
+from settings_store import SETTINGS
+from bot_utils import shard_arguments
+from metrics import increment, register_gauge
+from . import sync_callback, connect_callback, publish, SYNC_PREFIX
+import mqtt_client
+
+"""
+Versioned settings sync
+
+Every change to a servers/channels/roles/users row gets a sequence number
+in `change_log`, written in the same transaction by database triggers (see
+`db/ChangeLog.py`), so rows the config UIs write directly are numbered too.
+The sequence is the sync version, and the protocol is built on it:
+
+* `rrbot/sync/delta`: published after every commit,
+  `{"origin": ..., "changes": [{"seq", "table", "id", "deleted", "state"}]}`
+* `rrbot/sync/snapshot` (retained): `{"version": n, "tables": {table: {id: state}}}`
+  with only the rows that differ from the defaults, republished every
+  `sync_snapshot_interval` seconds by the leader process
+* `rrbot/sync/request` `{"since": n, "reply_to": name}`: the leader answers on
+  `rrbot/sync/replay/<name>` with up to `sync_replay_limit` changes after
+  `n` (`"more": true` when there are further pages), or `"reset": true` when
+  `n` is older than the retained log and the consumer should start over
+  from the snapshot
+
+A consumer starts from the snapshot (or version 0), applies deltas, and
+after a reconnect requests what it missed.  Bot processes have the database
+and catch up from `change_log` directly on every (re)connect.
+
+Changes are applied per row in sequence order: a change older than the last
+one applied to the same row is ignored, so duplicates, overlapping catch-ups
+and deltas arriving out of order are all harmless.
+"""
+
+ORIGIN = uuid.uuid4().hex
+TABLES = {
+    'servers': Servers,
+    'channels': Channels,
+    'users': Users,
+    'roles': Roles,
+}
+PREFIXED = ('servers', 'channels')
+
+DELTA_TOPIC = f'{SYNC_PREFIX}/delta'
+SNAPSHOT_TOPIC = f'{SYNC_PREFIX}/snapshot'
+REPLAY_PREFIX = f'{SYNC_PREFIX}/replay'
+
+SNAPSHOT_INTERVAL = CONFIG.get('sync_snapshot_interval', 300)
+REPLAY_LIMIT = CONFIG.get('sync_replay_limit', 1000)
+LOG_SIZE = CONFIG.get('sync_log_size', 100000)
+# catch-ups start this many versions early, for commits that finished out of order
+OVERLAP = 100
+
+# the unsharded process, or the one running shard 0, answers requests and
+# publishes snapshots
+_shards, _ = shard_arguments(sys.argv)
+LEADER = _shards is None or 0 in _shards
+
+# None until init_version(), the initial cache load covers everything before it
+VERSION = None
+ROW_VERSIONS = {}
+register_gauge('sync', lambda: {'version': VERSION, 'rows': len(ROW_VERSIONS)})
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+    changes = session.info.pop('sync_changes', None)
+    loop = mqtt_client.LOOP
+    if changes and loop is not None and not loop.is_closed():
+        # commits happen on the database executor, hop back onto the loop
+        loop.call_soon_threadsafe(asyncio.ensure_future, broadcast(changes))
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('sync_changes', None)
+
+async def broadcast(changes):
+    for change in changes:
+        _seen(change)
+    await publish(DELTA_TOPIC, {'origin': ORIGIN, 'changes': changes})
+
+def _seen(change):
+    """
+    record a change as applied, False if something newer already was
+    """
+    global VERSION
+    key = (change['table'], int(change['id']))
+    if ROW_VERSIONS.get(key, 0) >= change['seq']:
+        return False
+    ROW_VERSIONS[key] = change['seq']
+    VERSION = max(VERSION or 0, change['seq'])
+    return True
+
+def apply(change):
+    """
+    bring the live caches in line with one change
+    """
+    if not _seen(change):
+        return False
+    table, id = change['table'], int(change['id'])
+    if change['deleted']:
+        remove_live_permissions(table, id)
+        if table in PREFIXED:
+            update_live_prefix(id, None)
+    else:
+        record = SimpleNamespace(id=id, **change['state'])
+        update_live_permissions(table, record)
+        if table in PREFIXED:
+            update_live_prefix(id, record.prefix)
+    SETTINGS.invalidate(table, id)
+    increment('sync.applied')
+    return True
+
+def _latest(session):
+    return session.execute(select(func.max(ChangeLog.seq))).scalar() or 0
+
+def _oldest(session):
+    return session.execute(select(func.min(ChangeLog.seq))).scalar()
+
+def _since(session, since, limit):
+    query = select(ChangeLog).where(ChangeLog.seq > since).order_by(ChangeLog.seq).limit(limit)
+    return [row.as_change() for row in session.execute(query).scalars()]
+
+async def init_version():
+    """
+    start from the current version; call before the caches are loaded
+    """
+    global VERSION
+    async with AsyncSession(primary=True) as session:
+        latest = await session.run(_latest)
+    VERSION = max(VERSION or 0, latest)
+    return VERSION
+
+async def catch_up():
+    """
+    apply every committed change after the current version (less the overlap)
+    """
+    since = max((VERSION or 0) - OVERLAP, 0)
+    applied = 0
+    async with AsyncSession(primary=True) as session:
+        while True:
+            changes = await session.run(_since, since, REPLAY_LIMIT)
+            applied += sum(apply(change) for change in changes)
+            if len(changes) < REPLAY_LIMIT:
+                break
+            since = changes[-1]['seq']
+    if applied:
+        logging.info(f'Sync caught up {applied} changes, now at version {VERSION}')
+    return applied
+
+@connect_callback
+async def on_connect(client):
+    if VERSION is not None:
+        await catch_up()
+    if LEADER:
+        await publish_snapshot()
+
+@sync_callback('delta')
+async def receive_delta(data):
+    if data.get('origin') == ORIGIN:
+        return
+    for change in sorted(data.get('changes', ()), key=lambda change: change['seq']):
+        apply(change)
+
+def _replay(session, since):
+    oldest = _oldest(session)
+    latest = _latest(session)
+    if oldest is not None and since < oldest - 1:
+        return {'since': since, 'version': latest, 'reset': True}
+    changes = _since(session, since, REPLAY_LIMIT)
+    return {'since': since, 'version': latest, 'changes': changes, 'more': len(changes) == REPLAY_LIMIT}
+
+@sync_callback('request')
+async def replay(data):
+    if not LEADER or not data.get('reply_to'):
+        return
+    async with AsyncSession(primary=True) as session:
+        reply = await session.run(_replay, int(data.get('since', 0)))
+    await publish(f"{REPLAY_PREFIX}/{data['reply_to']}", reply)
+
+def _non_default(state):
+    return any(value not in (None, False, {}) for value in state.values())
+
+def _non_default_rows(model):
+    """
+    only the state columns of rows with anything set, filtered by the database;
+    most channels and roles exist only because the bot has seen them
+    """
+    columns = state_columns(model)
+    set_ = [column == true() if isinstance(column.type, Boolean) else column.isnot(None) for column in columns]
+    return select(model.id, *columns).where(or_(*set_))
+
+def _snapshot(session):
+    version = _latest(session)
+    tables = {}
+    for table, model in TABLES.items():
+        rows = {}
+        for row in session.execute(_non_default_rows(model)).mappings():
+            state = {key: value for key, value in row.items() if key != 'id'}
+            # an empty JSON object still makes it past the query
+            if _non_default(state):
+                rows[str(row['id'])] = state
+        tables[table] = rows
+
+    # keep the log bounded, consumers further behind start from this snapshot
+    session.execute(delete(ChangeLog).where(ChangeLog.seq <= version - LOG_SIZE))
+    session.commit()
+    return {'version': version, 'tables': tables}
+
+async def publish_snapshot():
+    async with AsyncSession(primary=True) as session:
+        snapshot = await session.run(_snapshot)
+    await publish(SNAPSHOT_TOPIC, snapshot, retain=True)
+    return snapshot['version']
+
+async def snapshot_task():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        if LEADER:
+            await publish_snapshot()
@@ -1,6 +1,7 @@
+import logging
 from . import setting_callback
 
 @setting_callback('test')
 async def testing(data):
-    print(data)
+    logging.debug(f'test message: {data}')
 
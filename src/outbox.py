@@ -0,0 +1,348 @@
+"""
+Outbound message scheduler
+
+Replies go through `OUTBOX.send(channel, content)` instead of `ctx.send` so
+bursts are paced before Discord has to push back:
+
+* one token bucket per channel plus a global one
+* a reply to a channel with nothing queued or in flight goes out right away
+  when both buckets have a token and nothing else is due
+* otherwise it queues; short plain-text replies queued for the same channel
+  are joined into one message, and replies queued behind one in flight wait
+  up to `coalesce_window` seconds after they were queued for company
+* MODERATION items go ahead of NORMAL ones, per channel and across channels
+* a 429 pauses the channel (or everything, for global limits) for the
+  reported retry time and the message is retried
+
+`await OUTBOX.send(...)` returns the sent message; when the reply can go out
+right away it is sent inline, with no task or loop round trip in between.
+`submit()` takes the same arguments and returns a future instead.
+"""
+
+import asyncio, heapq, logging
+from collections import deque
+from configuration import CONFIG
+from metrics import increment, observe, register_gauge
+
+MODERATION = 0
+NORMAL = 1
+
+MESSAGE_LIMIT = 2000
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = None
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        if now == self.stamp:
+            return
+        if self.stamp is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """
+        seconds until a token is available
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        self._refill(now)
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class Outgoing:
+    def __init__(self, content, kwargs, priority, created, future=None):
+        self.content = content
+        self.kwargs = kwargs
+        self.priority = priority
+        self.created = created
+        self.futures = [future] if future is not None else []
+        self.attempts = 0
+        self.settled = False
+        self.result = None
+        self.error = None
+
+    def absorb(self, content, future):
+        self.content = f'{self.content}\n{content}'
+        self.futures.append(future)
+
+    def settle(self, result=None, error=None):
+        self.settled = True
+        self.result = result
+        self.error = error
+        for future in self.futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+class ChannelQueue:
+    def __init__(self, channel, bucket):
+        self.channel = channel
+        self.bucket = bucket
+        self.items = deque()
+        self.entry = None
+        self.busy = False
+
+    def insert(self, item):
+        """
+        after everything of the same or higher priority, returns the index
+        """
+        index = len(self.items)
+        while index and self.items[index - 1].priority > item.priority:
+            index -= 1
+        self.items.insert(index, item)
+        return index
+
+    def mergeable(self, content, kwargs, priority):
+        """
+        the pending item a short reply can be folded into, if any
+        """
+        if kwargs or not isinstance(content, str):
+            return None
+        for item in reversed(self.items):
+            if item.priority < priority:
+                return None
+            if item.priority > priority:
+                continue
+            if item.kwargs or len(item.content) + len(content) + 1 > MESSAGE_LIMIT:
+                return None
+            return item
+        return None
+
+
+def _retry_after(err):
+    """
+    seconds to back off for a rate limited response, None for other errors
+    """
+    if getattr(err, 'status', None) != 429:
+        return None
+    retry = getattr(err, 'retry_after', None)
+    if retry is None:
+        headers = getattr(getattr(err, 'response', None), 'headers', None) or {}
+        retry = headers.get('Retry-After', headers.get('X-RateLimit-Reset-After', 1))
+    return float(retry)
+
+def _is_global(err):
+    headers = getattr(getattr(err, 'response', None), 'headers', None) or {}
+    return str(headers.get('X-RateLimit-Global', '')).lower() == 'true'
+
+async def _channel_send(channel, content, **kwargs):
+    return await channel.send(content, **kwargs)
+
+
+class Outbox:
+    def __init__(self, sender=None, channel_rate=1.0, channel_burst=5, global_rate=40.0, coalesce_window=0.2):
+        self.sender = sender or _channel_send
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.window = coalesce_window
+        self.channels = {}
+        self.waiting = []   # (not before, priority, seq, channel id)
+        self.ready = []     # (priority, seq, channel id)
+        self.seq = 0
+        self.in_flight = set()
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+    def __len__(self):
+        return sum(len(queue.items) for queue in self.channels.values())
+
+    def _queue_for(self, channel):
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = self.channels[channel.id] = ChannelQueue(channel, TokenBucket(self.channel_rate, self.channel_burst))
+        return queue
+
+    async def send(self, channel, content=None, priority=NORMAL, **kwargs):
+        self._ensure_worker()
+        now = self.loop.time()
+        queue = self._queue_for(channel)
+        if not self._idle(queue, now):
+            return await self.submit(channel, content, priority, **kwargs)
+
+        item = Outgoing(content, kwargs, priority, now)
+        self._take(queue, now)
+        await self._deliver(queue, item)
+        if not item.settled:
+            # rate limited and queued again, the worker finishes it
+            future = self.loop.create_future()
+            item.futures.append(future)
+            return await future
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def submit(self, channel, content=None, priority=NORMAL, **kwargs):
+        self._ensure_worker()
+        now = self.loop.time()
+        future = self.loop.create_future()
+        queue = self._queue_for(channel)
+
+        pending = queue.mergeable(content, kwargs, priority)
+        if pending is not None:
+            pending.absorb(content, future)
+            increment('outbox.coalesced')
+            return future
+
+        item = Outgoing(content, kwargs, priority, now, future)
+        if self._idle(queue, now):
+            self._send_now(queue, item, now)
+            return future
+
+        if queue.insert(item) == 0 and not queue.busy:
+            self._schedule(queue, now + queue.bucket.delay(now))
+        return future
+
+    def _idle(self, queue, now):
+        """
+        nothing to coalesce with, no token to wait for, and no other channel due first
+        """
+        if queue.items or queue.busy or self.ready:
+            return False
+        if self.waiting and self.waiting[0][0] <= now:
+            return False
+        return not self.bucket.delay(now) and not queue.bucket.delay(now)
+
+    async def drain(self, timeout=10):
+        """
+        wait for everything queued so far to be delivered
+        """
+        futures = [future for queue in self.channels.values() for item in queue.items for future in item.futures]
+        futures.extend(self.in_flight)
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self._run())
+
+    def _schedule(self, queue, not_before):
+        self.seq += 1
+        queue.entry = self.seq
+        heapq.heappush(self.waiting, (not_before, queue.items[0].priority, self.seq, queue.channel.id))
+        self.wakeup.set()
+
+    def _current(self, seq, id):
+        queue = self.channels.get(id)
+        return queue is not None and queue.entry == seq
+
+    def _prune(self, now):
+        idle = [id for id, queue in self.channels.items() if not queue.items and not queue.busy and queue.bucket.idle(now)]
+        for id in idle:
+            del self.channels[id]
+
+    async def _run(self):
+        while True:
+            now = self.loop.time()
+            while self.waiting and self.waiting[0][0] <= now:
+                _, priority, seq, id = heapq.heappop(self.waiting)
+                heapq.heappush(self.ready, (priority, seq, id))
+            while self.ready and not self._current(*self.ready[0][1:]):
+                heapq.heappop(self.ready)
+
+            if not self.ready:
+                if not self.waiting:
+                    self._prune(now)
+                timeout = self.waiting[0][0] - now if self.waiting else None
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            delay = self.bucket.delay(now)
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            _, seq, id = heapq.heappop(self.ready)
+            queue = self.channels[id]
+            delay = queue.bucket.delay(now)
+            if delay:
+                self._schedule(queue, now + delay)
+                continue
+
+            queue.entry = None
+            self._send_now(queue, queue.items.popleft(), now)
+
+    def _take(self, queue, now):
+        self.bucket.take(now)
+        queue.bucket.take(now)
+        queue.busy = True
+
+    def _send_now(self, queue, item, now):
+        self._take(queue, now)
+        task = self.loop.create_task(self._deliver(queue, item))
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+
+    async def _deliver(self, queue, item):
+        try:
+            result = await self.sender(queue.channel, item.content, **item.kwargs)
+        except Exception as err:
+            retry_after = _retry_after(err)
+            item.attempts += 1
+            if retry_after is None or item.attempts >= MAX_ATTEMPTS:
+                logging.warning(f'Dropping message for channel {queue.channel.id}: {err!r}')
+                increment('outbox.failed')
+                item.settle(error=err)
+            else:
+                increment('outbox.rate_limited')
+                bucket = self.bucket if _is_global(err) else queue.bucket
+                bucket.pause(self.loop.time(), retry_after)
+                queue.items.appendleft(item)
+        else:
+            increment('outbox.sent')
+            observe('outbox.latency', self.loop.time() - item.created)
+            item.settle(result)
+        finally:
+            queue.busy = False
+            if queue.items:
+                now = self.loop.time()
+                head = queue.items[0]
+                self._schedule(queue, max(head.created + self.window, now + queue.bucket.delay(now)))
+
+    def stats(self):
+        return {
+            'queued': len(self),
+            'channels': len(self.channels),
+            'in_flight': len(self.in_flight),
+        }
+
+
+OUTBOX = Outbox(
+    channel_rate=CONFIG.get('outbox_channel_rate', 1.0),
+    channel_burst=CONFIG.get('outbox_channel_burst', 5),
+    global_rate=CONFIG.get('outbox_global_rate', 40.0),
+    coalesce_window=CONFIG.get('outbox_coalesce_window', 0.2)
+)
+register_gauge('outbox', OUTBOX.stats)
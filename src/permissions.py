@@ -0,0 +1,71 @@
+"""
+In-memory permission index
+
+Mirrors the moderator/muted/voiced columns of the `users`, `roles`,
+`channels` and `servers` tables so permission checks and the message gate
+(see `gate.py`) are answered without any I/O.  Only rows with at least
+one flag set are kept; everything else is implicitly "no flags".
+
+The index is loaded once at boot (see `bot_utils.load_permissions`) and then
+kept current by the model listeners and the `permissions` MQTT setting.
+"""
+
+MODERATOR = 1
+MUTED = 2
+VOICED = 4
+
+PERMISSIONS = {
+    'users': {},
+    'roles': {},
+    'channels': {},
+    'servers': {},
+}
+
+def flags_of(record):
+    flags = 0
+    if getattr(record, 'moderator', False):
+        flags |= MODERATOR
+    if getattr(record, 'muted', False):
+        flags |= MUTED
+    if getattr(record, 'voiced', False):
+        flags |= VOICED
+    return flags
+
+def set_live_flags(table, id, flags):
+    index = PERMISSIONS[table]
+    if flags:
+        index[id] = flags
+    else:
+        index.pop(id, None)
+
+def update_live_permissions(table, record):
+    set_live_flags(table, record.id, flags_of(record))
+
+def remove_live_permissions(table, id):
+    PERMISSIONS[table].pop(id, None)
+
+def load_live_permissions(table, records):
+    index = PERMISSIONS[table]
+    index.clear()
+    for record in records:
+        flags = flags_of(record)
+        if flags:
+            index[record.id] = flags
+
+def _has_flag(flag, user_id, role_ids):
+    if PERMISSIONS['users'].get(user_id, 0) & flag:
+        return True
+    roles = PERMISSIONS['roles']
+    for role_id in role_ids:
+        if roles.get(role_id, 0) & flag:
+            return True
+    return False
+
+def is_moderator(user_id, role_ids=()):
+    return _has_flag(MODERATOR, user_id, role_ids)
+
+def is_muted(user_id, role_ids=()):
+    return _has_flag(MUTED, user_id, role_ids)
+
+def is_voiced(user_id, role_ids=()):
+    return _has_flag(VOICED, user_id, role_ids)
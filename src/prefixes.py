@@ -0,0 +1,141 @@
+"""
+Command prefix resolution
+
+Prefix overrides are looked up lazily and kept in a bounded LRU cache with a
+TTL.  Ids without an override are cached as well (as `None`) so quiet
+channels do not go back to the database for every message.
+
+Cache misses are not queried one by one: they are collected for the rest of
+the current loop iteration and resolved with a single lookup per table.
+"""
+import asyncio, time
+from collections import OrderedDict
+from configuration import CONFIG
+from metrics import register_gauge
+
+MISSING = object()
+
+class PrefixCache:
+    """
+    LRU mapping of channel/server id -> prefix override (None for "no override")
+    """
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def peek(self, id):
+        entry = self.entries.get(id)
+        if entry is None or entry[1] < time.monotonic():
+            return MISSING
+        return entry[0]
+
+    def get(self, id):
+        prefix = self.peek(id)
+        if prefix is MISSING:
+            self.misses += 1
+            self.entries.pop(id, None)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(id)
+        return prefix
+
+    def set(self, id, prefix):
+        self.entries[id] = (prefix, time.monotonic() + self.ttl)
+        self.entries.move_to_end(id)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, id):
+        self.entries.pop(id, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+class PrefixResolver:
+    """
+    Batches cache misses into one `loader(channel_ids, server_ids)` call.
+    The loader returns {id: prefix} for the ids that have an override.
+    """
+    def __init__(self, cache, loader):
+        self.cache = cache
+        self.loader = loader
+        self.pending = {}
+        self.flush_task = None
+
+    def _request(self, id, kind):
+        entry = self.pending.get(id)
+        if entry is None:
+            entry = self.pending[id] = (kind, asyncio.get_running_loop().create_future())
+            if self.flush_task is None:
+                self.flush_task = asyncio.ensure_future(self._flush())
+        return entry[1]
+
+    async def _flush(self):
+        # let every message of this loop iteration register its misses first
+        await asyncio.sleep(0)
+        pending, self.pending = self.pending, {}
+        self.flush_task = None
+
+        channel_ids = [id for id, (kind, _) in pending.items() if kind == 'channel']
+        server_ids = [id for id, (kind, _) in pending.items() if kind == 'server']
+        try:
+            found = await self.loader(channel_ids, server_ids)
+        except Exception as err:
+            for _, future in pending.values():
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for id, (_, future) in pending.items():
+            prefix = found.get(id)
+            # a live update that landed while we were loading is newer
+            if self.cache.peek(id) is MISSING:
+                self.cache.set(id, prefix)
+            else:
+                prefix = self.cache.peek(id)
+            if not future.done():
+                future.set_result(prefix)
+
+    async def resolve(self, channel_id, server_id=None):
+        """
+        the override for a channel, falling back on its server; None if neither has one
+        """
+        keys = [(channel_id, 'channel')]
+        if server_id is not None:
+            keys.append((server_id, 'server'))
+
+        prefixes = []
+        waiting = []
+        for id, kind in keys:
+            prefix = self.cache.get(id)
+            if prefix is MISSING:
+                prefix = self._request(id, kind)
+                waiting.append(prefix)
+            prefixes.append(prefix)
+
+        if waiting:
+            # the futures are shared with other callers, a cancelled caller
+            # must not cancel them for everyone
+            await asyncio.gather(*map(asyncio.shield, waiting))
+            prefixes = [p.result() if asyncio.isfuture(p) else p for p in prefixes]
+
+        return next((p for p in prefixes if p is not None), None)
+
+PREFIX_CACHE = PrefixCache(
+    CONFIG.get('prefix_cache_size', 10000),
+    CONFIG.get('prefix_cache_ttl', 600)
+)
+
+def update_live_prefix(id, prefix):
+    PREFIX_CACHE.set(id, prefix)
+
+register_gauge('prefix_cache', PREFIX_CACHE.stats)
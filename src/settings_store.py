@@ -0,0 +1,192 @@
+"""
+Settings store over the `jsondata` columns
+
+Servers, channels, roles and users each carry a free-form JSON blob.  This
+module gives it a key/value API with dotted paths (`automod.words`):
+
+* reads go through an in-memory LRU cache, loading a blob at most once
+* writes change the cached copy immediately and are remembered as
+  operations; every `interval` seconds (and at shutdown) the pending
+  operations are replayed onto freshly read rows and committed together,
+  so concurrent edits to other keys of the same blob are not lost
+* after a flush the changed (table, id) pairs are published on
+  `rrbot/settings/jsondata` so other processes drop their copies
+
+Keys can be declared with `define()` to get a type check and a default.
+Anything derived from a blob can `watch()` for local writes and remote
+invalidations to know when to rebuild.
+"""
+import asyncio, copy, logging
+from collections import OrderedDict
+from configuration import CONFIG
+from db import AsyncSession, Servers, Channels, Roles, Users
+
+TABLES = {
+    'servers': Servers,
+    'channels': Channels,
+    'roles': Roles,
+    'users': Users,
+}
+
+DELETE = object()
+
+def _split(path):
+    return path.split('.') if path else []
+
+def get_path(data, path, default=None):
+    for key in _split(path):
+        if not isinstance(data, dict) or key not in data:
+            return default
+        data = data[key]
+    return data
+
+def set_path(data, path, value):
+    keys = _split(path)
+    for key in keys[:-1]:
+        child = data.get(key)
+        if not isinstance(child, dict):
+            child = data[key] = {}
+        data = child
+    if value is DELETE:
+        data.pop(keys[-1], None)
+    else:
+        data[keys[-1]] = value
+
+class SettingsStore:
+    def __init__(self, size=10000, interval=5.0):
+        self.size = size
+        self.interval = interval
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.schema = {}
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.publisher = None
+        self.watchers = []
+
+    def define(self, table, path, type_, default=None):
+        self.schema[(table, path)] = (type_, default)
+
+    def watch(self, fn):
+        """
+        call `fn(table, id)` whenever a blob changes here or is invalidated
+        """
+        self.watchers.append(fn)
+
+    def _notify(self, table, id):
+        for fn in self.watchers:
+            fn(table, id)
+
+    def _lookup(self, session, table, ids):
+        model = TABLES[table]
+        return session.query(model).filter(model.id.in_(ids)).all()
+
+    async def _load(self, table, id):
+        key = (table, id)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        async with AsyncSession() as session:
+            found = await session.run(self._lookup, table, [id])
+        data = copy.deepcopy(found[0].jsondata or {}) if found else {}
+        # replay writes that were made while the row was loading
+        for path, value in self.pending.get(key, ()):
+            set_path(data, path, value)
+        self.cache[key] = data
+        self._evict()
+        return data
+
+    def _evict(self):
+        while len(self.cache) > self.size:
+            key = next((k for k in self.cache if k not in self.pending), None)
+            if key is None:
+                return
+            del self.cache[key]
+
+    async def get(self, table, id, path=None, default=None):
+        _, schema_default = self.schema.get((table, path), (None, None))
+        data = await self._load(table, id)
+        return copy.deepcopy(get_path(data, path, default if default is not None else schema_default))
+
+    async def set(self, table, id, path, value):
+        type_, _ = self.schema.get((table, path), (None, None))
+        if type_ is not None and value is not DELETE and not isinstance(value, type_):
+            raise TypeError(f'{table}.{path} expects {type_.__name__}, not {type(value).__name__}')
+
+        data = await self._load(table, id)
+        value = copy.deepcopy(value)
+        set_path(data, path, value)
+        self.pending.setdefault((table, id), []).append((path, value))
+        self._notify(table, id)
+        if self.timer is None:
+            loop = asyncio.get_running_loop()
+            self.timer = loop.call_later(self.interval, lambda: asyncio.ensure_future(self.flush()))
+
+    async def delete(self, table, id, path):
+        await self.set(table, id, path, DELETE)
+
+    def invalidate(self, table, id):
+        if (table, id) not in self.pending:
+            self.cache.pop((table, id), None)
+            self._notify(table, id)
+
+    def _apply(self, session, pending):
+        by_table = {}
+        for (table, id), ops in pending.items():
+            by_table.setdefault(table, {})[id] = ops
+
+        for table, changes in by_table.items():
+            model = TABLES[table]
+            rows = {row.id: row for row in self._lookup(session, table, list(changes))}
+            for id, ops in changes.items():
+                row = rows.get(id)
+                if row is None:
+                    row = model(id=id)
+                    session.add(row)
+                data = copy.deepcopy(row.jsondata or {})
+                for path, value in ops:
+                    set_path(data, path, value)
+                row.jsondata = data
+        session.commit()
+
+    async def flush(self):
+        """
+        write every pending change in one transaction
+        """
+        async with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            # stays pending until committed: the cached copies must not be
+            # evicted or reloaded from rows that do not have these writes yet
+            pending = {key: list(ops) for key, ops in self.pending.items()}
+            if not pending:
+                return 0
+
+            try:
+                # replayed onto current rows, a lagging replica would lose edits
+                async with AsyncSession(primary=True) as session:
+                    await session.run(self._apply, pending)
+            except Exception:
+                logging.exception(f'Failed to flush {len(pending)} settings, will retry')
+                loop = asyncio.get_running_loop()
+                self.timer = loop.call_later(self.interval, lambda: asyncio.ensure_future(self.flush()))
+                return 0
+
+            for key, ops in pending.items():
+                # writes made during the commit stay pending for the next flush
+                remaining = self.pending[key][len(ops):]
+                if remaining:
+                    self.pending[key] = remaining
+                else:
+                    del self.pending[key]
+
+            if self.publisher is not None:
+                await self.publisher([{'table': table, 'id': id} for table, id in pending])
+            return len(pending)
+
+SETTINGS = SettingsStore(
+    size = CONFIG.get('settings_cache_size', 10000),
+    interval = CONFIG.get('settings_flush_interval', 5)
+)
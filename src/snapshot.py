@@ -0,0 +1,189 @@
+"""
+Warm-start cache snapshot
+
+The permission index and the prefix cache are written to a small binary file
+periodically and at shutdown.  On boot the file is memory-mapped and loaded
+back, then only rows whose `updated_at` is newer than the snapshot are read
+from the database.  A missing, stale, corrupt or foreign-version file falls
+back to the regular full load.
+
+On MySQL `updated_at` is maintained by the server (`ON UPDATE
+CURRENT_TIMESTAMP`), so edits made by the config UIs while the bot was down
+are caught up on as well, and every connection reads it in UTC.
+
+Layout, little endian:
+
+    header   magic[8] version:u16 written_at:f64 permissions:u32 prefixes:u32 crc32:u32
+    records  permissions x (table:u8 id:u64 flags:u8)
+             prefixes    x (id:u64 length:u8 prefix[40])   length 255 = no override
+
+Row deletions are not caught up on; the bot never deletes these rows and
+the prefix cache TTL bounds how long anything stale can live.
+"""
+import asyncio, logging, mmap, os, struct, sys, tempfile, time, zlib
+from datetime import datetime, timedelta
+from configuration import CONFIG, ROOT
+from db import AsyncSession, run_sync, Servers, Channels, Roles, Users
+from permissions import PERMISSIONS, update_live_permissions
+from prefixes import PREFIX_CACHE, update_live_prefix
+
+MAGIC = b'RRBOTSNP'
+VERSION = 1
+HEADER = struct.Struct('<8sHdIII')
+PERMISSION = struct.Struct('<BQB')
+PREFIX = struct.Struct('<QB40s')
+NO_PREFIX = 255
+
+TABLES = (
+    ('users', Users),
+    ('roles', Roles),
+    ('channels', Channels),
+    ('servers', Servers),
+)
+PREFIXED = ('servers', 'channels')
+
+# relative paths are taken from the repository root
+SNAPSHOT_PATH = os.path.join(ROOT, CONFIG.get('snapshot_path', '.data/cache.snapshot'))
+# sharded fleets run one process per shard range, keep their snapshots apart
+if '--shards' in sys.argv:
+    SNAPSHOT_PATH += '-{}'.format(sys.argv[sys.argv.index('--shards') + 1])
+SNAPSHOT_INTERVAL = CONFIG.get('snapshot_interval', 300)
+SNAPSHOT_MAX_AGE = CONFIG.get('snapshot_max_age', 86400)
+
+# allowance for clock differences between the bot and the database
+CLOCK_SKEW = 60
+
+# set once the caches were loaded; before that a save would record empty
+# caches as if they were current and the next warm start would trust them
+LOADED = False
+
+class SnapshotError(Exception):
+    pass
+
+def encode():
+    permissions = bytearray()
+    for code, (table, _) in enumerate(TABLES):
+        for id, flags in PERMISSIONS[table].items():
+            permissions += PERMISSION.pack(code, id, flags)
+
+    prefixes = bytearray()
+    count = 0
+    now = time.monotonic()
+    for id, (prefix, expires) in list(PREFIX_CACHE.entries.items()):
+        if expires < now:
+            continue
+        raw = prefix.encode() if prefix is not None else b''
+        prefixes += PREFIX.pack(id, len(raw) if prefix is not None else NO_PREFIX, raw)
+        count += 1
+
+    body = bytes(permissions + prefixes)
+    header = HEADER.pack(MAGIC, VERSION, time.time(), len(permissions) // PERMISSION.size, count, zlib.crc32(body))
+    return header + body
+
+def decode(buffer, max_age=SNAPSHOT_MAX_AGE):
+    """
+    validate and parse a snapshot; returns (written_at, permissions, prefixes)
+    """
+    if len(buffer) < HEADER.size:
+        raise SnapshotError('truncated header')
+    magic, version, written_at, n_permissions, n_prefixes, crc = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != VERSION:
+        raise SnapshotError(f'unsupported snapshot {magic!r} v{version}')
+    if time.time() - written_at > max_age:
+        raise SnapshotError('snapshot is stale')
+
+    split = n_permissions * PERMISSION.size
+    # views are released explicitly so the mapping can be closed, even on errors
+    with memoryview(buffer)[HEADER.size:] as body:
+        if len(body) != split + n_prefixes * PREFIX.size:
+            raise SnapshotError('record counts do not match the file size')
+        if zlib.crc32(body) != crc:
+            raise SnapshotError('checksum mismatch')
+
+        with body[:split] as records:
+            permissions = list(PERMISSION.iter_unpack(records))
+        with body[split:] as records:
+            prefixes = [
+                (id, None if length == NO_PREFIX else raw[:length].decode())
+                for id, length, raw in PREFIX.iter_unpack(records)
+            ]
+    return written_at, permissions, prefixes
+
+def read(path=SNAPSHOT_PATH):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return decode(mapped)
+
+def restore(permissions, prefixes):
+    indexes = [PERMISSIONS[table] for table, _ in TABLES]
+    for index in indexes:
+        index.clear()
+    for code, id, flags in permissions:
+        indexes[code][id] = flags
+    for id, prefix in prefixes:
+        PREFIX_CACHE.set(id, prefix)
+
+def _changed(session, model, since):
+    return session.query(model).filter(model.updated_at >= since).all()
+
+async def catch_up(written_at):
+    since = datetime.utcfromtimestamp(written_at) - timedelta(seconds=CLOCK_SKEW)
+    changed = 0
+    async with AsyncSession(primary=True) as session:
+        for table, model in TABLES:
+            for record in await session.run(_changed, model, since):
+                update_live_permissions(table, record)
+                if table in PREFIXED:
+                    update_live_prefix(record.id, record.prefix)
+                changed += 1
+    return changed
+
+async def warm_start(full_load, path=SNAPSHOT_PATH):
+    """
+    restore from the snapshot and catch up, or run `full_load()` when that is not possible
+    """
+    try:
+        written_at, permissions, prefixes = await run_sync(read, path)
+    except (OSError, ValueError, SnapshotError, struct.error) as err:
+        logging.info(f'No usable cache snapshot ({err}), loading from the database')
+        await full_load()
+        _loaded()
+        return False
+
+    restore(permissions, prefixes)
+    changed = await catch_up(written_at)
+    _loaded()
+    logging.info(f'Warm start from snapshot, {changed} rows caught up')
+    return True
+
+def _loaded():
+    global LOADED
+    LOADED = True
+
+async def save(path=SNAPSHOT_PATH):
+    if not LOADED:
+        logging.info('Caches were never loaded, not saving a cache snapshot')
+        return
+    # encode on the loop, the caches are only safe to walk there
+    data = encode()
+
+    def _write():
+        # a temporary name of our own, another process may be saving next to us
+        fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path), suffix='.tmp', dir=os.path.dirname(path) or '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    try:
+        await run_sync(_write)
+    except OSError:
+        logging.exception(f'Could not write cache snapshot to {path}')
+
+async def snapshot_task():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        await save()
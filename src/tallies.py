@@ -0,0 +1,79 @@
+"""
+Rolling warning counters
+
+Warnings per (server, user) are kept in memory as hourly buckets, so
+"N warnings in the last X hours" is a sum over at most `WINDOW_HOURS`
+small integers, with no database involved.  The buckets mirror the
+`warning_tallies` table, which is written in the same transaction as the
+warnings themselves and read back at startup (see `infractions.py`).
+Buckets that fall out of the window are pruned as new ones are added and,
+for users who stopped collecting warnings, by `prune()` on a timer.
+
+Windows are hour aligned: "the last 24 hours" means the current hour plus
+the 23 before it.
+"""
+import time
+from datetime import timezone
+from configuration import CONFIG
+
+BUCKET_SECONDS = 3600
+
+# the longest window any moderation policy may ask about
+WINDOW_HOURS = CONFIG.get('warning_tally_window', 168)
+
+TALLIES = {}
+
+def bucket_of(when):
+    """
+    bucket of a naive UTC datetime
+    """
+    return int(when.replace(tzinfo=timezone.utc).timestamp() // BUCKET_SECONDS)
+
+def current_bucket():
+    return int(time.time() // BUCKET_SECONDS)
+
+def _prune(buckets, now):
+    oldest = now - WINDOW_HOURS
+    for bucket in [b for b in buckets if b <= oldest]:
+        del buckets[bucket]
+
+def prune(tallies=None):
+    """
+    drop buckets outside the window, and users left without any
+    """
+    tallies = TALLIES if tallies is None else tallies
+    now = current_bucket()
+    for key in list(tallies):
+        _prune(tallies[key], now)
+        if not tallies[key]:
+            del tallies[key]
+
+def add(server_id, user_id, bucket, count=1, tallies=None):
+    tallies = TALLIES if tallies is None else tallies
+    buckets = tallies.get((server_id, user_id))
+    if buckets is None:
+        buckets = tallies[(server_id, user_id)] = {}
+    if bucket not in buckets:
+        _prune(buckets, current_bucket())
+    buckets[bucket] = buckets.get(bucket, 0) + count
+
+def apply(counts):
+    """
+    add a {(server_id, user_id, bucket): count} batch, once it is committed
+    """
+    for (server_id, user_id, bucket), count in counts.items():
+        add(server_id, user_id, bucket, count)
+
+def warnings_within(server_id, user_id, hours=24):
+    buckets = TALLIES.get((server_id, user_id))
+    if not buckets:
+        return 0
+    start = current_bucket() - min(hours, WINDOW_HOURS) + 1
+    return sum(count for bucket, count in buckets.items() if bucket >= start)
+
+def exceeds(server_id, user_id, threshold, hours=24):
+    return warnings_within(server_id, user_id, hours) >= threshold
+
+def replace(tallies):
+    TALLIES.clear()
+    TALLIES.update(tallies)
@@ -3,12 +3,13 @@
 use_docker_database=0
 use_console=0
 run_tests=0
-while getopts "Dct" opt
+while getopts "Dctb" opt
 do
     case $opt in
     (D) use_docker_database=1 ;;
     (c) use_console=1 ;;
-    (t) echo "Test harness not yet established." && exit 1 ;;
+    (t) py3 -m pytest -q tests ; exit $? ;;
+    (b) py3 tests/benchmarks.py --baseline tests/bench_baseline.json ; exit $? ;;
     (*) printf "Illegal option '-%s'\n" "$opt" && exit 1 ;;
     esac
 done
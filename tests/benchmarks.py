@@ -0,0 +1,233 @@
+"""
+Offline benchmarks for the message hot path.
+
+Runs against fake discord objects and the test configuration (in-memory
+SQLite, in-process MQTT), so neither Discord nor MySQL is needed:
+
+    python tests/benchmarks.py --output bench_output.json --baseline tests/bench_baseline.json
+
+Each scenario is measured at several scales (guilds x channels x roles) and
+the best of `--rounds` runs is kept; the output maps `<scale>/<scenario>` to
+throughput and p50/p99 latency.
+With `--baseline` the run fails when a scenario regressed by more than
+`--tolerance` against the stored numbers.  `--update-baseline` rewrites it.
+"""
+import argparse, asyncio, json, os, platform, random, sys, time
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'src'))
+sys.path.insert(0, TESTS)
+
+from fakes import FakeGuild, FakeMember, FakeMessage, FakeContext
+
+SCALES = {
+    'small': (10, 10, 10),
+    'medium': (100, 20, 20),
+    'large': (1000, 20, 30),
+}
+
+def summarize(timings, elapsed=None):
+    timings = sorted(timings)
+    n = len(timings)
+    elapsed = elapsed if elapsed is not None else sum(timings)
+    return {
+        'ops': n,
+        'ops_per_sec': n / elapsed if elapsed else 0.0,
+        'p50_ms': timings[n // 2] * 1000 if n else 0.0,
+        'p99_ms': timings[min(n - 1, int(n * 0.99))] * 1000 if n else 0.0,
+    }
+
+async def timed(fn, args_list):
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        await fn(*args)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def timed_sync(fn, args_list):
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+class World:
+    """
+    a seeded database plus the matching fake guilds
+    """
+    def __init__(self, guilds, channels, roles, seed=0):
+        rng = random.Random(seed)
+        self.guilds = [FakeGuild(channels=channels, roles=roles) for _ in range(guilds)]
+        self.members = []
+        self.messages = []
+        for guild in self.guilds:
+            for _ in range(5):
+                member = FakeMember(roles=rng.sample(guild.roles, min(len(guild.roles), 5)))
+                self.members.append(member)
+                channel = rng.choice(guild.channels)
+                self.messages.append(FakeMessage(member, channel, guild, '=ping'))
+        self.rng = rng
+
+    async def seed(self):
+        import db
+        from bot_utils import load_permissions
+        from prefixes import PREFIX_CACHE
+
+        db.Base.metadata.drop_all(db.engine)
+        db.Base.metadata.create_all(db.engine)
+        async with db.AsyncSession() as session:
+            await db.ensure_servers(session, [g.id for g in self.guilds])
+            await db.ensure_channels(session, [c.id for g in self.guilds for c in g.channels])
+            await db.ensure_roles(session, [r.id for g in self.guilds for r in g.roles])
+
+            def flag(session):
+                for guild in self.guilds[::3]:
+                    session.get(db.Servers, guild.id).prefix = '!'
+                    session.get(db.Roles, guild.roles[0].id).moderator = True
+                    session.get(db.Channels, guild.channels[0].id).prefix = '?'
+                session.commit()
+            await session.run(flag)
+
+        PREFIX_CACHE.clear()
+        await load_permissions()
+
+async def bench_scale(name, guilds, channels, roles, results):
+    import bot_utils, db, gate, mqtt_client
+    from commands.admins import AdminCog
+    from commands.ping import ping
+    from prefixes import PREFIX_CACHE
+
+    world = World(guilds, channels, roles)
+    await world.seed()
+    messages = world.messages
+
+    def record(scenario, summary):
+        results[f'{name}/{scenario}'] = summary
+
+    PREFIX_CACHE.clear()
+    record('prefix_operator_cold', await timed(bot_utils.prefix_operator, [(None, m) for m in messages]))
+    record('prefix_operator_warm', await timed(bot_utils.prefix_operator, [(None, m) for m in messages]))
+    record('is_server_moderator', timed_sync(bot_utils._is_server_moderator, [(m,) for m in world.members]))
+    record('gate', timed_sync(gate.allow_message, [(m,) for m in messages]))
+
+    async def ensure_guild(guild):
+        async with db.AsyncSession() as session:
+            await db.ensure_channels(session, [c.id for c in guild.channels])
+            await db.ensure_roles(session, [r.id for r in guild.roles])
+    record('ensure_existing', await timed(ensure_guild, [(g,) for g in world.guilds]))
+    fresh = [FakeGuild(channels=channels, roles=roles) for _ in range(min(guilds, 100))]
+    record('ensure_new', await timed(ensure_guild, [(g,) for g in fresh]))
+
+    handled = []
+    async def sink(data):
+        handled.append(data)
+    topic = 'rrbot/settings/benchmark'
+    mqtt_client.DISPATCH[topic] = [sink]
+    mqtt_client.DISPATCHER.start()
+
+    class Message:
+        def __init__(self, i):
+            self.topic = topic
+            self.payload = json.dumps({'i': i}).encode()
+    payloads = [(Message(i),) for i in range(len(messages))]
+    start = time.perf_counter()
+    summary = await timed(mqtt_client.dispatch_message, payloads)
+    while len(handled) < len(payloads):
+        await asyncio.sleep(0)
+    summary['ops_per_sec'] = len(payloads) / (time.perf_counter() - start)
+    record('dispatch_message', summary)
+
+    async def invoke_ping(message):
+        if gate.allow_message(message):
+            await bot_utils.prefix_operator(None, message)
+            await ping.callback(FakeContext(message))
+    record('command_ping', await timed(invoke_ping, [(m,) for m in messages]))
+
+    cog = AdminCog(None)
+    async def invoke_prefix(message):
+        if gate.allow_message(message):
+            await bot_utils.prefix_operator(None, message)
+            await AdminCog.prefix.callback(cog, FakeContext(message), '$')
+    record('command_prefix', await timed(invoke_prefix, [(m,) for m in messages[:200]]))
+
+def best_of(runs):
+    """
+    per scenario, the best numbers seen over several rounds; filters out
+    one-off hiccups from the rest of the machine
+    """
+    best = {}
+    for results in runs:
+        for key, summary in results.items():
+            if key not in best:
+                best[key] = dict(summary)
+                continue
+            best[key]['ops_per_sec'] = max(best[key]['ops_per_sec'], summary['ops_per_sec'])
+            best[key]['p50_ms'] = min(best[key]['p50_ms'], summary['p50_ms'])
+            best[key]['p99_ms'] = min(best[key]['p99_ms'], summary['p99_ms'])
+    return best
+
+async def run(scales, rounds=1):
+    import mqtt_client
+    runs = []
+    for _ in range(rounds):
+        results = {}
+        for name in scales:
+            await bench_scale(name, *SCALES[name], results)
+        runs.append(results)
+    mqtt_client.DISPATCHER.stop()
+    return best_of(runs)
+
+def compare(results, baseline, tolerance, min_delta_ms=0.01):
+    """
+    scenarios that got slower than `baseline` by more than `tolerance` (a fraction);
+    latency changes below `min_delta_ms` are timer noise and never count
+    """
+    regressions = []
+    for key, base in baseline.items():
+        current = results.get(key)
+        if current is None:
+            continue
+        slower = current['p50_ms'] - base['p50_ms']
+        if slower > min_delta_ms and current['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p50 {current['p50_ms']:.3f}ms vs {base['p50_ms']:.3f}ms")
+        if current['ops_per_sec'] < base['ops_per_sec'] * (1 - tolerance):
+            regressions.append(f"{key}: {current['ops_per_sec']:.0f} ops/s vs {base['ops_per_sec']:.0f} ops/s")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default=','.join(SCALES), help='comma separated, from: ' + ', '.join(SCALES))
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run(args.scales.split(','), args.rounds))
+    report = {
+        'meta': {'python': platform.python_version(), 'machine': platform.machine(), 'time': time.time()},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    for key, summary in sorted(results.items()):
+        print(f"{key:40} {summary['ops_per_sec']:>12.0f} ops/s  p50 {summary['p50_ms']:8.3f}ms  p99 {summary['p99_ms']:8.3f}ms")
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+Configuration used by the test suite and benchmarks.
+
+Shadows `src/configuration.py`: nothing talks to Discord, the database is an
+in-memory SQLite one and MQTT goes through the in-process broker.
+Set RRBOT_TEST_DATABASE_URL to run against a real database instead.
+"""
+import os
+from pathlib import Path
+
+CONFIG = {
+    'database_url': os.environ.get('RRBOT_TEST_DATABASE_URL', 'sqlite://'),
+    'database_workers': 4,
+    'database_chunk_size': 1000,
+    'reconcile_batch_size': 50,
+    'reconcile_batch_pause': 0,
+    'warnings_batch_size': 100,
+    'warnings_flush_interval': 2,
+    'warning_tally_window': 168,
+    'settings_cache_size': 10000,
+    'settings_flush_interval': 5,
+    'prefix_cache_size': 10000,
+    'prefix_cache_ttl': 600,
+    'snapshot_interval': 0,
+    'mqtt_url': 'local',
+    'mqtt_workers': 4,
+    'mqtt_queue_size': 100,
+    'mqtt_overflow': 'block',
+    'metrics_interval': 0,
+    'sync_snapshot_interval': 0,
+    # fake channels have no rate limits, keep pacing out of command timings
+    'outbox_channel_rate': 1000000,
+    'outbox_channel_burst': 1000000,
+    'outbox_global_rate': 1000000,
+    'discord_client_id': 1234567890,
+    'discord_client_secret': 'not a token',
+    'default_command_prefix': '=',
+    'admins': [1],
+    'mod_roles': [],
+    'log_level': 'WARNING',
+}
+
+CONFIG['rootpath'] = ROOT     = Path(__file__).parent.absolute().parent
+CONFIG['srcpath']  = SRC      = os.path.join(ROOT, 'src')
+
+DB_URL = CONFIG['database_url']
+MQTT_URL = CONFIG['mqtt_url']
+TOKEN = CONFIG['discord_client_secret']
+PREFIX = CONFIG['default_command_prefix'].lower()
+ADMINS = CONFIG['admins']
+LOG_LEVEL = CONFIG['log_level']
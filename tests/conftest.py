@@ -0,0 +1,7 @@
+import os, sys
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+
+# the test configuration must win over a developer's src/configuration.py
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'src'))
+sys.path.insert(0, TESTS)
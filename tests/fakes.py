@@ -0,0 +1,94 @@
+"""
+Stand-ins for the discord.py objects the bot touches, enough to drive the
+message path without a gateway connection.
+"""
+import itertools
+
+_ids = itertools.count(10 ** 17)
+
+def snowflake():
+    return next(_ids)
+
+class FakeRole:
+    def __init__(self, id=None):
+        self.id = id or snowflake()
+
+class FakeChannel:
+    def __init__(self, id=None):
+        self.id = id or snowflake()
+        self.mention = f'<#{self.id}>'
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+class FakeGuild:
+    def __init__(self, id=None, channels=0, roles=0):
+        self.id = id or snowflake()
+        self.channels = [FakeChannel() for _ in range(channels)]
+        self.roles = [FakeRole() for _ in range(roles)]
+
+class FakeMember:
+    def __init__(self, id=None, roles=(), bot=False):
+        self.id = id or snowflake()
+        self.roles = list(roles)
+        self.bot = bot
+
+class FakeMessage:
+    def __init__(self, author, channel, guild=None, content=''):
+        self.id = snowflake()
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.content = content
+
+class FakeContext:
+    def __init__(self, message, bot=None):
+        self.message = message
+        self.bot = bot
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+
+    async def send(self, content=None, **kwargs):
+        await self.channel.send(content, **kwargs)
+
+class FakeResponse:
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+class FakeHTTPException(Exception):
+    def __init__(self, response):
+        super().__init__(f'{response.status}')
+        self.response = response
+        self.status = response.status
+
+class FakeHTTP:
+    """
+    Message endpoint with discord-style per channel buckets: `limit` sends
+    per `per` seconds, anything over that is refused with a 429 carrying the
+    usual rate limit headers.
+    """
+    def __init__(self, limit=5, per=5.0, clock=None):
+        self.limit = limit
+        self.per = per
+        self.clock = clock
+        self.windows = {}
+        self.sent = []
+        self.refused = 0
+
+    async def send(self, channel, content=None, **kwargs):
+        now = self.clock()
+        start, used = self.windows.get(channel.id, (now, 0))
+        if now - start >= self.per:
+            start, used = now, 0
+        if used >= self.limit:
+            self.refused += 1
+            raise FakeHTTPException(FakeResponse(429, {
+                'Retry-After': str(self.per - (now - start)),
+                'X-RateLimit-Global': 'false',
+            }))
+        self.windows[channel.id] = (start, used + 1)
+        self.sent.append((channel.id, content))
+        return (channel.id, content)
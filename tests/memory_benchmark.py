@@ -0,0 +1,90 @@
+"""
+Memory used to know every member's roles: discord.py's member cache versus
+the compact index of `member_index.py`.
+
+    python tests/memory_benchmark.py --guilds 10 --members 10000 --roles 3
+
+Real `discord.Member` objects are built from gateway-shaped payloads on a
+bare connection state, the same way the member cache is filled; memory is
+measured with tracemalloc.
+"""
+import argparse, gc, json, os, random, sys, tracemalloc
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'src'))
+sys.path.insert(0, TESTS)
+
+import discord
+from discord.state import ConnectionState
+from member_index import MemberIndex
+
+def payloads(guilds, members, roles, seed=0):
+    rng = random.Random(seed)
+    base = 10 ** 17
+    role_ids = [str(base + n) for n in range(50)]
+    for g in range(guilds):
+        for m in range(members):
+            user_id = base + g * members + m
+            yield g + 1, {
+                'user': {'id': str(user_id), 'username': f'user{user_id}', 'discriminator': '0', 'avatar': None, 'global_name': None},
+                'roles': rng.sample(role_ids, roles),
+                'joined_at': '2021-01-01T00:00:00+00:00',
+                'nick': None,
+                'deaf': False,
+                'mute': False,
+                'flags': 0,
+            }
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    kept = build()
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, used
+
+def member_cache(guilds, members, roles):
+    def build():
+        state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, syncer=None, http=None, loop=None,
+                intents=discord.Intents.default())
+        cache = {}
+        for guild_id, data in payloads(guilds, members, roles):
+            guild = cache.get(guild_id)
+            if guild is None:
+                guild = cache[guild_id] = discord.Guild(data={'id': str(guild_id), 'name': 'guild'}, state=state)
+            guild._add_member(discord.Member(data=data, guild=guild, state=state))
+        return cache
+    return measure(build)[1]
+
+def member_index(guilds, members, roles):
+    def build():
+        index = MemberIndex()
+        for guild_id, data in payloads(guilds, members, roles):
+            index.set(guild_id, int(data['user']['id']), map(int, data['roles']))
+        for guild in index.guilds.values():
+            guild.compact()
+        return index
+    return measure(build)[1]
+
+def run(guilds, members, roles):
+    cache = member_cache(guilds, members, roles)
+    index = member_index(guilds, members, roles)
+    return {
+        'members': guilds * members,
+        'member_cache_bytes': cache,
+        'index_bytes': index,
+        'saved': round(1 - index / cache, 3),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=10)
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--roles', type=int, default=3)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.guilds, args.members, args.roles), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,213 @@
+"""
+Query budgets for commands and MQTT callbacks.
+
+`QueryRecorder` hooks the engine's cursor events and keeps every statement
+issued while it is active, with its parameters and duration.  Each scenario
+below runs one command or callback against the test configuration
+(in-memory SQLite) and is held to the budget stored for it in
+`query_budgets.json`: a number of queries, a total SQL time, and how many
+statements may repeat with different parameters (the mark of an N+1 loop).
+
+    python tests/querycount.py            # report against the budgets
+    python tests/querycount.py --update   # record the current numbers as budgets
+
+Counts are for SQLite; a few statements differ on MySQL (upserts).
+"""
+import argparse, asyncio, json, os, sys, time
+from collections import defaultdict
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), 'src'))
+sys.path.insert(0, TESTS)
+
+from sqlalchemy import event
+from fakes import FakeGuild, FakeMember, FakeMessage, FakeContext
+
+BUDGETS = os.path.join(TESTS, 'query_budgets.json')
+
+
+class QueryRecorder:
+    def __init__(self, engines=None):
+        import db
+        self.engines = engines if engines is not None else [db.engine, *db.REPLICAS.engines]
+        self.statements = []
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('querycount_start', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        took = time.perf_counter() - conn.info['querycount_start'].pop()
+        self.statements.append((statement, repr(parameters), took))
+
+    def __enter__(self):
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._before)
+            event.listen(engine, 'after_cursor_execute', self._after)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._before)
+            event.remove(engine, 'after_cursor_execute', self._after)
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def total_ms(self):
+        return sum(took for _, _, took in self.statements) * 1000
+
+    def repeated(self):
+        """
+        statements issued more than once with different parameters, and how often
+        """
+        parameters = defaultdict(set)
+        runs = defaultdict(int)
+        for statement, params, _ in self.statements:
+            parameters[statement].add(params)
+            runs[statement] += 1
+        return {statement: runs[statement] for statement, seen in parameters.items() if len(seen) > 1}
+
+    def summary(self):
+        return {
+            'queries': self.count,
+            'time_ms': round(self.total_ms, 3),
+            'repeated': sum(self.repeated().values()),
+        }
+
+
+def over_budget(name, recorder, budget):
+    """
+    one line per exceeded limit, empty when `recorder` is within `budget`
+    """
+    problems = []
+    if recorder.count > budget['queries']:
+        problems.append(f'{name}: {recorder.count} queries, budget {budget["queries"]}')
+    if recorder.total_ms > budget['time_ms']:
+        problems.append(f'{name}: {recorder.total_ms:.1f}ms of SQL, budget {budget["time_ms"]}ms')
+    repeated = recorder.repeated()
+    if sum(repeated.values()) > budget.get('repeated', 0):
+        for statement, runs in repeated.items():
+            problems.append(f'{name}: repeated {runs}x with different parameters: {" ".join(statement.split())[:120]}')
+    return problems
+
+
+# a scenario sets up its data unrecorded and returns the coroutine function to record
+
+def _reset():
+    import db
+    from prefixes import PREFIX_CACHE
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+    PREFIX_CACHE.clear()
+
+def _context(guild, channel=None):
+    channel = channel or guild.channels[0]
+    return FakeContext(FakeMessage(FakeMember(1), channel, guild, '=prefix $'))
+
+async def _known_guild(guild):
+    import db
+    async with db.AsyncSession() as session:
+        await db.ensure_server(session, guild.id)
+        await db.ensure_channels(session, [channel.id for channel in guild.channels])
+        await session.commit()
+
+async def prefix():
+    from commands.admins import AdminCog
+    ctx = _context(FakeGuild(channels=1))
+    return lambda: AdminCog.prefix.callback(AdminCog(None), ctx, '$')
+
+async def prefix_known_server():
+    from commands.admins import AdminCog
+    guild = FakeGuild(channels=1)
+    await _known_guild(guild)
+    ctx = _context(guild)
+    return lambda: AdminCog.prefix.callback(AdminCog(None), ctx, '$')
+
+async def cprefix():
+    from commands.admins import AdminCog
+    guild = FakeGuild(channels=1)
+    await _known_guild(guild)
+    ctx = _context(guild)
+    return lambda: AdminCog.cprefix.callback(AdminCog(None), ctx, '?')
+
+async def ping():
+    """
+    a whole invocation: resolving the prefix (cold cache) and replying
+    """
+    from bot_utils import prefix_operator
+    from commands.ping import ping
+    guild = FakeGuild(channels=1)
+    await _known_guild(guild)
+    ctx = _context(guild)
+    async def invoke():
+        await prefix_operator(None, ctx.message)
+        await ping.callback(ctx)
+    return invoke
+
+async def set_prefix():
+    from mqtt_client.edit_prefix import set_prefix
+    guilds = [FakeGuild(channels=3) for _ in range(3)]
+    for guild in guilds:
+        await _known_guild(guild)
+    data = [{'server_id': guild.id, 'prefix': None} for guild in guilds]
+    data += [{'channel_id': channel.id, 'prefix': None} for guild in guilds for channel in guild.channels]
+    data.append({'channel_id': 1, 'prefix': '!'})
+    return lambda: set_prefix(data)
+
+SCENARIOS = {
+    'prefix': prefix,
+    'prefix_known_server': prefix_known_server,
+    'cprefix': cprefix,
+    'ping': ping,
+    'set_prefix': set_prefix,
+}
+
+async def measure(name):
+    _reset()
+    invoke = await SCENARIOS[name]()
+    with QueryRecorder() as recorder:
+        await invoke()
+    return recorder
+
+def load_budgets(path=BUDGETS):
+    with open(path) as f:
+        return json.load(f)
+
+async def run(names=None):
+    return {name: await measure(name) for name in (names or SCENARIOS)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budgets', default=BUDGETS)
+    parser.add_argument('--update', action='store_true')
+    args = parser.parse_args(argv)
+
+    recorders = asyncio.run(run())
+    for name, recorder in recorders.items():
+        summary = recorder.summary()
+        print(f"{name:24} {summary['queries']:>4} queries  {summary['time_ms']:8.3f}ms  {summary['repeated']} repeated")
+
+    if args.update:
+        budgets = {
+            name: {
+                'queries': recorder.count,
+                # SQL time is noisy, only catch gross regressions
+                'time_ms': max(50, round(recorder.total_ms * 20)),
+                'repeated': sum(recorder.repeated().values()),
+            }
+            for name, recorder in recorders.items()
+        }
+        with open(args.budgets, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+        return 0
+
+    budgets = load_budgets(args.budgets)
+    problems = [line for name, recorder in recorders.items() for line in over_budget(name, recorder, budgets[name])]
+    for line in problems:
+        print('OVER BUDGET', line)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
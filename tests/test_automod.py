@@ -0,0 +1,75 @@
+import asyncio
+import db
+from automod import Automaton, FilterEngine, compile_rules, strongest
+from settings_store import SettingsStore
+
+RULES = {'rules': [
+    {'id': 'words', 'patterns': ['he', 'she', 'hers', 'bad word']},
+    {'id': 'partial', 'patterns': ['spam'], 'whole_word': False},
+    {'id': 'invites', 'type': 'invites', 'action': 'delete'},
+    {'id': 'shouting', 'type': 'regex', 'patterns': [r'\b([a-z])\1{5,}\b'], 'action': 'log'},
+    {'id': 'links', 'type': 'regex', 'patterns': [r'https?://\S+\.ru\b', '(broken']},
+]}
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+
+def test_automaton_finds_overlapping_words():
+    automaton = Automaton({'he': [('a', False)], 'she': [('b', False)], 'hers': [('c', False)]})
+    assert automaton.search('ushers') == {'a', 'b', 'c'}
+    assert automaton.search('nothing here') == {'a'}
+    assert automaton.search('xyz') == set()
+
+def test_rules_compile_into_one_scan():
+    compiled = compile_rules(RULES)
+    assert compiled.scan('She said a BAD WORD') == {'words'}
+    assert compiled.scan('shells and hearts') == set()
+    assert compiled.scan('antispammer') == {'partial'}
+    assert compiled.scan('join discord.gg/abc-123 aaaaaa') == {'invites', 'shouting'}
+    assert compiled.scan('see http://example.ru now') == {'links'}
+    assert compiled.actions['invites'] == 'delete'
+    assert not compile_rules({'enabled': False, 'rules': RULES['rules']})
+
+def test_overlapping_rules_all_match():
+    compiled = compile_rules({'rules': [
+        {'id': 'links', 'type': 'regex', 'patterns': [r'https?://\S+']},
+        {'id': 'invites', 'type': 'invites', 'action': 'delete'},
+        {'id': 'gg', 'type': 'regex', 'patterns': [r'discord\.gg'], 'action': 'log'},
+    ]})
+    hits = compiled.scan('join https://discord.gg/abc now')
+    assert hits == {'links', 'invites', 'gg'}
+    assert strongest({rule: compiled.actions[rule] for rule in hits}) == 'delete'
+    assert compiled.scan('see https://example.com') == {'links'}
+    assert strongest({}) is None
+
+def test_malformed_rules_are_skipped():
+    compiled = compile_rules({'rules': [
+        'spam',
+        {'id': 'words', 'patterns': ['spam', 7, None]},
+        {'id': 'regex', 'type': 'regex', 'patterns': [r'\d{6}', {'p': 1}]},
+        {'id': 'lists', 'patterns': 'not a list'},
+    ]})
+    assert compiled.scan('spam 123456') == {'words', 'regex'}
+    assert set(compiled.actions) == {'words', 'regex', 'lists'}
+    assert not compile_rules({'rules': 'spam'})
+
+def test_engine_rebuilds_after_settings_change():
+    async def scenario():
+        store = SettingsStore(interval=60)
+        engine = FilterEngine(store)
+        await store.set('servers', 1, 'automod', {'rules': [{'id': 'w', 'patterns': ['foo']}]})
+        assert await engine.check(1, 'foo bar') == {'w': 'warn'}
+        assert await engine.check(2, 'foo bar') == {}
+        builds = engine.builds
+        assert await engine.check(1, 'foo') == {'w': 'warn'}
+        assert engine.builds == builds
+
+        await store.set('servers', 1, 'automod.rules', [{'id': 'w', 'patterns': ['bar']}])
+        assert await engine.check(1, 'foo bar') == {'w': 'warn'}
+        assert await engine.check(1, 'foo') == {}
+        assert engine.builds == builds + 1
+        return engine.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats['hits'] == {'1/w': 3}
@@ -0,0 +1,26 @@
+import asyncio
+import benchmarks
+
+def test_small_scale_produces_every_scenario():
+    results = asyncio.run(benchmarks.run(['small']))
+    scenarios = {key.split('/', 1)[1] for key in results}
+    assert scenarios == {
+        'prefix_operator_cold', 'prefix_operator_warm', 'is_server_moderator', 'gate',
+        'ensure_existing', 'ensure_new', 'dispatch_message', 'command_ping', 'command_prefix',
+    }
+    for summary in results.values():
+        assert summary['ops'] > 0
+        assert summary['p50_ms'] <= summary['p99_ms']
+
+def test_compare_flags_slower_scenarios_only():
+    baseline = {
+        'small/gate': {'ops_per_sec': 1000, 'p50_ms': 1, 'p99_ms': 1},
+        'small/ping': {'ops_per_sec': 1000, 'p50_ms': 1, 'p99_ms': 1},
+    }
+    results = {
+        'small/gate': {'ops_per_sec': 1100, 'p50_ms': 1.2, 'p99_ms': 5},
+        'small/ping': {'ops_per_sec': 400, 'p50_ms': 3, 'p99_ms': 3},
+    }
+    regressions = benchmarks.compare(results, baseline, 0.5)
+    assert len(regressions) == 2
+    assert all(line.startswith('small/ping') for line in regressions)
@@ -0,0 +1,39 @@
+import asyncio
+import db
+from mqtt_client import edit_prefix
+from prefixes import PREFIX_CACHE
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+    PREFIX_CACHE.clear()
+
+def acks(monkeypatch):
+    sent = []
+    async def acknowledge(setting, results):
+        sent.append(results)
+    monkeypatch.setattr(edit_prefix, 'acknowledge', acknowledge)
+    return sent
+
+def test_invalid_items_do_not_abort_the_batch(monkeypatch):
+    sent = acks(monkeypatch)
+    session = db.Session()
+    session.add(db.Servers(id=1, prefix='!'))
+    session.commit()
+    session.close()
+
+    asyncio.run(edit_prefix.set_prefix([
+        {'server_id': 1, 'prefix': '!'},
+        {'channel_id': 'abc', 'prefix': '?'},
+        {'channel_id': None},
+        {'prefix': '?'},
+        'nonsense',
+        {'channel_id': 2, 'prefix': '?'},
+    ]))
+    assert [result['status'] for result in sent[0]] == ['applied', 'invalid', 'invalid', 'invalid', 'invalid', 'not_found']
+    assert PREFIX_CACHE.peek(1) == '!'
+
+def test_non_list_payloads_are_rejected(monkeypatch):
+    sent = acks(monkeypatch)
+    asyncio.run(edit_prefix.set_prefix({'server_id': 1}))
+    assert sent == [[{'status': 'invalid', 'error': 'payload must be a list'}]]
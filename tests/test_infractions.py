@@ -0,0 +1,128 @@
+import asyncio
+import db
+from infractions import WarningQueue, warning_history, record_warning
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+
+def test_queue_flushes_when_full_or_after_interval():
+    async def scenario():
+        queue = WarningQueue(batch_size=10, interval=0.05)
+        for i in range(3):
+            queue.enqueue(moderator_id=1, user_id=2, server_id=3, context=f'spam {i}')
+        assert queue.written == 0
+        await asyncio.sleep(0.1)
+        assert queue.written == 3
+
+        queue.interval = 60
+        for i in range(22):
+            queue.enqueue(moderator_id=1, user_id=2, server_id=3, context=f'raid {i}')
+        await asyncio.sleep(0.05)
+        assert len(queue) == 0
+        return queue.written
+
+    assert asyncio.run(scenario()) == 25
+    session = db.Session()
+    assert session.query(db.Warnings).count() == 25
+    session.close()
+
+def test_queue_is_bounded_while_writes_fail(monkeypatch):
+    import infractions
+    def unavailable(rows):
+        raise RuntimeError('database is down')
+    monkeypatch.setattr(infractions, '_insert_warnings', unavailable)
+
+    async def scenario():
+        queue = WarningQueue(batch_size=4, interval=60, max_queued=6)
+        for i in range(5):
+            queue.enqueue(moderator_id=1, user_id=2, server_id=3, context=f'raid {i}')
+        assert await queue.flush() == 0
+        for i in range(5, 8):
+            queue.enqueue(moderator_id=1, user_id=2, server_id=3, context=f'raid {i}')
+        queue.timer.cancel()
+        return queue
+
+    queue = asyncio.run(scenario())
+    assert len(queue) == 6 and queue.dropped == 2
+    assert [row['context'] for row in queue.rows] == [f'raid {i}' for i in range(2, 8)]
+
+def test_history_pages_newest_first():
+    async def scenario():
+        async with db.AsyncSession() as session:
+            for i in range(7):
+                await record_warning(session, moderator_id=1, user_id=2, server_id=3, context=str(i))
+            await record_warning(session, moderator_id=1, user_id=9, server_id=3)
+
+            first = await warning_history(session, 3, 2, limit=5)
+            second = await warning_history(session, 3, 2, before=first[-1].id, limit=5)
+        return [w.context for w in first], [w.context for w in second]
+
+    first, second = asyncio.run(scenario())
+    assert first == ['6', '5', '4', '3', '2']
+    assert second == ['1', '0']
+
+def test_tallies_follow_writes_and_rebuild_from_the_tally_table():
+    import tallies
+    from infractions import WARNING_QUEUE, load_tallies
+
+    async def scenario():
+        tallies.replace({})
+        async with db.AsyncSession() as session:
+            await record_warning(session, moderator_id=1, user_id=2, server_id=3)
+        for _ in range(4):
+            WARNING_QUEUE.enqueue(moderator_id=1, user_id=2, server_id=3)
+        await WARNING_QUEUE.flush()
+        live = tallies.warnings_within(3, 2, hours=24)
+
+        # a warning from before timestamps were recorded never counts
+        async with db.AsyncSession() as session:
+            def legacy(session):
+                session.execute(db.Warnings.__table__.insert().values(
+                    moderator_id=1, user_id=2, server_id=3, created_at=None
+                ))
+                session.commit()
+            await session.run(legacy)
+
+        tallies.replace({})
+        await load_tallies()
+        return live, tallies.warnings_within(3, 2, hours=24)
+
+    assert asyncio.run(scenario()) == (5, 5)
+    assert tallies.exceeds(3, 2, threshold=5)
+    assert not tallies.exceeds(3, 9, threshold=1)
+
+    session = db.Session()
+    assert sum(t.count for t in session.query(db.WarningTallies)) == 5
+    session.close()
+
+def test_buckets_outside_the_window_are_pruned():
+    import tallies
+    from infractions import load_tallies, prune_tallies
+
+    now = tallies.current_bucket()
+    stale = now - tallies.WINDOW_HOURS
+    session = db.Session()
+    session.add_all([
+        db.WarningTallies(server_id=3, user_id=2, bucket=now, count=2),
+        db.WarningTallies(server_id=3, user_id=2, bucket=stale, count=7),
+        db.WarningTallies(server_id=3, user_id=9, bucket=stale - 1, count=1),
+    ])
+    session.commit()
+    session.close()
+
+    async def scenario():
+        await load_tallies()
+        loaded = dict(tallies.TALLIES)
+        # as if the user had been quiet for the whole window
+        tallies.TALLIES[(3, 9)] = {stale: 4}
+        purged = await prune_tallies()
+        return loaded, purged
+
+    loaded, purged = asyncio.run(scenario())
+    assert loaded == {(3, 2): {now: 2}}
+    assert purged == 2
+    assert tallies.TALLIES == {(3, 2): {now: 2}}
+    session = db.Session()
+    assert [(t.user_id, t.bucket) for t in session.query(db.WarningTallies)] == [(2, now)]
+    session.close()
@@ -0,0 +1,32 @@
+import asyncio, threading
+import db
+from permissions import PERMISSIONS, MODERATOR
+from prefixes import PREFIX_CACHE, PrefixCache
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+    PREFIX_CACHE.clear()
+
+def test_model_listeners_update_caches_on_the_loop(monkeypatch):
+    threads = []
+    set_prefix = PrefixCache.set
+    def record(self, id, prefix):
+        threads.append(threading.current_thread())
+        set_prefix(self, id, prefix)
+    monkeypatch.setattr(PrefixCache, 'set', record)
+
+    def write(session):
+        session.add(db.Servers(id=1, prefix='!'))
+        session.add(db.Roles(id=2, moderator=True))
+        session.commit()
+
+    async def scenario():
+        async with db.AsyncSession() as session:
+            await session.run(write)
+            # visible as soon as the write is awaited
+            return PREFIX_CACHE.peek(1), PERMISSIONS['roles'].get(2)
+
+    assert asyncio.run(scenario()) == ('!', MODERATOR)
+    assert threads == [threading.main_thread()]
+    PERMISSIONS['roles'].pop(2, None)
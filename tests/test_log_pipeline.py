@@ -0,0 +1,33 @@
+import json, logging
+from log_pipeline import SubsystemFilter, JsonFormatter, configure, stop
+
+def record(name='root', module='gate', level=logging.INFO, msg='hello'):
+    return logging.LogRecord(name, level, f'/src/{module}.py', 1, msg, None, None)
+
+def test_rate_limit_applies_per_subsystem_below_warning():
+    gate = SubsystemFilter(limits={'gate': 2})
+    assert [gate.filter(record()) for _ in range(4)] == [True, True, False, False]
+    assert gate.filter(record(level=logging.WARNING))
+    assert gate.filter(record(module='prefixes'))
+
+def test_sampling_uses_longest_prefix():
+    sampler = SubsystemFilter(sample={'sqlalchemy': 1.0, 'sqlalchemy.engine': 0.0})
+    assert not sampler.filter(record(name='sqlalchemy.engine.Engine'))
+    assert sampler.filter(record(name='sqlalchemy.pool'))
+
+def test_records_reach_the_file_through_the_queue(tmp_path):
+    path = tmp_path / 'rrbot.log'
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    try:
+        configure(str(path), 'INFO')
+        logging.info('queued %s', 1)
+        stop()
+    finally:
+        root.handlers[:] = handlers
+        root.setLevel(level)
+    assert 'queued 1' in path.read_text()
+
+def test_json_lines():
+    line = JsonFormatter().format(record(msg='structured'))
+    assert json.loads(line)['message'] == 'structured'
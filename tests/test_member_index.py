@@ -0,0 +1,87 @@
+import asyncio
+import memory_benchmark
+import member_index
+from member_index import GuildRoles, MemberIndex, MEMBER_INDEX
+from permissions import PERMISSIONS, MODERATOR, MUTED
+from fakes import FakeGuild, FakeMember, FakeRole, FakeChannel, FakeMessage
+
+class FakeUser:
+    """
+    a message author without the member cache: no roles, no guild
+    """
+    def __init__(self, id):
+        self.id = id
+        self.bot = False
+
+def test_updates_survive_compaction():
+    guild = GuildRoles()
+    for user_id in range(200, 0, -1):
+        guild.set(user_id, [user_id + 1000, 5])
+    guild.remove(7)
+    guild.set(8, [])
+    guild.compact()
+    assert not guild.delta
+    assert list(guild.users) == sorted(guild.users)
+    assert guild.get(1) == (5, 1001)
+    assert guild.get(7) is None
+    assert guild.get(8) == ()
+    assert len(guild) == 199
+
+    guild.set(1, [9])
+    guild.set(500, [1])
+    assert guild.get(1) == (9,)
+    assert len(guild) == 200
+
+def test_gateway_payloads_feed_the_index():
+    index = MemberIndex()
+    index.apply('GUILD_MEMBER_ADD', {'guild_id': '1', 'user': {'id': '2'}, 'roles': ['30', '20']})
+    index.apply('MESSAGE_CREATE', {'guild_id': '1', 'author': {'id': '3'}, 'member': {'roles': ['20']}})
+    index.apply('TYPING_START', {'guild_id': '1'})
+    assert index.get(1, 2) == (20, 30)
+    assert index.get(1, 3) == (20,)
+    index.apply('GUILD_MEMBER_REMOVE', {'guild_id': '1', 'user': {'id': '2'}})
+    assert index.get(1, 2) is None
+
+def test_misses_are_fetched_once():
+    guild = FakeGuild()
+    calls = []
+    async def fetch_member(user_id):
+        calls.append(user_id)
+        await asyncio.sleep(0)
+        return FakeMember(user_id, roles=[FakeRole(guild.id), FakeRole(42)])
+    guild.fetch_member = fetch_member
+
+    async def scenario():
+        index = MemberIndex()
+        results = await asyncio.gather(*[index.fetch_role_ids(guild, 9) for _ in range(3)])
+        return results + [await index.fetch_role_ids(guild, 9)]
+
+    assert asyncio.run(scenario()) == [(42,)] * 4
+    assert calls == [9]
+
+def test_checks_use_the_index_for_plain_users(monkeypatch):
+    from bot_utils import _is_server_moderator, is_server_moderator
+    from gate import allow_message
+
+    guild = FakeGuild()
+    MEMBER_INDEX.set(guild.id, 5, [71])
+    monkeypatch.setitem(PERMISSIONS, 'roles', {71: MODERATOR, 72: MUTED})
+    assert _is_server_moderator(FakeUser(5), guild.id)
+    assert not _is_server_moderator(FakeUser(5))
+
+    MEMBER_INDEX.set(guild.id, 6, [72])
+    assert not allow_message(FakeMessage(FakeUser(6), FakeChannel(), guild))
+    assert allow_message(FakeMessage(FakeUser(5), FakeChannel(), guild))
+
+    # a miss is fetched from the API in low memory mode
+    async def fetch_member(user_id):
+        return FakeMember(user_id, roles=[FakeRole(71)])
+    guild.fetch_member = fetch_member
+    monkeypatch.setattr(member_index, 'LOW_MEMORY', True)
+    assert asyncio.run(is_server_moderator(FakeUser(7), guild))
+    assert MEMBER_INDEX.get(guild.id, 7) == (71,)
+    MEMBER_INDEX.drop_guild(guild.id)
+
+def test_index_is_smaller_than_the_member_cache():
+    result = memory_benchmark.run(guilds=2, members=500, roles=3)
+    assert result['index_bytes'] * 5 < result['member_cache_bytes']
@@ -0,0 +1,67 @@
+import asyncio, json
+import pytest
+from asyncio_mqtt import MqttError
+import mqtt_client
+from mqtt_client.local_broker import LOCAL_BROKER
+
+def test_backoff_grows_with_jitter_up_to_the_cap():
+    delays = [max(mqtt_client.reconnect_delay(attempt) for _ in range(200)) for attempt in range(12)]
+    assert all(0 <= delay <= mqtt_client.BACKOFF_CAP for delay in delays)
+    assert delays[0] <= mqtt_client.BACKOFF_BASE
+    assert delays[8] > delays[1]
+
+async def wait_for(predicate, timeout=2):
+    for _ in range(int(timeout / 0.01)):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError('timed out')
+
+def test_survives_a_broker_restart_and_sends_what_was_buffered(monkeypatch):
+    monkeypatch.setattr(mqtt_client, 'BACKOFF_BASE', 0.01)
+    monkeypatch.setattr(mqtt_client, 'BACKOFF_CAP', 0.05)
+    # the sync snapshot published on connect would race the kill below
+    monkeypatch.setattr(mqtt_client, 'CONNECT_CALLBACKS', [])
+    mqtt_client.OUTBOX.clear()
+    received = []
+    async def callback(data):
+        received.append(data)
+    mqtt_client.register_setting_callback('restart_test', callback)
+
+    async def scenario():
+        task = asyncio.ensure_future(mqtt_client.mqtt_task())
+        connects = mqtt_client.CONNECTION['connects']
+        try:
+            await wait_for(lambda: mqtt_client.CLIENT is not None)
+            LOCAL_BROKER.kill()
+            await wait_for(lambda: mqtt_client.CLIENT is None)
+            assert not await mqtt_client.acknowledge('prefix', [{'status': 'applied'}])
+            assert len(mqtt_client.OUTBOX) == 1
+
+            # reconnect attempts keep failing until the broker is back
+            with pytest.raises(MqttError):
+                async with LOCAL_BROKER.client():
+                    pass
+            await asyncio.sleep(0.1)
+            assert mqtt_client.CONNECTION['state'] in ('connecting', 'backoff')
+
+            LOCAL_BROKER.restart()
+            async with LOCAL_BROKER.client() as observer:
+                await observer.subscribe('rrbot/ack/#')
+                await wait_for(lambda: mqtt_client.CLIENT is not None)
+                message = await asyncio.wait_for(observer.queue.get(), 1)
+                await mqtt_client.publish('rrbot/settings/restart_test', {'n': 1})
+                await wait_for(lambda: received)
+            return message, mqtt_client.CONNECTION['connects'] - connects
+        finally:
+            task.cancel()
+            mqtt_client.DISPATCHER.stop()
+            mqtt_client.CLIENT = None
+            LOCAL_BROKER.restart()
+
+    message, connects = asyncio.run(scenario())
+    assert json.loads(message.payload) == [{'status': 'applied'}]
+    assert connects == 2
+    assert received == [{'n': 1}]
+    assert not mqtt_client.OUTBOX
+    del mqtt_client.DISPATCH['rrbot/settings/restart_test']
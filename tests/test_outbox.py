@@ -0,0 +1,73 @@
+import asyncio
+from outbox import Outbox, MODERATION, NORMAL
+from fakes import FakeChannel, FakeHTTP
+
+def clock():
+    return asyncio.get_running_loop().time()
+
+def test_short_replies_are_coalesced():
+    http = FakeHTTP(clock=clock)
+    channel = FakeChannel()
+
+    async def scenario():
+        outbox = Outbox(sender=http.send, coalesce_window=0.05)
+        futures = [outbox.submit(channel, f'line {n}') for n in range(10)]
+        await asyncio.gather(*futures)
+        return futures
+
+    futures = asyncio.run(scenario())
+    # the first goes out at once, the rest queue behind it and are joined
+    assert http.sent == [(channel.id, 'line 0'), (channel.id, '\n'.join(f'line {n}' for n in range(1, 10)))]
+    assert len({future.result() for future in futures}) == 2
+
+def test_lone_reply_skips_the_coalescing_window():
+    http = FakeHTTP(clock=clock)
+    channel = FakeChannel()
+
+    async def scenario():
+        outbox = Outbox(sender=http.send, coalesce_window=10)
+        await asyncio.wait_for(outbox.send(channel, 'Pong!'), timeout=1)
+
+    asyncio.run(scenario())
+    assert http.sent == [(channel.id, 'Pong!')]
+
+def test_rate_limited_sends_are_retried():
+    # our bucket is more generous than the server, every refusal must be retried
+    http = FakeHTTP(limit=2, per=0.1, clock=clock)
+    channel = FakeChannel()
+
+    async def scenario():
+        outbox = Outbox(sender=http.send, channel_rate=100, channel_burst=10, coalesce_window=0)
+        await asyncio.gather(*[outbox.submit(channel, 'x' * 1500) for _ in range(5)])
+
+    asyncio.run(scenario())
+    assert len(http.sent) == 5
+    assert http.refused > 0
+
+def test_channel_bucket_paces_sends():
+    http = FakeHTTP(limit=100, clock=clock)
+    channel = FakeChannel()
+
+    async def scenario():
+        outbox = Outbox(sender=http.send, channel_rate=20, channel_burst=2, coalesce_window=0)
+        start = clock()
+        await asyncio.gather(*[outbox.submit(channel, 'x' * 1500) for _ in range(4)])
+        return clock() - start
+
+    # two from the burst, then one every 50ms
+    assert asyncio.run(scenario()) >= 0.09
+    assert http.refused == 0
+
+def test_moderation_output_goes_first():
+    http = FakeHTTP(limit=100, clock=clock)
+    chatty, moderated = FakeChannel(), FakeChannel()
+
+    async def scenario():
+        outbox = Outbox(sender=http.send, global_rate=20, coalesce_window=0)
+        outbox.bucket.tokens = 0
+        normal = [outbox.submit(chatty, 'x' * 1500, priority=NORMAL) for _ in range(3)]
+        urgent = outbox.submit(moderated, 'removed a message', priority=MODERATION)
+        await asyncio.gather(urgent, *normal)
+
+    asyncio.run(scenario())
+    assert http.sent[0] == (moderated.id, 'removed a message')
@@ -0,0 +1,22 @@
+import asyncio
+from prefixes import PrefixCache, PrefixResolver
+
+def test_cancelled_resolve_leaves_other_callers_alone():
+    loads = []
+    async def loader(channel_ids, server_ids):
+        loads.append((channel_ids, server_ids))
+        await asyncio.sleep(0.01)
+        return {1: '!', 10: '?'}
+
+    async def scenario():
+        resolver = PrefixResolver(PrefixCache(100, 60), loader)
+        first = asyncio.ensure_future(resolver.resolve(1, 10))
+        second = asyncio.ensure_future(resolver.resolve(2, 10))
+        await asyncio.sleep(0.001)
+        first.cancel()
+        result = await second
+        # the shared lookup still filled the cache for everyone
+        return first.cancelled(), result, await resolver.resolve(1, 10)
+
+    assert asyncio.run(scenario()) == (True, '?', '!')
+    assert len(loads) == 1
@@ -0,0 +1,33 @@
+import asyncio
+import pytest
+import querycount
+
+BUDGETS = querycount.load_budgets()
+
+def test_every_scenario_has_a_budget():
+    assert set(BUDGETS) == set(querycount.SCENARIOS)
+
+@pytest.mark.parametrize('name', sorted(querycount.SCENARIOS))
+def test_within_budget(name):
+    recorder = asyncio.run(querycount.measure(name))
+    assert querycount.over_budget(name, recorder, BUDGETS[name]) == []
+
+def test_repeated_statements_are_flagged():
+    import db
+
+    def one_by_one(session, ids):
+        for id in ids:
+            session.get(db.Servers, id)
+
+    async def scenario():
+        querycount._reset()
+        with querycount.QueryRecorder() as recorder:
+            async with db.AsyncSession() as session:
+                await session.run(one_by_one, [1, 2, 3])
+        return recorder
+
+    recorder = asyncio.run(scenario())
+    assert recorder.count == 3
+    assert list(recorder.repeated().values()) == [3]
+    problems = querycount.over_budget('loop', recorder, {'queries': 3, 'time_ms': 1000})
+    assert len(problems) == 1 and 'repeated 3x' in problems[0]
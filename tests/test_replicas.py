@@ -0,0 +1,90 @@
+import asyncio, threading
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import db
+
+def database(path, prefix):
+    engine = create_engine(f'sqlite:///{path}')
+    db.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(db.Servers(id=1, prefix=prefix))
+    session.commit()
+    session.close()
+    return engine
+
+def routed(primary, replicas):
+    return sessionmaker(class_=db.RoutingSession, primary=primary, replicas=replicas, expire_on_commit=False)
+
+def prefix(session, id=1):
+    return session.query(db.Servers.prefix).filter(db.Servers.id == id).scalar()
+
+def test_reads_go_to_replicas_until_the_session_writes(tmp_path):
+    primary = database(tmp_path / 'primary.db', '!')
+    replica = database(tmp_path / 'replica.db', '?')
+    Session = routed(primary, db.ReplicaSet([replica]))
+
+    session = Session()
+    assert prefix(session) == '?'
+    session.add(db.Servers(id=2, prefix='$'))
+    session.flush()
+    # reads after a write see the primary, including the uncommitted row
+    assert prefix(session) == '!'
+    assert prefix(session, 2) == '$'
+    session.commit()
+    session.close()
+
+    pinned = Session()
+    pinned.info['primary'] = True
+    assert prefix(pinned) == '!'
+    pinned.close()
+
+def test_round_robin_skips_unhealthy_replicas(tmp_path):
+    primary = database(tmp_path / 'primary.db', '!')
+    first = database(tmp_path / 'first.db', 'a')
+    second = database(tmp_path / 'second.db', 'b')
+    broken = create_engine(f'sqlite:///{tmp_path}/missing/broken.db')
+    replicas = db.ReplicaSet([first, second, broken])
+    Session = routed(primary, replicas)
+
+    assert replicas.check() == 2
+    seen = []
+    for _ in range(4):
+        session = Session()
+        seen.append(prefix(session))
+        session.close()
+    assert sorted(seen) == ['a', 'a', 'b', 'b']
+
+    replicas.mark_down(first)
+    replicas.mark_down(second)
+    session = Session()
+    assert prefix(session) == '!'
+    session.close()
+
+def test_hung_db_check_leaves_the_executor_alone(monkeypatch):
+    release = threading.Event()
+    threads = []
+    def hang():
+        threads.append(threading.current_thread().name)
+        release.wait(5)
+    monkeypatch.setattr(db, '_ping', hang)
+    try:
+        with pytest.raises(db.BotDBError):
+            asyncio.run(db.db_test(timeout=0.05, retries=2, backoff=0))
+        assert threads == ['rrbot-db-check'] * 2
+        assert asyncio.run(db.run_sync(lambda: 'free')) == 'free'
+    finally:
+        release.set()
+
+def test_get_or_create_reads_the_primary(tmp_path):
+    primary = database(tmp_path / 'primary.db', '!')
+    # a replica that has not received the row yet
+    lagging = create_engine(f'sqlite:///{tmp_path}/replica.db')
+    db.Base.metadata.create_all(lagging)
+    Session = routed(primary, db.ReplicaSet([lagging]))
+
+    session = Session()
+    server = db.get_or_create(session, db.Servers, id=1)
+    assert server.prefix == '!'
+    assert session.info['primary']
+    session.close()
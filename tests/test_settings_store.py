@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+import db
+from settings_store import SettingsStore
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+
+def stored(model, id):
+    session = db.Session()
+    try:
+        return session.get(model, id).jsondata
+    finally:
+        session.close()
+
+def test_writes_are_coalesced_into_one_flush():
+    published = []
+    async def publisher(changes):
+        published.append(changes)
+
+    async def scenario():
+        store = SettingsStore(interval=60)
+        store.publisher = publisher
+        store.define('servers', 'automod.enabled', bool, False)
+        assert await store.get('servers', 1, 'automod.enabled') is False
+
+        await store.set('servers', 1, 'automod.enabled', True)
+        await store.set('servers', 1, 'automod.words', ['spam'])
+        await store.set('channels', 2, 'topic', 'x')
+        with pytest.raises(TypeError):
+            await store.set('servers', 1, 'automod.enabled', 'yes')
+
+        assert await store.get('servers', 1, 'automod') == {'enabled': True, 'words': ['spam']}
+        return await store.flush()
+
+    assert asyncio.run(scenario()) == 2
+    assert stored(db.Servers, 1) == {'automod': {'enabled': True, 'words': ['spam']}}
+    assert stored(db.Channels, 2) == {'topic': 'x'}
+    assert len(published) == 1
+
+def test_partial_updates_keep_concurrent_edits():
+    session = db.Session()
+    session.add(db.Servers(id=1, jsondata={'a': 1}))
+    session.commit()
+
+    async def scenario():
+        store = SettingsStore(interval=60)
+        assert await store.get('servers', 1, 'a') == 1
+
+        # someone else edits another key after we cached the blob
+        other = db.Session()
+        other.get(db.Servers, 1).jsondata = {'a': 1, 'b': 2}
+        other.commit()
+        other.close()
+
+        await store.set('servers', 1, 'c.d', 3)
+        await store.flush()
+        store.invalidate('servers', 1)
+        return await store.get('servers', 1)
+
+    assert asyncio.run(scenario()) == {'a': 1, 'b': 2, 'c': {'d': 3}}
+    session.close()
+
+def test_reads_during_a_flush_do_not_cache_the_old_row():
+    import threading
+    store = SettingsStore(size=1, interval=60)
+    committing = threading.Event()
+    release = threading.Event()
+    apply = store._apply
+    def slow_apply(session, pending):
+        committing.set()
+        release.wait(5)
+        apply(session, pending)
+    store._apply = slow_apply
+
+    async def scenario():
+        await store.set('servers', 1, 'greeting', 'hi')
+        flush = asyncio.ensure_future(store.flush())
+        await asyncio.get_running_loop().run_in_executor(None, committing.wait)
+        # a remote invalidation and cache pressure, while the row still has the old blob
+        store.invalidate('servers', 1)
+        await store.get('servers', 2, 'greeting')
+        during = await store.get('servers', 1, 'greeting')
+        await store.set('servers', 1, 'farewell', 'bye')
+        release.set()
+        await flush
+        assert store.pending == {('servers', 1): [('farewell', 'bye')]}
+        store.timer.cancel()
+        return during, await store.get('servers', 1)
+
+    assert asyncio.run(scenario()) == ('hi', {'greeting': 'hi', 'farewell': 'bye'})
+    assert stored(db.Servers, 1) == {'greeting': 'hi'}
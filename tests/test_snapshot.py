@@ -0,0 +1,80 @@
+import asyncio
+import db, snapshot
+from permissions import PERMISSIONS, MODERATOR, MUTED
+from prefixes import PREFIX_CACHE
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+    for index in PERMISSIONS.values():
+        index.clear()
+    PREFIX_CACHE.clear()
+    # as if a previous run had loaded its caches
+    snapshot.LOADED = True
+
+def test_warm_start_restores_and_catches_up(tmp_path):
+    path = str(tmp_path / 'cache.snapshot')
+    full_loads = []
+    async def full_load():
+        full_loads.append(True)
+
+    async def scenario():
+        PERMISSIONS['roles'][7] = MODERATOR
+        PREFIX_CACHE.set(1, '!')
+        PREFIX_CACHE.set(2, None)
+        await snapshot.save(path)
+
+        for index in PERMISSIONS.values():
+            index.clear()
+        PREFIX_CACHE.clear()
+
+        # changed after the snapshot was taken
+        async with db.AsyncSession() as session:
+            session.add(db.Users(id=5, muted=True))
+            await session.commit()
+        PERMISSIONS['users'].clear()
+
+        return await snapshot.warm_start(full_load, path)
+
+    assert asyncio.run(scenario()) is True
+    assert not full_loads
+    assert PERMISSIONS['roles'] == {7: MODERATOR}
+    assert PERMISSIONS['users'] == {5: MUTED}
+    assert PREFIX_CACHE.peek(1) == '!'
+    assert PREFIX_CACHE.peek(2) is None
+
+def test_corrupt_or_missing_snapshot_falls_back_to_full_load(tmp_path):
+    path = tmp_path / 'cache.snapshot'
+    full_loads = []
+    async def full_load():
+        full_loads.append(True)
+
+    async def scenario():
+        PREFIX_CACHE.set(1, '!')
+        await snapshot.save(str(path))
+        data = bytearray(path.read_bytes())
+        data[-1] ^= 0xff
+        path.write_bytes(bytes(data))
+        corrupt = await snapshot.warm_start(full_load, str(path))
+        missing = await snapshot.warm_start(full_load, str(tmp_path / 'nope'))
+        return corrupt, missing
+
+    assert asyncio.run(scenario()) == (False, False)
+    assert len(full_loads) == 2
+
+def test_caches_that_never_loaded_are_not_saved(tmp_path):
+    path = tmp_path / 'cache.snapshot'
+    async def failing_load():
+        raise RuntimeError('database went away')
+
+    async def scenario():
+        snapshot.LOADED = False
+        try:
+            await snapshot.warm_start(failing_load, str(path))
+        except RuntimeError:
+            pass
+        await snapshot.save(str(path))
+
+    asyncio.run(scenario())
+    assert not path.exists()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,116 @@
+import asyncio
+from sqlalchemy import event, text
+import db
+from mqtt_client import sync
+from permissions import PERMISSIONS, MUTED
+from prefixes import PREFIX_CACHE
+
+def setup_function():
+    db.Base.metadata.drop_all(db.engine)
+    db.Base.metadata.create_all(db.engine)
+    sync.VERSION = None
+    sync.ROW_VERSIONS.clear()
+
+def log():
+    session = db.Session()
+    try:
+        return [row.as_change() for row in session.query(db.ChangeLog).order_by(db.ChangeLog.seq)]
+    finally:
+        session.close()
+
+def test_changes_are_logged_with_their_state():
+    session = db.Session()
+    session.add(db.Servers(id=1, prefix='!'))
+    session.commit()
+    server = session.get(db.Servers, 1)
+    server.muted = True
+    session.commit()
+    server.muted = True   # no net change, nothing to log
+    session.commit()
+    session.delete(server)
+    session.commit()
+    session.close()
+
+    changes = log()
+    assert [change['seq'] for change in changes] == [1, 2, 3]
+    assert changes[0]['state']['prefix'] == '!'
+    assert changes[1]['state']['muted'] is True
+    assert changes[2]['deleted'] and changes[2]['state'] is None
+
+def test_older_changes_for_a_row_are_ignored():
+    newer = {'seq': 5, 'table': 'channels', 'id': 7, 'deleted': False, 'state': {'prefix': '?', 'muted': True, 'voiced': False, 'jsondata': None}}
+    older = dict(newer, seq=4, state=dict(newer['state'], prefix='.', muted=False))
+    assert sync.apply(newer)
+    assert not sync.apply(older)
+    assert PREFIX_CACHE.get(7) == '?'
+    assert PERMISSIONS['channels'][7] == MUTED
+    assert sync.VERSION == 5
+
+def test_catch_up_replays_missed_changes():
+    asyncio.run(sync.init_version())
+    session = db.Session()
+    session.add_all([db.Users(id=n, muted=True) for n in range(1, 6)])
+    session.commit()
+    session.close()
+    PERMISSIONS['users'].clear()
+
+    assert asyncio.run(sync.catch_up()) == 5
+    assert set(PERMISSIONS['users']) == {1, 2, 3, 4, 5}
+    assert sync.VERSION == 5
+    # a second pass overlaps, but applies nothing twice
+    assert asyncio.run(sync.catch_up()) == 0
+
+def test_replay_pages_and_resets():
+    session = db.Session()
+    session.add_all([db.Roles(id=n, moderator=True) for n in range(1, 4)])
+    session.add(db.Roles(id=9))
+    session.commit()
+    reply = sync._replay(session, 1)
+    assert [change['id'] for change in reply['changes']] == [2, 3, 9]
+    assert reply['version'] == 4 and not reply['more']
+
+    snapshot = sync._snapshot(session)
+    assert snapshot['version'] == 4
+    assert set(snapshot['tables']['roles']) == {'1', '2', '3'}
+
+    session.query(db.ChangeLog).filter(db.ChangeLog.seq < 3).delete()
+    session.commit()
+    assert sync._replay(session, 0)['reset']
+    session.close()
+
+def test_writes_outside_the_orm_are_logged_and_replayed():
+    asyncio.run(sync.init_version())
+    # what a config UI does: plain SQL, straight to the database
+    with db.engine.begin() as connection:
+        connection.execute(text("INSERT INTO users (id, voiced, muted, moderator, updated_at) VALUES (8, 0, 1, 0, CURRENT_TIMESTAMP)"))
+        connection.execute(text("UPDATE servers SET prefix = '!' WHERE id = 1"))
+        connection.execute(text("INSERT INTO servers (id, prefix, muted, updated_at) VALUES (2, '?', 0, CURRENT_TIMESTAMP)"))
+        connection.execute(text("UPDATE servers SET muted = 0 WHERE id = 2"))   # no change, not logged
+
+    session = db.Session()
+    changes = sync._replay(session, 0)['changes']
+    session.close()
+    assert [(change['table'], change['id']) for change in changes] == [('users', 8), ('servers', 2)]
+    assert changes[0]['state'] == {'voiced': False, 'muted': True, 'moderator': False, 'jsondata': None}
+    assert changes[1]['state']['prefix'] == '?'
+
+    PERMISSIONS['users'].clear()
+    assert asyncio.run(sync.catch_up()) == 2
+    assert PERMISSIONS['users'] == {8: MUTED}
+    assert PREFIX_CACHE.get(2) == '?'
+
+def test_core_inserts_are_logged_and_broadcast():
+    committed = []
+    def capture(session):
+        committed.extend(session.info.get('sync_changes', ()))
+    # ahead of sync's own listener, which takes the changes
+    event.listen(db.Session, 'after_commit', capture, insert=True)
+    try:
+        session = db.Session()
+        db.bulk_ensure(session, db.Channels, [3, 4])
+        session.close()
+    finally:
+        event.remove(db.Session, 'after_commit', capture)
+
+    assert [(change['seq'], change['id']) for change in log()] == [(1, 3), (2, 4)]
+    assert sorted((change['seq'], change['id']) for change in committed) == [(1, 3), (2, 4)]